@@ -0,0 +1,108 @@
+import bz2
+import gzip
+import lzma
+import queue
+import tarfile
+
+# Single compressed files by extension, each opened as an incremental decompressing stream
+DECOMPRESSORS = {
+    "gz": gzip.open,
+    "bz2": bz2.open,
+    "xz": lzma.open,
+}
+
+# Names of tar archives, plain or compressed
+TAR_SUFFIXES = (".tar", ".tgz", ".tar.gz", ".tbz", ".tbz2", ".tar.bz2", ".txz", ".tar.xz")
+
+def archive_kind(file_name):
+    """"tar" for a tar archive, "gz", "bz2" or "xz" for a single compressed file, None for anything else."""
+    lower_name = file_name.lower()
+    if lower_name.endswith(TAR_SUFFIXES):
+        return "tar"
+    extension = lower_name.rsplit('.', 1)[-1] if '.' in lower_name else ''
+    return extension if extension in DECOMPRESSORS else None
+
+def decompressed_name(file_name):
+    """Name of a single compressed file once decompressed, e.g. find.txt.gz becomes find.txt."""
+    return file_name.rsplit('.', 1)[0] or file_name
+
+def open_decompressed(fileobj, kind):
+    """Decompress a gz, bz2 or xz stream as it is read, checking its CRC or checksum at the end."""
+    return DECOMPRESSORS[kind](fileobj, "rb")
+
+def iter_tar_members(fileobj):
+    """Read a tar archive, compressed or not, in a single forward pass over fileobj.
+
+    Yields (tarinfo, stream) for every regular file. Each stream has to be
+    read before moving on to the next member, since nothing is seekable.
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                yield member, tar.extractfile(member)
+
+class StreamPipe:
+    """File-like bridge from a writer pushing chunks, such as a pycurl WRITEFUNCTION, to a reader in another thread.
+
+    At most max_chunks chunks are held, so the transfer waits for the reader
+    instead of buffering the archive in memory. The writer calls close() when
+    it is done, with the error if it failed, and the reader calls abort() to
+    stop the writer early.
+    """
+
+    def __init__(self, max_chunks):
+        self._chunks = queue.Queue(max_chunks)
+        self._buffer = bytearray()
+        self._eof = False
+        self.aborted = False
+        self.error = None
+        self.bytes_written = 0
+
+    def _put(self, chunk):
+        while not self.aborted:
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, data):
+        """Queue a chunk, returning 0 aborts the pycurl transfer once the reader has given up."""
+        if not self._put(bytes(data)):
+            return 0
+        self.bytes_written += len(data)
+        return None
+
+    def close(self, error=None):
+        self.error = error
+        self._put(None)
+
+    def abort(self):
+        self.aborted = True
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+                if self.error is not None:
+                    raise self.error
+                break
+            self._buffer += chunk
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def drain(self):
+        """Read and discard whatever the reader left, such as tar padding, so the writer can finish."""
+        self._buffer.clear()
+        while not self._eof:
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+                if self.error is not None:
+                    raise self.error
@@ -0,0 +1,479 @@
+import asyncio
+import calendar
+import os
+import time
+from urllib.parse import urlparse
+
+import aiofiles
+import aioftp
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobBlock
+from azure.storage.blob.aio import BlobServiceClient
+
+import bandwidth
+import config
+import custom_logging as cl
+import child
+import host_limits
+import metrics
+import sinks
+from blob_blocks import make_block_id, resumable_block_prefix
+from blob_index import BlobIndex
+from content_hash import hash_file
+from retry import CircuitBreaker
+
+# Seconds between attempts to take a server's connection slot while other processes hold them all
+HOST_SLOT_POLL_INTERVAL = 0.1
+
+# Existing blobs per prefix, kept for the life of the worker like child.blob_index
+blob_index = (BlobIndex(None, results_per_page=config.BLOB_INDEX["results_per_page"],
+                        max_age=config.BLOB_INDEX["max_age"])
+              if config.BLOB_INDEX["enabled"] else None)
+
+def transfer_timeouts():
+    """TRANSFER_TIMEOUTS as (connect, stall, total) seconds for the asyncio clients, None where there is no limit.
+
+    A transfer counts as stalled when no data arrives for low_speed_time
+    seconds, the nearest these clients get to curl's low speed limit.
+    """
+    timeouts = config.TRANSFER_TIMEOUTS
+    stall = timeouts["low_speed_time"] if timeouts["low_speed_limit"] and timeouts["low_speed_time"] else None
+    return timeouts["connect_timeout"] or None, stall, timeouts["total_timeout"] or None
+
+def parse_mlst_time(value):
+    """Convert an MLST modify fact (UTC, YYYYMMDDHHMMSS[.fff]) to a Unix timestamp."""
+    return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+
+async def acquire_host_slot(host, deadline=None):
+    """Wait for one of the server's cross-process connection slots without blocking the event loop.
+
+    Returns False without a slot once deadline, a time.monotonic() value, has passed.
+    """
+    while not host_limits.try_acquire(host):
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(HOST_SLOT_POLL_INTERVAL)
+    return True
+
+class FtpClientPool:
+    """Logged-in aioftp clients kept per server so consecutive transfers skip the connect and login."""
+
+    def __init__(self, max_idle_per_host):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+
+    async def acquire(self, server):
+        idle = self._idle.get(server)
+        if idle:
+            return idle.pop()
+
+        parsed = urlparse(server)
+        connect_timeout, stall_timeout, _ = transfer_timeouts()
+        # socket_timeout aborts a read that gets no data for that long, e.g. a hung data connection
+        client = aioftp.Client(connection_timeout=connect_timeout, socket_timeout=stall_timeout)
+        # Only new connections are timed, a reused client has nothing left to connect
+        with metrics.collector.timed("connect", child.get_server_folder_name(server)):
+            await client.connect(parsed.hostname, parsed.port or 21)
+            await client.login(user=parsed.username or "anonymous", password=parsed.password or "")
+        return client
+
+    async def release(self, server, client):
+        idle = self._idle.setdefault(server, [])
+        if len(idle) < self.max_idle_per_host:
+            idle.append(client)
+        else:
+            await self.discard(client)
+
+    @staticmethod
+    async def discard(client):
+        try:
+            await client.quit()
+        except Exception:
+            client.close()
+
+    async def close(self):
+        for idle in self._idle.values():
+            for client in idle:
+                await self.discard(client)
+        self._idle.clear()
+
+class SftpSessions:
+    """One asyncssh connection and SFTP session per server, shared by every transfer to it."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._locks = {}
+
+    async def get(self, server):
+        # asyncssh is only needed when SFTP sources are used
+        import asyncssh
+
+        async with self._locks.setdefault(server, asyncio.Lock()):
+            if server not in self._sessions:
+                parsed = urlparse(server)
+                connect_timeout, _, _ = transfer_timeouts()
+                with metrics.collector.timed("connect", child.get_server_folder_name(server)):
+                    conn = await asyncssh.connect(parsed.hostname, port=parsed.port or 22,
+                                                  username=parsed.username, password=parsed.password,
+                                                  known_hosts=None, connect_timeout=connect_timeout,
+                                                  login_timeout=connect_timeout)
+                    self._sessions[server] = (conn, await conn.start_sftp_client())
+            return self._sessions[server][1]
+
+    async def close(self):
+        for conn, sftp in self._sessions.values():
+            sftp.exit()
+            conn.close()
+            await conn.wait_closed()
+        self._sessions.clear()
+
+class AsyncEngine:
+    """Ingest a batch on one event loop: aioftp/asyncssh downloads, aiofiles for local files and
+    non-blocking uploads through azure.storage.blob.aio.
+
+    A semaphore bounds how many files are in flight, and each download also
+    holds its server's connection slot from host_limits. Zip, tar and
+    compressed files are handed to child.handle_downloaded_file in a thread,
+    since extraction is file and CPU bound, and so are the SQLite lookups of
+    the ingestion state. Files larger than one block are staged block by
+    block, so at most a block of each file is in memory. Downloads are not
+    resumed or segmented in this engine.
+
+    Like child.process_batch, every download has the TRANSFER_TIMEOUTS and is
+    cut short at the batch deadline, CHILD_PROCESS["timeout"] seconds after
+    the engine is created. Entries that fail are kept in self.failed, entries
+    not started before the deadline or while their server's circuit is open
+    in self.deferred, both to be handed back for a retry.
+    """
+
+    def __init__(self, max_concurrent_tasks):
+        self.semaphore = asyncio.Semaphore(max_concurrent_tasks)
+        self.failed = []
+        self.deferred = []
+        self.deadline = time.monotonic() + config.CHILD_PROCESS["timeout"]
+        self.breaker = CircuitBreaker(config.RETRY["breaker_failures"], config.RETRY["breaker_cooldown"])
+        self.ftp_clients = FtpClientPool(config.CHILD_PROCESS["max_idle_connections_per_host"])
+        self.sftp_sessions = SftpSessions()
+        self.blob_service_client = BlobServiceClient.from_connection_string(
+            config.AZURE_STORAGE_CONNECTION_STRING,
+            max_block_size=config.UPLOAD["block_size"],
+            max_single_put_size=config.UPLOAD["single_put_threshold"],
+            connection_timeout=config.UPLOAD["connection_timeout"],
+            read_timeout=config.UPLOAD["read_timeout"]
+        )
+        self.container_client = self.blob_service_client.get_container_client(config.AZURE_CONTAINER_NAME)
+        self._prefix_locks = {}
+
+    async def close(self):
+        await self.ftp_clients.close()
+        await self.sftp_sessions.close()
+        await self.blob_service_client.close()
+
+    def past_deadline(self):
+        return time.monotonic() >= self.deadline
+
+    def may_start(self, entry, host):
+        """Whether to try an entry now, otherwise it is handed back untried like in child.may_start."""
+        if self.past_deadline():
+            reason = "the batch ran out of time"
+        elif not self.breaker.allow(host):
+            reason = f"{host} keeps failing"
+        else:
+            return True
+        self.defer(entry, reason)
+        return False
+
+    def defer(self, entry, reason):
+        cl.monitor_logger.warning(f"Handing back {entry[1]} from {entry[0]} for a retry, {reason}")
+        self.deferred.append(entry)
+
+    def transfer_failed(self, server, host):
+        # Transfers aborted by the batch deadline say nothing about the server
+        if self.past_deadline():
+            return
+        if self.breaker.record_failure(host):
+            cl.monitor_logger.warning(f"{server} failed {self.breaker.failure_threshold} transfers in a row, "
+                                      f"handing back its files for {self.breaker.cooldown} seconds")
+
+    async def download_with_timeout(self, server, remote_path, local_path, expected_size, remote_timestamp):
+        """Run a download, aborting it after the total timeout or at the batch deadline, whichever is first."""
+        _, _, total_timeout = transfer_timeouts()
+        timeout = max(0.0, self.deadline - time.monotonic())
+        if total_timeout is not None:
+            timeout = min(timeout, total_timeout)
+        try:
+            return await asyncio.wait_for(
+                self.download(server, remote_path, local_path, expected_size, remote_timestamp), timeout)
+        except asyncio.TimeoutError:
+            raise Exception(f"Download of {remote_path} from {server} timed out after {timeout:.0f} seconds")
+
+    async def ingest(self, entry):
+        """Download, upload and record one (server, remote_path[, size, modified_time]) entry."""
+        server, remote_path, *metadata = entry
+        expected_size, remote_timestamp = metadata if metadata else (None, None)
+
+        async with self.semaphore:
+            host = child.get_server_folder_name(server)
+            if not self.may_start(entry, host):
+                return
+            try:
+                server_folder, file_name, file_type, local_dir, local_path = child.prepare_download(server, remote_path)
+
+                if not await acquire_host_slot(host, self.deadline):
+                    self.defer(entry, "the batch ran out of time waiting for a connection slot")
+                    return
+                try:
+                    downloaded = await self.download_with_timeout(server, remote_path, local_path,
+                                                                  expected_size, remote_timestamp)
+                except Exception:
+                    self.transfer_failed(server, host)
+                    raise
+                finally:
+                    host_limits.release(host)
+                self.breaker.record_success(host)
+                if downloaded is None:
+                    return
+                expected_size, remote_timestamp = downloaded
+
+                child.verify_download(local_path, expected_size, remote_timestamp)
+
+                if child.expansion_kind(file_name, file_type) is not None:
+                    blob_paths = await asyncio.to_thread(child.handle_downloaded_file, local_path, local_dir,
+                                                         server_folder, file_name, file_type)
+                else:
+                    try:
+                        with metrics.collector.timed("upload", server_folder, expected_size):
+                            blob_paths = [await self.upload_file(local_path, server_folder, file_name, file_type)]
+                    finally:
+                        child.cleanup_file(local_path)
+                    if None in blob_paths:
+                        blob_paths = None
+
+                if blob_paths is None:
+                    self.failed.append((server, remote_path, expected_size, remote_timestamp))
+                    return
+                await asyncio.to_thread(child.record_ingested, server, remote_path, expected_size,
+                                        remote_timestamp, blob_paths)
+
+            except Exception as e:
+                cl.error_logger.error(f"Error downloading {remote_path} from {server}: {e}")
+                self.failed.append((server, remote_path, expected_size, remote_timestamp))
+
+    async def download(self, server, remote_path, local_path, expected_size, remote_timestamp):
+        """Download a file to local_path, returning its (size, modified_time) or None if it is unchanged."""
+        scheme = urlparse(server).scheme
+        if scheme == "ftp":
+            return await self.download_ftp(server, remote_path, local_path, expected_size, remote_timestamp)
+        if scheme == "sftp":
+            return await self.download_sftp(server, remote_path, local_path, expected_size, remote_timestamp)
+        raise Exception(f"Unsupported protocol for server: {server}")
+
+    async def download_ftp(self, server, remote_path, local_path, expected_size, remote_timestamp):
+        host = child.get_server_folder_name(server)
+        client = await self.ftp_clients.acquire(server)
+        try:
+            if expected_size is None or remote_timestamp is None:
+                with metrics.collector.timed("metadata", host):
+                    info = await client.stat(remote_path)
+                if info.get("type") != "file":
+                    raise Exception(f"{remote_path} is not a file, detected type: {info.get('type')}")
+                expected_size, remote_timestamp = int(info["size"]), parse_mlst_time(info["modify"])
+
+            unchanged = await asyncio.to_thread(child.is_already_ingested, server, remote_path,
+                                                expected_size, remote_timestamp)
+            if not unchanged:
+                cl.monitor_logger.info(f"Downloading {server}{remote_path} to {local_path}")
+                with metrics.collector.timed("download", host, expected_size):
+                    async with client.download_stream(remote_path) as stream:
+                        async with aiofiles.open(local_path, "wb") as local_file:
+                            async for block in stream.iter_by_block(child.STREAM_READ_SIZE):
+                                await local_file.write(block)
+                                await pace("download", bandwidth.host_of(server), len(block))
+        except asyncio.CancelledError:
+            # Timed out mid-transfer, the connection is dropped without waiting on the server
+            client.close()
+            raise
+        except Exception:
+            # The control connection may be mid-transfer, so it is not reused
+            await self.ftp_clients.discard(client)
+            raise
+
+        await self.ftp_clients.release(server, client)
+        return None if unchanged else (expected_size, remote_timestamp)
+
+    async def download_sftp(self, server, remote_path, local_path, expected_size, remote_timestamp):
+        host = child.get_server_folder_name(server)
+        sftp = await self.sftp_sessions.get(server)
+        if expected_size is None or remote_timestamp is None:
+            with metrics.collector.timed("metadata", host):
+                attrs = await sftp.stat(remote_path)
+            expected_size, remote_timestamp = attrs.size, attrs.mtime
+
+        if await asyncio.to_thread(child.is_already_ingested, server, remote_path, expected_size, remote_timestamp):
+            return None
+
+        cl.monitor_logger.info(f"Downloading {server}{remote_path} to {local_path}")
+        _, stall_timeout, _ = transfer_timeouts()
+        with metrics.collector.timed("download", host, expected_size):
+            async with sftp.open(remote_path, "rb") as remote_file:
+                async with aiofiles.open(local_path, "wb") as local_file:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(remote_file.read(child.STREAM_READ_SIZE), stall_timeout)
+                        except asyncio.TimeoutError:
+                            raise Exception(f"Download of {remote_path} from {server} stalled for {stall_timeout} seconds")
+                        if not chunk:
+                            break
+                        await local_file.write(chunk)
+                        await pace("download", bandwidth.host_of(server), len(chunk))
+        return expected_size, remote_timestamp
+
+    async def get_existing_metadata(self, blob_client):
+        """Return the metadata of an existing blob, or None if it doesn't exist."""
+        try:
+            if blob_index is None:
+                return (await blob_client.get_blob_properties()).metadata
+
+            prefix = BlobIndex.prefix_of(blob_client.blob_name)
+            async with self._prefix_locks.setdefault(prefix, asyncio.Lock()):
+                if not blob_index.is_indexed(prefix):
+                    blobs = [blob async for blob in self.container_client.list_blobs(
+                        name_starts_with=prefix,
+                        include=["metadata"],
+                        results_per_page=config.BLOB_INDEX["results_per_page"]
+                    )]
+                    blob_index.add_listing(prefix, blobs)
+            return blob_index.lookup(blob_client.blob_name)
+        except Exception:
+            # Blob does not exist, continue with original blob_path
+            return None
+
+    async def resolve_blob_path(self, server_folder, file_name, file_type, file_size, modified_time):
+        """Determine the blob path for a file, adding a timestamp suffix if an identical blob already exists."""
+        blob_path = child.build_blob_path(server_folder, file_name, file_type)
+        blob_client = self.container_client.get_blob_client(blob_path)
+
+        if child.is_duplicate(await self.get_existing_metadata(blob_client), file_size, modified_time):
+            blob_path = child.build_blob_path(server_folder, file_name, file_type, suffix=f"_{int(time.time())}")
+            blob_client = self.container_client.get_blob_client(blob_path)
+
+        return blob_path, blob_client
+
+    async def upload_file(self, local_path, server_folder, file_name, file_type):
+        """Upload a local file without blocking the event loop, returning the blob path or None on failure."""
+        try:
+            modified_time = os.path.getmtime(local_path)
+            creation_time = os.path.getctime(local_path)
+            file_size = os.path.getsize(local_path)
+            blob_path, blob_client = await self.resolve_blob_path(server_folder, file_name, file_type,
+                                                                  file_size, modified_time)
+
+            cl.monitor_logger.info(f"Uploading {local_path} to Azure as {blob_path}")
+
+            response = None
+            # Anything larger than a block is staged, so a file is never read into memory whole
+            if file_size > config.UPLOAD["block_size"]:
+                # Hashing a large file from disk is CPU bound, so it runs off the event loop
+                hasher = await asyncio.to_thread(hash_file, local_path, config.INTEGRITY["sha256"])
+                metadata = child.build_blob_metadata(creation_time, modified_time, file_size, hasher)
+                await self.upload_in_blocks(blob_client, local_path, file_size, modified_time,
+                                            sinks.content_settings(hasher), metadata)
+            else:
+                async with aiofiles.open(local_path, "rb") as data:
+                    content = await data.read()
+                # The file is already in memory, so it is hashed there and Azure checks it against Content-MD5
+                hasher = child.new_hasher()
+                hasher.update(content)
+                metadata = child.build_blob_metadata(creation_time, modified_time, file_size, hasher)
+                await pace("upload", None, file_size)
+                response = await blob_client.upload_blob(
+                    content,
+                    content_settings=sinks.content_settings(hasher),
+                    metadata=metadata,
+                    overwrite=True,
+                    headers={"Content-MD5": hasher.md5_base64()},
+                    timeout=config.UPLOAD["operation_timeout"]
+                )
+
+            cl.monitor_logger.info(f"Successfully uploaded {local_path} to Azure as {blob_path}")
+            if blob_index is not None:
+                blob_index.add(blob_path, metadata)
+
+            child.verify_upload(local_path, hasher, response)
+            return blob_path
+
+        except Exception as e:
+            cl.error_logger.error(f"Error uploading {local_path} to Azure: {e}")
+            return None
+
+    async def upload_in_blocks(self, blob_client, local_path, file_size, modified_time, content_settings, metadata):
+        """Stage a large file as blocks concurrently and commit them, like blob_blocks.upload_file_in_blocks."""
+        block_size = config.UPLOAD["block_size"]
+        prefix = resumable_block_prefix(file_size, modified_time, block_size)
+        block_count = max(1, -(-file_size // block_size))
+        block_ids = [make_block_id(index, prefix) for index in range(block_count)]
+
+        try:
+            _, uncommitted = await blob_client.get_block_list(block_list_type="uncommitted")
+            already_staged = {block.id: block.size for block in uncommitted}
+        except ResourceNotFoundError:
+            already_staged = {}
+
+        block_semaphore = asyncio.Semaphore(max(1, config.UPLOAD["max_concurrency"]))
+
+        async def stage(index, block_id):
+            length = min(block_size, file_size - index * block_size)
+            if already_staged.get(block_id) == length:
+                return
+            async with block_semaphore:
+                async with aiofiles.open(local_path, "rb") as local_file:
+                    await local_file.seek(index * block_size)
+                    data = await local_file.read(length)
+                await stage_block_with_retries(blob_client, block_id, data,
+                                               config.UPLOAD["block_retries"], config.UPLOAD["block_retry_delay"])
+
+        await asyncio.gather(*(stage(index, block_id) for index, block_id in enumerate(block_ids)))
+        await blob_client.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in block_ids],
+            content_settings=content_settings,
+            metadata=metadata,
+            timeout=config.UPLOAD["operation_timeout"]
+        )
+
+async def stage_block_with_retries(blob_client, block_id, data, retries, retry_delay):
+    """Stage one block, retrying just that block with exponential backoff."""
+    for attempt in range(retries + 1):
+        await pace("upload", None, len(data))
+        try:
+            await blob_client.stage_block(block_id=block_id, data=data, length=len(data),
+                                          timeout=config.UPLOAD["operation_timeout"])
+            return
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay * (2 ** attempt)
+            cl.monitor_logger.warning(f"Staging block {block_id} of {blob_client.blob_name} failed ({e}), retrying in {delay} seconds")
+            await asyncio.sleep(delay)
+
+async def pace(direction, host, num_bytes):
+    """Charge bytes to the shared bandwidth budgets, waiting without blocking the event loop."""
+    wait = bandwidth.reserve(direction, host, num_bytes)
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+async def process_batch_async(batch):
+    engine = AsyncEngine(config.ASYNC_ENGINE["max_concurrent_tasks"])
+    try:
+        await asyncio.gather(*(engine.ingest(entry) for entry in batch))
+    finally:
+        await engine.close()
+    return engine.failed, engine.deferred
+
+def process_batch(batch):
+    """Process a batch on a single event loop, a drop-in replacement for child.process_batch.
+
+    Each entry is (server, remote_path) or (server, remote_path, size, modified_time)
+    when the remote metadata was already probed. Returns (failed, deferred) like
+    child.process_batch.
+    """
+    return asyncio.run(process_batch_async(batch))
@@ -0,0 +1,117 @@
+import multiprocessing
+import time
+from urllib.parse import urlparse
+
+# Limiter shared by every process, set in each worker by init_worker
+_limiter = None
+
+def host_of(url):
+    """Key of a URL's server, host_port like the server folders and HOST_LIMITS."""
+    parsed = urlparse(url)
+    return f"{parsed.hostname}_{parsed.port or (21 if parsed.scheme == 'ftp' else 22)}"
+
+def schedule_scale(schedule, now=None):
+    """Factor the rates are scaled by at the given local time, from the first matching schedule window.
+
+    Windows are {"start": "HH:MM", "end": "HH:MM", "scale": factor} with an
+    optional "weekdays" list, Monday being 0. A window whose end is before its
+    start runs past midnight.
+    """
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    for window in schedule:
+        if "weekdays" in window and local.tm_wday not in window["weekdays"]:
+            continue
+        start_hour, start_minute = map(int, window["start"].split(":"))
+        end_hour, end_minute = map(int, window["end"].split(":"))
+        start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            return window["scale"]
+    return 1.0
+
+class TokenBucket:
+    """Token bucket in shared memory, refilled at rate bytes per second by every process that uses it.
+
+    Bytes are taken after they are sent, so the bucket can go into debt, and
+    the taker waits until the debt is paid off. Create it in the parent
+    before the Pool starts.
+    """
+
+    def __init__(self, rate, burst_seconds):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        # [tokens, time.monotonic() of the last refill], monotonic time is system wide
+        self._state = multiprocessing.RawArray("d", [rate * burst_seconds, time.monotonic()])
+        self._lock = multiprocessing.Lock()
+
+    def take(self, num_bytes, scale=1.0, now=None):
+        """Take num_bytes tokens, returning the seconds to wait before sending more."""
+        now = time.monotonic() if now is None else now
+        rate = self.rate * scale
+        with self._lock:
+            tokens, last = self._state
+            tokens = min(rate * self.burst_seconds, tokens + max(0.0, now - last) * rate) - num_bytes
+            self._state[0] = tokens
+            self._state[1] = now
+        return -tokens / rate if tokens < 0 else 0.0
+
+class BandwidthLimiter:
+    """Global, per-direction and per-host token buckets, every transfer pays into each one that applies."""
+
+    def __init__(self, global_bucket, direction_buckets, host_buckets, schedule):
+        self.global_bucket = global_bucket
+        self.direction_buckets = direction_buckets  # {"download" or "upload": bucket}
+        self.host_buckets = host_buckets  # {host: bucket}
+        self.schedule = schedule
+
+    def take(self, direction, host, num_bytes, now=None):
+        """Charge num_bytes sent in a direction to a host, None for storage, returning the seconds to wait."""
+        scale = schedule_scale(self.schedule)
+        buckets = [self.global_bucket, self.direction_buckets.get(direction), self.host_buckets.get(host)]
+        return max([bucket.take(num_bytes, scale, now) for bucket in buckets if bucket is not None], default=0.0)
+
+def create_limiter(hosts, settings):
+    """Create the shared buckets for BANDWIDTH in config.py, in the parent before the Pool starts.
+
+    Returns None when limiting is disabled or every rate is 0, meaning no limit.
+    """
+    if not settings["enabled"]:
+        return None
+    for window in settings["schedule"]:
+        # A rate of 0 would never refill the buckets, pause a window's transfers with a small scale instead
+        if not window["scale"] > 0:
+            raise Exception(f"BANDWIDTH schedule window {window['start']}-{window['end']} needs a scale above 0")
+
+    def bucket(rate):
+        return TokenBucket(rate, settings["burst_seconds"]) if rate else None
+
+    direction_buckets = {direction: bucket(settings[f"{direction}_rate"]) for direction in ("download", "upload")}
+    host_buckets = {host: bucket(settings["per_host"].get(host, settings["per_host_rate"])) for host in hosts}
+    direction_buckets = {direction: b for direction, b in direction_buckets.items() if b is not None}
+    host_buckets = {host: b for host, b in host_buckets.items() if b is not None}
+
+    global_bucket = bucket(settings["global_rate"])
+    if global_bucket is None and not direction_buckets and not host_buckets:
+        return None
+    return BandwidthLimiter(global_bucket, direction_buckets, host_buckets, settings["schedule"])
+
+def init_worker(limiter):
+    """Pool initializer, gives the worker the limiter created in the parent."""
+    global _limiter
+    _limiter = limiter
+
+def limits(direction):
+    """Whether bytes sent in a direction count against a global or per-direction budget."""
+    return _limiter is not None and (_limiter.global_bucket is not None or direction in _limiter.direction_buckets)
+
+def reserve(direction, host, num_bytes):
+    """Charge bytes already sent, returning the seconds to hold off, for callers that can't sleep."""
+    if _limiter is None or num_bytes <= 0:
+        return 0.0
+    return _limiter.take(direction, host, num_bytes)
+
+def throttle(direction, host, num_bytes):
+    """Charge bytes about to be sent, sleeping until the budget allows them."""
+    wait = reserve(direction, host, num_bytes)
+    if wait > 0:
+        time.sleep(wait)
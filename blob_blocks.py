@@ -0,0 +1,154 @@
+import base64
+import hashlib
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobBlock
+
+import bandwidth
+import custom_logging as cl
+
+def make_block_id(index, prefix):
+    """Build a base64 block id, every id in a blob must have the same length so the prefix is 12 characters and the index is zero padded."""
+    return base64.b64encode(f"{prefix[:12]:0>12}-{index:08d}".encode()).decode()
+
+def resumable_block_prefix(file_size, modified_time, block_size):
+    """Derive a block id prefix from the file's identity so a retried upload of the same file finds its earlier blocks."""
+    return hashlib.md5(f"{file_size}-{int(modified_time)}-{block_size}".encode()).hexdigest()[:12]
+
+def get_uncommitted_blocks(blob_client):
+    """Return {block_id: size} for blocks staged on a blob but not yet committed."""
+    try:
+        _, uncommitted = blob_client.get_block_list(block_list_type="uncommitted")
+    except ResourceNotFoundError:
+        return {}
+    return {block.id: block.size for block in uncommitted}
+
+def stage_block_with_retries(blob_client, block_id, data, retries, retry_delay, timeout=None):
+    """Stage one block, retrying just that block with exponential backoff, timeout is Azure's per-request limit."""
+    for attempt in range(retries + 1):
+        # Every attempt sends the block again, so each one is paced
+        bandwidth.throttle("upload", None, len(data))
+        try:
+            blob_client.stage_block(block_id=block_id, data=data, length=len(data), timeout=timeout)
+            return
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay * (2 ** attempt)
+            cl.monitor_logger.warning(f"Staging block {block_id} of {blob_client.blob_name} failed ({e}), retrying in {delay} seconds")
+            time.sleep(delay)
+
+def upload_file_in_blocks(blob_client, local_path, file_size, modified_time, block_size, max_concurrency,
+                          retries, retry_delay, content_settings, metadata, timeout=None):
+    """Stage a local file as blocks in parallel and commit them, resuming an interrupted upload.
+
+    Block ids are derived from the file's size, modified time and the block
+    size, so the uncommitted block list Azure keeps for the blob is the record
+    of what an earlier attempt already staged. Those blocks are skipped and
+    only the missing ones are sent.
+    """
+    prefix = resumable_block_prefix(file_size, modified_time, block_size)
+    block_count = max(1, -(-file_size // block_size))
+    block_ids = [make_block_id(index, prefix) for index in range(block_count)]
+
+    already_staged = get_uncommitted_blocks(blob_client)
+    missing = []
+    for index, block_id in enumerate(block_ids):
+        length = min(block_size, file_size - index * block_size)
+        if already_staged.get(block_id) != length:
+            missing.append((index, block_id, length))
+
+    resumed = block_count - len(missing)
+    if resumed:
+        cl.monitor_logger.info(f"Resuming upload of {local_path}: {resumed} of {block_count} blocks already staged")
+
+    fd = os.open(local_path, os.O_RDONLY)
+    try:
+        def stage(item):
+            index, block_id, length = item
+            data = os.pread(fd, length, index * block_size)
+            stage_block_with_retries(blob_client, block_id, data, retries, retry_delay, timeout)
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            # list() re-raises the first block that ran out of retries
+            list(executor.map(stage, missing))
+    finally:
+        os.close(fd)
+
+    return blob_client.commit_block_list(
+        [BlobBlock(block_id=block_id) for block_id in block_ids],
+        content_settings=content_settings,
+        metadata=metadata,
+        timeout=timeout
+    )
+
+class BlockStager:
+    """Buffer incoming bytes and stage them as fixed-size blocks of a block blob.
+
+    write() can be used directly as a pycurl WRITEFUNCTION. An error while
+    staging aborts the transfer and is kept in self.error so the caller can
+    raise it once perform() returns.
+    """
+
+    def __init__(self, blob_client, block_size, retries=0, retry_delay=1, timeout=None):
+        self.blob_client = blob_client
+        self.block_size = block_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.block_ids = []
+        self.bytes_received = 0
+        self.error = None
+        self.prefix = uuid.uuid4().hex[:12]
+
+    @property
+    def name(self):
+        """Path of the blob being staged."""
+        return self.blob_client.blob_name
+
+    def write(self, data):
+        """Append data and stage every full block, returning 0 aborts the pycurl transfer."""
+        try:
+            self.buffer += data
+            self.bytes_received += len(data)
+            while len(self.buffer) >= self.block_size:
+                self._stage(bytes(self.buffer[:self.block_size]))
+                del self.buffer[:self.block_size]
+        except Exception as e:
+            self.error = e
+            return 0
+        return None
+
+    def flush(self):
+        """Stage whatever is left in the buffer as the final, possibly short, block."""
+        if self.buffer:
+            self._stage(bytes(self.buffer))
+            self.buffer.clear()
+
+    def commit(self, content_settings, metadata):
+        """Commit the staged blocks, in order, as the blob's content."""
+        self.flush()
+        return self.blob_client.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in self.block_ids],
+            content_settings=content_settings,
+            metadata=metadata,
+            timeout=self.timeout
+        )
+
+    def abort(self):
+        """Drop the buffered data of a blob that won't be committed.
+
+        Azure discards staged blocks that are never committed after a week.
+        """
+        self.buffer.clear()
+        self.block_ids = []
+
+    def _stage(self, data):
+        block_id = make_block_id(len(self.block_ids), self.prefix)
+        stage_block_with_retries(self.blob_client, block_id, data, self.retries, self.retry_delay, self.timeout)
+        self.block_ids.append(block_id)
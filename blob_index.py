@@ -0,0 +1,73 @@
+import threading
+import time
+
+import custom_logging as cl
+
+class BlobIndex:
+    """In-memory map of blob path to metadata for duplicate checks without a request per file.
+
+    Each server_folder/file_type prefix is listed once, with a paged
+    list_blobs including metadata, the first time a blob under it is looked
+    up. Uploads made through this process are added as they complete, so the
+    index stays current for the rest of the run. With max_age, a prefix is
+    listed again once its listing is that many seconds old, so a long-running
+    process also sees blobs uploaded by the others.
+    """
+
+    def __init__(self, container_client, results_per_page=5000, max_age=None):
+        self.container_client = container_client
+        self.results_per_page = results_per_page
+        self.max_age = max_age
+        self._blobs = {}
+        self._loaded_prefixes = {}  # {prefix: monotonic time it was listed}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def prefix_of(blob_path):
+        return blob_path.rsplit('/', 1)[0] + '/' if '/' in blob_path else ''
+
+    def _load(self, prefix):
+        """List every blob under a prefix into the index, once or whenever the listing is older than max_age."""
+        with self._lock:
+            if self.is_indexed(prefix):
+                return
+
+            blobs = self.container_client.list_blobs(
+                name_starts_with=prefix,
+                include=["metadata"],
+                results_per_page=self.results_per_page
+            )
+            self._store_listing(prefix, blobs)
+
+    def _store_listing(self, prefix, blobs):
+        listed = {blob.name: blob.metadata or {} for blob in blobs}
+        if prefix in self._loaded_prefixes:
+            # A new listing replaces the old one, dropping blobs deleted since
+            for blob_path in [blob_path for blob_path in self._blobs if blob_path.startswith(prefix)]:
+                del self._blobs[blob_path]
+        self._blobs.update(listed)
+        self._loaded_prefixes[prefix] = time.monotonic()
+        cl.monitor_logger.info(f"Indexed {len(listed)} existing blobs under {prefix}")
+
+    def is_indexed(self, prefix):
+        listed_at = self._loaded_prefixes.get(prefix)
+        return listed_at is not None and (self.max_age is None or time.monotonic() - listed_at < self.max_age)
+
+    def add_listing(self, prefix, blobs):
+        """Store a listing made elsewhere, e.g. by an async container client, as the blobs under a prefix."""
+        with self._lock:
+            self._store_listing(prefix, blobs)
+
+    def get(self, blob_path):
+        """Return the metadata of a blob, or None if it doesn't exist."""
+        self._load(self.prefix_of(blob_path))
+        return self.lookup(blob_path)
+
+    def lookup(self, blob_path):
+        """Return the metadata of a blob from prefixes already indexed, without listing anything."""
+        return self._blobs.get(blob_path)
+
+    def add(self, blob_path, metadata):
+        """Record a blob uploaded by this process."""
+        with self._lock:
+            self._blobs[blob_path] = metadata
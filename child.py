@@ -1,17 +1,70 @@
 import os
+import json
 import pycurl
 import shutil
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import config
 import custom_logging as cl
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from curl_pool import CurlPool
+from multi_download import DownloadJob, MultiDownloader
+from state_store import StateStore
+from listing import expand_pattern, remote_url
+from blob_index import BlobIndex
+from pipeline import Pipeline
+from content_hash import ContentHasher, hash_file
+from retry import CircuitBreaker
+import host_limits
+import metrics
+import sinks
+import archives
+import compression
 from urllib.parse import urlparse
 import time
 import re
+from collections import deque
 
-# Azure connection setup
-blob_service_client = BlobServiceClient.from_connection_string(config.AZURE_STORAGE_CONNECTION_STRING)
+# Storage the files are ingested into, Azure or a local filesystem per config.STORAGE
+sink = sinks.create_sink()
+
+# Per-process pool of curl handles, each worker reuses its logged-in connections across files
+curl_pool = CurlPool(max_idle_per_host=config.CHILD_PROCESS["max_idle_connections_per_host"],
+                     timeouts=config.TRANSFER_TIMEOUTS)
+# An idle handle keeps its logged-in connection open, so it keeps the connection slot of a limited server too
+host_limits.keep_idle_slots(curl_pool)
+
+# Record of ingested files, shared by every worker so unchanged files are skipped on later runs
+state_store = StateStore(config.INGESTION_STATE["path"]) if config.INGESTION_STATE["enabled"] else None
+
+# Existing blobs per prefix, listed once per worker for duplicate checks
+blob_index = (BlobIndex(sink, results_per_page=config.BLOB_INDEX["results_per_page"],
+                        max_age=config.BLOB_INDEX["max_age"])
+              if config.BLOB_INDEX["enabled"] else None)
+
+# Bytes read at a time when uploading from a stream such as a zip member
+STREAM_READ_SIZE = 1024 * 1024
+
+# Hashes of downloaded files computed during the transfer, keyed by local path until upload_file picks them up
+content_hashes = {}
+
+# Per-process CurlMulti engine, created on first use when max_concurrent_tasks > 1
+multi_downloader = None
+
+# Per-process threads expanding downloaded archives, created on first use
+archive_executor = None
+
+# Per-process threads uploading the files the multi downloader finishes, created on first use
+upload_executor = None
+
+# Entries of the running batch handed back to the parent, ones that failed and ones not tried
+failed_entries = []
+deferred_entries = []
+batch_lock = threading.Lock()
+
+# Per-batch circuit breaker, the files of a server that keeps failing are handed back instead of tried
+host_breaker = None
 
 def get_server_folder_name(server):
     parsed = urlparse(server)
@@ -32,53 +85,192 @@ def sanitize_filename(filename):
     
     return filename
 
-def get_remote_file_size(url):
-    """Get the file size from the remote server before downloading."""
-    c = pycurl.Curl()
-    c.setopt(pycurl.URL, url)
-    c.setopt(pycurl.NOBODY, True)  # We only want the headers
-    c.perform()
-    remote_file_size = c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
-    c.close()
-    
+def archive_member_name(member_name):
+    """Sanitize an archive member's path component by component, keeping its directories.
+
+    Members with the same name in different directories get different blobs.
+    Empty, . and .. components are dropped so the name stays inside the server folder.
+    """
+    parts = [sanitize_filename(part) for part in member_name.split('/') if part not in ('', '.', '..')]
+    return '/'.join(part for part in parts if part)
+
+def get_remote_file_metadata(url):
+    """Get the file size and last modified timestamp from the remote server in a single request."""
+    with curl_pool.handle(url) as c:
+        c.setopt(pycurl.NOBODY, True)  # We only want the headers
+        c.setopt(pycurl.OPT_FILETIME, True)  # This enables retrieval of the file's timestamp
+        c.setopt(pycurl.WRITEFUNCTION, lambda data: None)  # FTP reports the headers as body data, discard them
+        curl_pool.perform(c)
+        record_curl_timings("metadata", url, c)
+        remote_file_size = c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
+        # Get the remote file's last modified time (in seconds since epoch)
+        remote_timestamp = c.getinfo(pycurl.INFO_FILETIME)
+
     if remote_file_size < 0:
         cl.error_logger.error(f"Could not get the file size for {url}")
         raise Exception(f"Could not get the file size for {url}")
-    
-    return remote_file_size
 
-def get_remote_file_timestamp(url):
-    """Get the last modified timestamp of a file from the remote server."""
-    c = pycurl.Curl()
-    c.setopt(pycurl.URL, url)
-    c.setopt(pycurl.NOBODY, True)  # We only want the headers
-    c.setopt(pycurl.OPT_FILETIME, True)  # This enables retrieval of the file's timestamp
-    c.perform()
-    # Get the remote file's last modified time (in seconds since epoch)
-    remote_timestamp = c.getinfo(pycurl.INFO_FILETIME)
-    c.close()
-    
     if remote_timestamp == -1:
         cl.error_logger.error(f"Could not get the last modified time for {url}")
         raise Exception(f"Could not get the last modified time for {url}")
-    
-    return remote_timestamp
 
-def download_file_with_pycurl(url, local_path):
-    """Download a file from FTP or SFTP using pycurl and verify integrity by size."""
+    return int(remote_file_size), remote_timestamp
+
+def get_remote_file_size(url):
+    """Get the file size from the remote server before downloading."""
+    return get_remote_file_metadata(url)[0]
+
+def get_remote_file_timestamp(url):
+    """Get the last modified timestamp of a file from the remote server."""
+    return get_remote_file_metadata(url)[1]
+
+def record_curl_timings(stage, url, c):
+    """Record a finished curl transfer as connect time (connecting, login and commands before data flows) and stage time."""
+    host = get_server_folder_name(url)
+    pretransfer = c.getinfo(pycurl.PRETRANSFER_TIME)
+    metrics.collector.record("connect", host, pretransfer)
+    metrics.collector.record(stage, host, c.getinfo(pycurl.TOTAL_TIME) - pretransfer, int(c.getinfo(pycurl.SIZE_DOWNLOAD)))
+
+def record_multi_timings(job, c):
+    """MultiDownloader on_transfer callback, records each finished request of a job."""
+    record_curl_timings("metadata" if job.phase == "metadata" else "download", job.url, c)
+
+def new_hasher():
+    """Start hashing a transfer with the configured algorithms."""
+    return ContentHasher(sha256=config.INTEGRITY["sha256"])
+
+def resume_hasher(local_path, offset):
+    """Hasher for a download resuming at offset, already fed the bytes an earlier attempt wrote."""
+    if not offset:
+        return new_hasher()
+    return hash_file(local_path, length=offset, hasher=new_hasher())
+
+def checkpoint_path(local_path):
+    """Path of the checkpoint file kept next to an in-flight download."""
+    return f"{local_path}.checkpoint"
+
+def open_download_file(local_path, url, expected_size, remote_timestamp):
+    """Open the local file for a download, resuming a partial file if the remote file is unchanged.
+
+    Returns the open file and the byte offset to resume the transfer from.
+    """
+    checkpoint_file = checkpoint_path(local_path)
+    checkpoint = {"url": url, "size": expected_size, "modified_time": remote_timestamp}
+
+    if config.CHILD_PROCESS["resume_downloads"] and os.path.isfile(local_path):
+        try:
+            with open(checkpoint_file) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = None
+
+        offset = os.path.getsize(local_path)
+        if previous == checkpoint and 0 < offset <= expected_size:
+            cl.monitor_logger.info(f"Resuming download of {url} at byte {offset} of {expected_size}")
+            return open(local_path, 'ab'), offset
+
+    # Record what is being downloaded so an interrupted transfer can be resumed safely
+    with open(checkpoint_file, 'w') as f:
+        json.dump(checkpoint, f)
+    return open(local_path, 'wb'), 0
+
+def remove_checkpoint(local_path):
+    """Remove the checkpoint of a completed download."""
+    try:
+        os.remove(checkpoint_path(local_path))
+    except FileNotFoundError:
+        pass
+
+def segment_count_for(expected_size):
+    """Number of byte ranges to split a download into, 1 unless it is a large file and segmenting is enabled."""
+    settings = config.SEGMENTED_DOWNLOAD
+    if not settings["enabled"] or expected_size < settings["threshold"]:
+        return 1
+    return max(1, min(settings["segments"], settings["max_segments_per_host"]))
+
+def download_file_in_segments(url, local_path, expected_size, remote_timestamp, segment_count):
+    """Fetch a large file as byte ranges over several connections into one preallocated local file.
+
+    Segments are written out of order, so a partial file can't be resumed and
+    any checkpoint of an earlier attempt is removed first.
+    """
+    errors = []
+    remove_checkpoint(local_path)
+
+    # The caller holds the server's connection slot for the first segment, every extra one takes its own
+    extra_slots = 0
+    caller_slot_free = True
+
+    def acquire_slot(host):
+        nonlocal extra_slots, caller_slot_free
+        if caller_slot_free:
+            caller_slot_free = False
+            return True
+        if not host_limits.try_acquire(host):
+            return False
+        extra_slots += 1
+        return True
+
+    def release_slot(host):
+        nonlocal extra_slots, caller_slot_free
+        if extra_slots:
+            extra_slots -= 1
+            host_limits.release(host)
+        else:
+            caller_slot_free = True
+
+    def on_metadata(job):
+        job.segment_count = segment_count
+
+    downloader = MultiDownloader(curl_pool, segment_count,
+                                 max_segments_per_host=config.SEGMENTED_DOWNLOAD["max_segments_per_host"],
+                                 acquire_slot=acquire_slot, release_slot=release_slot,
+                                 on_transfer=record_multi_timings)
+    job = DownloadJob(url, local_path, on_done=lambda job: None,
+                      on_error=lambda job, error: errors.append(error), on_metadata=on_metadata)
+    job.host = get_server_folder_name(url)
+    # The caller already has the size and timestamp, so the job skips its metadata request
+    job.expected_size, job.remote_timestamp = expected_size, remote_timestamp
+    downloader.run([job])
+    if errors:
+        raise errors[0]
+
+def download_file_with_pycurl(url, local_path, expected_size=None, remote_timestamp=None):
+    """Download a file from FTP or SFTP using pycurl and verify integrity by size.
+
+    Returns the remote size and timestamp, which are only requested from the
+    server if the caller doesn't already know them.
+    """
     # Get the expected size and timestamp of the file from the server
-    expected_size = get_remote_file_size(url)
-    remote_timestamp = get_remote_file_timestamp(url)
-
-    # Download the file
-    with open(local_path, 'wb') as f:
-        c = pycurl.Curl()
-        c.setopt(pycurl.URL, url)
-        c.setopt(pycurl.WRITEDATA, f)
-        c.setopt(pycurl.NOPROGRESS, True)
-        c.perform()
-        c.close()
-    
+    if expected_size is None or remote_timestamp is None:
+        expected_size, remote_timestamp = get_remote_file_metadata(url)
+
+    segment_count = segment_count_for(expected_size)
+    if segment_count > 1:
+        cl.monitor_logger.info(f"Downloading {url} in up to {segment_count} segments")
+        download_file_in_segments(url, local_path, expected_size, remote_timestamp, segment_count)
+        verify_download(local_path, expected_size, remote_timestamp)
+        return expected_size, remote_timestamp
+
+    # Download the file, reusing the connection the metadata request just logged in with
+    f, offset = open_download_file(local_path, url, expected_size, remote_timestamp)
+    with f:
+        hasher = resume_hasher(local_path, offset)
+        if offset < expected_size:
+            with curl_pool.handle(url) as c:
+                # Hash each chunk as it arrives so the upload doesn't have to read the file again
+                c.setopt(pycurl.WRITEFUNCTION, hasher.wrap(f.write))
+                if offset:
+                    c.setopt(pycurl.RESUME_FROM_LARGE, offset)
+                curl_pool.perform(c)
+                record_curl_timings("download", url, c)
+
+    verify_download(local_path, expected_size, remote_timestamp)
+    content_hashes[local_path] = hasher
+    return expected_size, remote_timestamp
+
+def verify_download(local_path, expected_size, remote_timestamp):
+    """Check a downloaded file against the remote size and apply the remote timestamp."""
     # Check if the downloaded file size matches the expected size
     downloaded_size = os.path.getsize(local_path)
     cl.monitor_logger.info(f"Downloaded file {local_path}, size: {downloaded_size} bytes")
@@ -87,138 +279,781 @@ def download_file_with_pycurl(url, local_path):
         cl.error_logger.error(f"Incomplete download for {local_path}: expected size {expected_size} bytes, got {downloaded_size} bytes")
         raise Exception(f"Incomplete download for {local_path}: expected size {expected_size} bytes, got {downloaded_size} bytes")
     
+    # The whole file is verified, so a later attempt has nothing to resume
+    remove_checkpoint(local_path)
+
     # Set the file's modified time to match the remote timestamp
     os.utime(local_path, (remote_timestamp, remote_timestamp))
     cl.monitor_logger.info(f"Successfully downloaded and verified file {local_path} with original timestamp")
 
 def handle_zip_file(local_path, destination_folder, server_folder, file_type):
-    """Extract zip file contents while preserving their own metadata and uploading them."""
+    """Upload zip file contents while preserving their own metadata.
+
+    Returns the blob path of every member, with None for members that failed.
+    """
+    if config.ZIP["stream_members"]:
+        with zipfile.ZipFile(local_path, 'r') as zip_ref:
+            members = [file_info for file_info in zip_ref.infolist() if not file_info.is_dir()]
+            # Members are read straight out of the archive, several at a time
+            with ThreadPoolExecutor(max_workers=config.ZIP["max_concurrent_members"]) as executor:
+                blob_paths = list(executor.map(lambda file_info: upload_zip_member(local_path, zip_ref, file_info, server_folder), members))
+    else:
+        blob_paths = extract_zip_file(local_path, destination_folder, server_folder)
+
+    # Delete the original zip file
+    try:
+        os.remove(local_path)
+        cl.monitor_logger.info(f"Deleted original zip file: {local_path}")
+    except Exception as e:
+        cl.error_logger.error(f"Error deleting zip file {local_path}: {e}")
+
+    return blob_paths
+
+def upload_zip_member(local_path, zip_ref, file_info, server_folder):
+    """Stream a single zip member into the sink without extracting it to disk."""
+    source = f"{local_path}:{file_info.filename}"
+    try:
+        # Preserve the original modified time of the file inside the zip
+        original_modified_time = time.mktime(file_info.date_time + (0, 0, -1))
+
+        # Keep the member's directories, so members uploaded side by side with the same name get different blobs
+        member_file_name = archive_member_name(file_info.filename)
+        base_name = member_file_name.split('/')[-1]
+        member_file_type = base_name.split('.')[-1] if '.' in base_name else 'none'
+
+        with metrics.collector.timed("upload", server_folder, file_info.file_size):
+            if config.CONTENT_ADDRESSING["enabled"]:
+                return upload_zip_member_content_addressed(source, zip_ref, file_info, server_folder, member_file_name,
+                                                           member_file_type, original_modified_time)
+
+            with zip_ref.open(file_info) as member:
+                return upload_stream(member, source, server_folder, member_file_name, member_file_type,
+                                     file_info.file_size, original_modified_time)
+    except Exception as e:
+        cl.error_logger.error(f"Error uploading zip member {source} to {sink.name}: {e}")
+        return None
+
+def upload_zip_member_content_addressed(source, zip_ref, file_info, server_folder, file_name, file_type, modified_time):
+    """Hash a zip member out of the local archive first, so its bytes are only uploaded if the content is new."""
+    hasher = new_hasher()
+    with zip_ref.open(file_info) as member:
+        while True:
+            chunk = member.read(STREAM_READ_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+
+    def put_content(content_path, content_metadata):
+        with zip_ref.open(file_info) as member:
+            put_stream(content_path, member, source, file_type, file_info.file_size, hasher, content_metadata)
+
+    metadata = build_blob_metadata(time.time(), modified_time, file_info.file_size, hasher)
+    return upload_content_addressed(source, server_folder, file_name, file_type, file_info.file_size,
+                                    modified_time, hasher, metadata, put_content)
+
+def extract_zip_file(local_path, destination_folder, server_folder):
+    """Extract zip file contents to disk while preserving their own metadata and uploading them."""
+    # Handle each extracted file as if it were individually downloaded
+    return [handle_file(extracted_path, server_folder, extracted_file_name, extracted_file_type)
+            for extracted_path, extracted_file_name, extracted_file_type in extract_zip_members(local_path, destination_folder, server_folder)]
+
+def extract_zip_members(local_path, destination_folder, server_folder):
+    """Extract zip members to disk one at a time, yielding (extracted_path, file_name, file_type) for each file."""
     # Create a folder for the extracted contents
     extracted_dir = os.path.join(destination_folder, f"extracted_{Path(local_path).stem}")
     os.makedirs(extracted_dir, exist_ok=True)
 
     with zipfile.ZipFile(local_path, 'r') as zip_ref:
         for file_info in zip_ref.infolist():
+            # Directory entries have nothing to upload
+            if file_info.is_dir():
+                continue
+
             # Extract each file individually
-            extracted_path = zip_ref.extract(file_info, extracted_dir)
+            with metrics.collector.timed("extract", server_folder, file_info.file_size):
+                extracted_path = zip_ref.extract(file_info, extracted_dir)
             # Preserve the original modified time of the file inside the zip
             original_modified_time = time.mktime(file_info.date_time + (0, 0, -1))
             set_file_metadata(extracted_path, original_modified_time)
             cl.monitor_logger.info(f"Extracted {extracted_path} with original timestamp")
 
-            # Sanitize and determine the file name
-            extracted_file_name = sanitize_filename(file_info.filename.split('/')[-1])
-            extracted_file_type = extracted_file_name.split('.')[-1] if '.' in extracted_file_name else 'none'
-            
-            # Handle each extracted file as if it were individually downloaded
-            handle_file(extracted_path, server_folder, extracted_file_name, extracted_file_type)
+            # Keep the member's directories, like streamed members
+            extracted_file_name = archive_member_name(file_info.filename)
+            base_name = extracted_file_name.split('/')[-1]
+            extracted_file_type = base_name.split('.')[-1] if '.' in base_name else 'none'
 
-    # Delete the original zip file
-    try:
-        os.remove(local_path)
-        cl.monitor_logger.info(f"Deleted original zip file: {local_path}")
-    except Exception as e:
-        cl.error_logger.error(f"Error deleting zip file {local_path}: {e}")
+            yield extracted_path, extracted_file_name, extracted_file_type
 
 def set_file_metadata(local_path, modified_time):
     """Set the file's access and modified time to the original timestamp."""
     os.utime(local_path, (modified_time, modified_time))
     cl.monitor_logger.info(f"Set original timestamp for {local_path}")
 
-def download_and_handle_file(server, remote_path):
+def expansion_kind(file_name, file_type):
+    """How a file is expanded before upload: "zip", "tar", "gz", "bz2" or "xz", or None to upload it as it is."""
+    if file_type.lower() == 'zip':
+        return "zip"
+    if config.ARCHIVES["enabled"]:
+        return archives.archive_kind(file_name)
+    return None
+
+def archive_members_to_disk():
+    """Whether archive members are written to disk before upload rather than streamed.
+
+    Content-addressed uploads need the hash before any bytes are sent, and a
+    tar stream can't be read twice, so members go to disk in that mode.
+    """
+    return not config.ARCHIVES["stream_members"] or config.CONTENT_ADDRESSING["enabled"]
+
+def handle_archive(local_path, destination_folder, server_folder, file_name, kind):
+    """Expand a downloaded tar or compressed file as a stream, uploading each member as it is decompressed.
+
+    Returns the blob path of every member, with None for members that failed.
+    """
+    try:
+        if archive_members_to_disk():
+            return [handle_file(extracted_path, server_folder, extracted_file_name, extracted_file_type)
+                    for extracted_path, extracted_file_name, extracted_file_type
+                    in extract_archive_members(local_path, destination_folder, server_folder, file_name, kind)]
+
+        with open(local_path, 'rb') as archive:
+            return expand_archive(archive, local_path, server_folder, file_name, kind, os.path.getmtime(local_path))
+    finally:
+        # Delete the original archive
+        cleanup_file(local_path)
+
+def iter_archive_members(archive, file_name, kind, modified_time):
+    """Yield (member_name, stream, size, modified_time) for every file in an open archive.
+
+    A single compressed file is one member named without its compression
+    extension, whose size is only known once it has been read.
+    """
+    if kind == "tar":
+        for member, stream in archives.iter_tar_members(archive):
+            yield member.name, stream, member.size, member.mtime
+        return
+
+    with archives.open_decompressed(archive, kind) as stream:
+        yield archives.decompressed_name(file_name), stream, None, modified_time
+
+def expand_archive(archive, source, server_folder, file_name, kind, modified_time):
+    """Upload every member of an open archive straight from the decompressing stream."""
+    blob_paths = []
+    for member_name, stream, size, member_modified_time in iter_archive_members(archive, file_name, kind, modified_time):
+        blob_paths.append(upload_archive_member(stream, f"{source}:{member_name}", server_folder, member_name,
+                                                size, member_modified_time))
+    return blob_paths
+
+def upload_archive_member(stream, source, server_folder, member_name, size, modified_time):
+    """Stream one archive member into the sink, returning its blob path or None on failure."""
     try:
-        server_folder = get_server_folder_name(server)
-        file_name = sanitize_filename(remote_path.split('/')[-1])
-        file_type = file_name.split('.')[-1] if '.' in file_name else 'none'
+        # Sanitize and determine the file name, the type comes from the last path component
+        member_file_name = archive_member_name(member_name)
+        base_name = member_file_name.split('/')[-1]
+        member_file_type = base_name.split('.')[-1] if '.' in base_name else 'none'
+
+        with metrics.collector.timed("upload", server_folder, size or 0) as sample:
+            blob_path = upload_stream(stream, source, server_folder, member_file_name, member_file_type,
+                                      size, modified_time)
+            if size is None:
+                # A decompressed file's size is where its stream ended up
+                sample["bytes"] = stream.tell()
+            return blob_path
+    except Exception as e:
+        cl.error_logger.error(f"Error uploading archive member {source} to {sink.name}: {e}")
+        return None
+
+def extract_archive_members(local_path, destination_folder, server_folder, file_name, kind):
+    """Decompress archive members to disk one at a time, yielding (extracted_path, file_name, file_type) for each file."""
+    # Create a folder for the extracted contents
+    extracted_dir = os.path.join(destination_folder, f"extracted_{Path(local_path).stem}")
+    os.makedirs(extracted_dir, exist_ok=True)
+
+    with open(local_path, 'rb') as archive:
+        members = iter_archive_members(archive, file_name, kind, os.path.getmtime(local_path))
+        for index, (member_name, stream, size, modified_time) in enumerate(members):
+            # Sanitize and determine the file name, the type comes from the last path component
+            extracted_file_name = archive_member_name(member_name)
+            base_name = extracted_file_name.split('/')[-1]
+            extracted_file_type = base_name.split('.')[-1] if '.' in base_name else 'none'
+
+            # Members are written under their index, so names that only differ by directory don't collide
+            extracted_path = os.path.join(extracted_dir, f"{index}_{base_name}")
+            hasher = new_hasher()
+            with metrics.collector.timed("extract", server_folder) as sample, open(extracted_path, 'wb') as f:
+                write = hasher.wrap(f.write)
+                while True:
+                    chunk = stream.read(STREAM_READ_SIZE)
+                    if not chunk:
+                        break
+                    write(chunk)
+                sample["bytes"] = hasher.bytes_hashed
+
+            # Keep the hash computed while decompressing, and the member's own modified time
+            content_hashes[extracted_path] = hasher
+            set_file_metadata(extracted_path, modified_time)
+            cl.monitor_logger.info(f"Extracted {extracted_path} with original timestamp")
+
+            yield extracted_path, extracted_file_name, extracted_file_type
+
+def stream_archive_from_url(url, server_folder, file_name, kind, expected_size, remote_timestamp):
+    """Download an archive straight into its expansion, so neither the archive nor its members touch local disk.
+
+    The transfer runs in a thread writing into a bounded pipe, which the
+    decompressor reads from here, so the download waits whenever expansion
+    and upload fall behind.
+    """
+    pipe = archives.StreamPipe(config.ARCHIVES["max_buffered_chunks"])
+
+    def transfer():
+        try:
+            with curl_pool.handle(url) as c:
+                c.setopt(pycurl.WRITEFUNCTION, pipe.write)
+                curl_pool.perform(c)
+                record_curl_timings("download", url, c)
+        except Exception as e:
+            pipe.close(e)
+            return
+        pipe.close()
+
+    thread = threading.Thread(target=transfer, name="archive-download", daemon=True)
+    thread.start()
+    try:
+        blob_paths = expand_archive(pipe, url, server_folder, file_name, kind, remote_timestamp)
+        pipe.drain()
+    except Exception:
+        pipe.abort()
+        raise
+    finally:
+        thread.join()
+
+    # Check if the streamed size matches the expected size
+    if pipe.bytes_written != expected_size:
+        cl.error_logger.error(f"Incomplete download for {url}: expected size {expected_size} bytes, got {pipe.bytes_written} bytes")
+        raise Exception(f"Incomplete download for {url}: expected size {expected_size} bytes, got {pipe.bytes_written} bytes")
+    return blob_paths
+
+def prepare_download(server, remote_path):
+    """Work out the sanitized names and local download path for a remote file."""
+    server_folder = get_server_folder_name(server)
+    file_name = sanitize_filename(remote_path.split('/')[-1])
+    file_type = file_name.split('.')[-1] if '.' in file_name else 'none'
+
+    local_dir = os.path.join(config.LOCAL_DOWNLOAD_DIR, server_folder, file_type)
+    os.makedirs(local_dir, exist_ok=True)
+    local_path = os.path.join(local_dir, file_name)
+
+    return server_folder, file_name, file_type, local_dir, local_path
+
+def handle_downloaded_file(local_path, local_dir, server_folder, file_name, file_type):
+    """Pass a verified download on to zip extraction, archive expansion or straight to upload.
+
+    Returns the uploaded blob paths, or None if anything failed to upload.
+    """
+    # Extract zip files, expand tar and compressed files or handle regular files
+    kind = expansion_kind(file_name, file_type)
+    if kind == "zip":
+        blob_paths = handle_zip_file(local_path, local_dir, server_folder, file_type)
+    elif kind is not None:
+        blob_paths = handle_archive(local_path, local_dir, server_folder, file_name, kind)
+    else:
+        blob_paths = [handle_file(local_path, server_folder, file_name, file_type)]
+
+    if None in blob_paths:
+        return None
+    return blob_paths
+
+def is_already_ingested(server, remote_path, size, modified_time):
+    """Whether the state store has this file with the same remote size and modified time."""
+    if state_store is None or not state_store.is_unchanged(server, remote_path, size, modified_time):
+        return False
+    cl.monitor_logger.info(f"Skipping {server}{remote_path}: unchanged since it was last ingested")
+    return True
+
+def record_ingested(server, remote_path, size, modified_time, blob_paths):
+    """Record a fully uploaded file in the state store."""
+    if state_store is None or not blob_paths:
+        return
+    try:
+        state_store.record(server, remote_path, size, modified_time, blob_paths)
+    except Exception as e:
+        cl.error_logger.error(f"Error recording ingestion state for {server}{remote_path}: {e}")
+
+def record_transfer(server, num_bytes, started_at):
+    """Add a finished download to the server's transfer history, used to estimate batch times."""
+    if state_store is None or started_at is None:
+        return
+    try:
+        state_store.record_transfer(server, num_bytes, time.monotonic() - started_at)
+    except Exception as e:
+        cl.error_logger.error(f"Error recording transfer rate for {server}: {e}")
+
+def start_batch():
+    """Reset the handed back entries and circuit breaker, and set the deadline that aborts the batch's transfers."""
+    global host_breaker
+    with batch_lock:
+        failed_entries.clear()
+        deferred_entries.clear()
+    host_breaker = CircuitBreaker(config.RETRY["breaker_failures"], config.RETRY["breaker_cooldown"])
+    curl_pool.deadline = time.monotonic() + config.CHILD_PROCESS["timeout"]
 
-        local_dir = os.path.join(config.LOCAL_DOWNLOAD_DIR, server_folder, file_type)
-        os.makedirs(local_dir, exist_ok=True)
-        local_path = os.path.join(local_dir, file_name)
+def finish_batch():
+    """Clear the deadline and return the batch's (failed, deferred) entries.
+
+    Slots kept by idle connections are freed, other processes may need them
+    while this one waits for its next batch.
+    """
+    curl_pool.deadline = None
+    curl_pool.release_kept_slots()
+    with batch_lock:
+        return list(failed_entries), list(deferred_entries)
+
+def may_start(entry):
+    """Whether to try an entry now, otherwise it is handed back untried.
+
+    Entries are handed back once the batch is past its deadline or while
+    their server's circuit is open after repeated failures.
+    """
+    host = get_server_folder_name(entry[0])
+    if curl_pool.past_deadline():
+        reason = "the batch ran out of time"
+    elif host_breaker is not None and not host_breaker.allow(host):
+        reason = f"{host} keeps failing"
+    else:
+        return True
+
+    cl.monitor_logger.warning(f"Handing back {entry[1]} from {entry[0]} for a retry, {reason}")
+    with batch_lock:
+        deferred_entries.append(entry)
+    return False
+
+def file_failed(entry, transfer_failed=False):
+    """Hand a failed entry back for a retry, counting a failed transfer against its server."""
+    with batch_lock:
+        failed_entries.append(entry)
+
+    # Transfers aborted by the batch deadline say nothing about the server
+    if not transfer_failed or host_breaker is None or curl_pool.past_deadline():
+        return
+    if host_breaker.record_failure(get_server_folder_name(entry[0])):
+        cl.monitor_logger.warning(f"{entry[0]} failed {host_breaker.failure_threshold} transfers in a row, "
+                                  f"handing back its files for {host_breaker.cooldown} seconds")
+
+def transfer_succeeded(server):
+    if host_breaker is not None:
+        host_breaker.record_success(get_server_folder_name(server))
+
+def probe_remote_file(entry):
+    """Fetch the remote size and timestamp for a (server, remote_path) entry, returning them with the entry."""
+    server, remote_path = entry[:2]
+    try:
+        with host_limits.host_slot(get_server_folder_name(server)):
+            expected_size, remote_timestamp = get_remote_file_metadata(remote_url(server, remote_path))
+    except Exception as e:
+        cl.error_logger.error(f"Error probing {remote_path} on {server}: {e}")
+        return server, remote_path, None, None
+    return server, remote_path, expected_size, remote_timestamp
+
+def expand_source(entry):
+    """Expand a (server, directory or glob pattern) entry into (server, remote_path, size, modified_time) entries."""
+    server, pattern = entry
+    try:
+        with host_limits.host_slot(get_server_folder_name(server)):
+            entries = expand_pattern(server, pattern, curl_pool)
+    except Exception as e:
+        cl.error_logger.error(f"Error listing {pattern} on {server}: {e}")
+        return []
+    cl.monitor_logger.info(f"Expanded {pattern} on {server} into {len(entries)} files")
+    return entries
+
+def fetch_file(server, remote_path, expected_size=None, remote_timestamp=None, slot_acquired=False):
+    """Download a file to LOCAL_DOWNLOAD_DIR while holding the server's connection slot.
+
+    Returns (server_folder, file_name, file_type, local_dir, local_path, size, modified_time),
+    or None when the file is unchanged or was streamed straight to the sink. A streamed
+    archive with members that failed to upload is handed back with file_failed.
+    """
+    # Only the transfer holds the server's connection slot, the upload runs after it is freed
+    with host_limits.host_slot(get_server_folder_name(server), acquired=slot_acquired):
+        server_folder, file_name, file_type, local_dir, local_path = prepare_download(server, remote_path)
+
+        download_url = remote_url(server, remote_path)
+        if expected_size is None or remote_timestamp is None:
+            expected_size, remote_timestamp = get_remote_file_metadata(download_url)
+
+        if is_already_ingested(server, remote_path, expected_size, remote_timestamp):
+            return None
+
+        started_at = time.monotonic()
+        kind = expansion_kind(file_name, file_type)
+        if streams_to_blob(file_type) and kind not in (None, "zip") and not archive_members_to_disk():
+            blob_paths = stream_archive_from_url(download_url, server_folder, file_name, kind,
+                                                 expected_size, remote_timestamp)
+            record_transfer(server, expected_size, started_at)
+            if None in blob_paths:
+                # The transfer itself worked, so the retry doesn't count against the server
+                cl.error_logger.error(f"{blob_paths.count(None)} members of {download_url} failed to upload")
+                file_failed((server, remote_path, expected_size, remote_timestamp))
+            else:
+                record_ingested(server, remote_path, expected_size, remote_timestamp, blob_paths)
+            return None
+
+        if streams_to_blob(file_type) and kind is None:
+            blob_path = stream_file_to_blob(download_url, server_folder, file_name, file_type,
+                                            expected_size, remote_timestamp)
+            record_transfer(server, expected_size, started_at)
+            record_ingested(server, remote_path, expected_size, remote_timestamp, [blob_path])
+            return None
 
-        download_url = f"{server}{remote_path}"
         cl.monitor_logger.info(f"Downloading {download_url} to {local_path}")
-        download_file_with_pycurl(download_url, local_path)
+        download_file_with_pycurl(download_url, local_path, expected_size, remote_timestamp)
+        record_transfer(server, expected_size, started_at)
+        if kind is not None:
+            # Archives are expanded rather than uploaded, so upload_file never picks up their hash
+            content_hashes.pop(local_path, None)
 
-        # Extract zip files or handle regular files
-        if file_type.lower() == 'zip':
-            handle_zip_file(local_path, local_dir, server_folder, file_type)
-        else:
-            handle_file(local_path, server_folder, file_name, file_type)
+    return server_folder, file_name, file_type, local_dir, local_path, expected_size, remote_timestamp
 
+def download_and_handle_file(server, remote_path, expected_size=None, remote_timestamp=None, slot_acquired=False):
+    """Download and upload one file, handing it back for a retry if either fails."""
+    try:
+        fetched = fetch_file(server, remote_path, expected_size, remote_timestamp, slot_acquired)
     except Exception as e:
         cl.error_logger.error(f"Error downloading {remote_path} from {server}: {e}")
+        file_failed((server, remote_path, expected_size, remote_timestamp), transfer_failed=True)
+        return
+    transfer_succeeded(server)
+    if fetched is None:
+        return
+    server_folder, file_name, file_type, local_dir, local_path, expected_size, remote_timestamp = fetched
+
+    try:
+        blob_paths = handle_downloaded_file(local_path, local_dir, server_folder, file_name, file_type)
+        record_ingested(server, remote_path, expected_size, remote_timestamp, blob_paths)
+    except Exception as e:
+        cl.error_logger.error(f"Error handling {remote_path} from {server}: {e}")
+        blob_paths = None
+    if blob_paths is None:
+        file_failed((server, remote_path, expected_size, remote_timestamp))
 
 def handle_file(local_path, server_folder, file_name, file_type):
-    """Handle a file after download by uploading and cleaning up."""
+    """Handle a file after download by uploading and cleaning up, returning the blob path or None on failure."""
     try:
-        upload_file(local_path, server_folder, file_name, file_type)
+        with metrics.collector.timed("upload", server_folder, os.path.getsize(local_path)):
+            return upload_file(local_path, server_folder, file_name, file_type)
     except Exception as e:
         cl.error_logger.error(f"Error while handling file {local_path}: {e}")
+        return None
     finally:
         cleanup_file(local_path)
 
+def build_blob_path(server_folder, file_name, file_type, suffix=""):
+    """Build the sanitized blob path for a file, with an optional suffix before the extension."""
+    server_folder_sanitized = sanitize_filename(server_folder)
+    # Archive members keep their directories, each component is sanitized on its own
+    file_name_sanitized = '/'.join(sanitize_filename(part) for part in file_name.split('/'))
+    base_name, ext = os.path.splitext(file_name_sanitized)
+    return f"{server_folder_sanitized}/{file_type}/{base_name}{suffix}{ext}"
+
+def is_duplicate(existing_metadata, file_size, modified_time):
+    """Whether an existing blob's metadata has the same file size and modified time.
+
+    A size of None, for a decompressed stream whose size is only known at the
+    end, matches on the modified time alone.
+    """
+    return (existing_metadata is not None and
+            (file_size is None or str(file_size) == existing_metadata.get("file_size")) and
+            str(int(modified_time)) == existing_metadata.get("modified_time"))
+
+def resolve_blob_path(server_folder, file_name, file_type, file_size, modified_time):
+    """Determine the blob path for a file, adding a timestamp suffix if an identical blob already exists."""
+    # Determine blob path and check for duplicates
+    blob_path = build_blob_path(server_folder, file_name, file_type)
+
+    # Compare file size and modified time with a blob already stored at that path
+    if is_duplicate(get_existing_metadata(blob_path), file_size, modified_time):
+        # If a duplicate, append Unix timestamp to file name
+        blob_path = build_blob_path(server_folder, file_name, file_type, suffix=f"_{int(time.time())}")
+
+    return blob_path
+
+def get_existing_metadata(blob_path):
+    """Return the metadata of an existing blob, or None if it doesn't exist."""
+    try:
+        if blob_index is not None:
+            return blob_index.get(blob_path)
+
+        # Fetch the blob's metadata to check for duplicates
+        return sink.get_metadata(blob_path)
+    except Exception:
+        # Blob does not exist, continue with original blob_path
+        return None
+
+def build_blob_metadata(creation_time, modified_time, file_size, hasher=None):
+    """Build the metadata stored with every uploaded blob, including the content hashes when known."""
+    metadata = {
+        "creation_time": str(int(creation_time)),
+        "modified_time": str(int(modified_time)),
+        "file_size": str(file_size)
+    }
+    if hasher is not None:
+        metadata.update(hasher.metadata())
+    return metadata
+
+def verify_upload(source, hasher, response=None):
+    """Integrity check from the upload response, without requesting the blob's properties again.
+
+    A single put sends the MD5 as its Content-MD5 header, so Azure rejects it
+    if the bytes it received differ, and the MD5 it returns must match ours.
+    Block uploads are checked against the expected size as they are staged.
+    """
+    uploaded_md5 = (response or {}).get("content_md5")
+    if uploaded_md5 is not None and bytes(uploaded_md5) != hasher.md5_digest():
+        cl.error_logger.error(f"Upload failed for {source}: MD5 mismatch (local: {hasher.md5_base64()})")
+        raise Exception(f"Upload failed for {source}: MD5 mismatch")
+
+    cl.monitor_logger.info(f"Upload verified for {source}: MD5 {hasher.md5_base64()}")
+
+def compression_policy(file_type):
+    """The {"codec", "level"} to compress a file type with on upload, or None to upload it as it is."""
+    settings = config.COMPRESSION
+    if (not settings["enabled"] or not sink.supports_content_encoding or
+            file_type.lower() in settings["skip_file_types"]):
+        return None
+    return settings["file_types"].get(file_type.lower(), settings["default"])
+
+def open_stager(blob_path, file_type):
+    """The sink's stager for a blob, wrapped to compress the data on the way if the file type has a policy."""
+    policy = compression_policy(file_type)
+    if policy is None:
+        return sink.stager(blob_path, config.STREAMING_UPLOAD["block_size"])
+
+    # Create the compressor first, so a missing codec fails before anything is staged
+    compressor = compression.new_compressor(policy["codec"], policy["level"])
+    return compression.CompressingWriter(sink.stager(blob_path, config.STREAMING_UPLOAD["block_size"]),
+                                         policy["codec"], compressor)
+
+def commit_stream(stager, hasher, metadata):
+    """Commit a stager's data as its blob, ending the compression first if it compresses.
+
+    A compressed blob's Content-MD5 is that of the stored bytes, while its
+    content_md5 metadata and file_size stay those of the original data.
+    """
+    if not isinstance(stager, compression.CompressingWriter):
+        sink.commit(stager, hasher, metadata)
+        return
+
+    stager.finish()
+    if stager.error is not None:
+        raise stager.error
+    metadata.update(stager.metadata())
+    sink.commit(stager.stager, stager.hasher, metadata, content_encoding=stager.content_encoding)
+    cl.monitor_logger.info(f"Compressed {stager.name} with {stager.content_encoding}: "
+                           f"{stager.bytes_received} bytes stored as {stager.compressed_size}")
+
+def put_local_file(blob_path, local_path, file_type, file_size, modified_time, hasher, metadata):
+    """Send a local file to the sink, compressing it as a stream when its file type has a policy.
+
+    Returns the response of a single put, which is None for staged data.
+    """
+    if compression_policy(file_type) is None:
+        return sink.put_file(blob_path, local_path, file_size, modified_time, hasher, metadata)
+
+    stager = open_stager(blob_path, file_type)
+    try:
+        with open(local_path, 'rb') as f:
+            feed_stager(stager, f, local_path, file_size)
+        commit_stream(stager, hasher, metadata)
+    except Exception:
+        stager.abort()
+        raise
+    return None
+
 def upload_file(local_path, server_folder, file_name, file_type):
-    """Upload a file to Azure Blob Storage while preserving metadata and verifying upload integrity."""
+    """Upload a file to the storage sink while preserving metadata and verifying upload integrity."""
     try:
         modified_time = os.path.getmtime(local_path)
         creation_time = os.path.getctime(local_path)
         file_size = os.path.getsize(local_path)
-        container_name = config.AZURE_CONTAINER_NAME
-        server_folder_sanitized = sanitize_filename(server_folder)
-        file_name_sanitized = sanitize_filename(file_name)
 
-        # Determine blob path and check for duplicates
-        base_name, ext = os.path.splitext(file_name_sanitized)
-        blob_path = f"{server_folder_sanitized}/{file_type}/{base_name}{ext}"
+        # Use the hash computed while the file was downloaded, only files that weren't hashed in transit are read for it
+        hasher = content_hashes.pop(local_path, None)
+        if hasher is None or hasher.bytes_hashed != file_size:
+            hasher = hash_file(local_path, sha256=config.INTEGRITY["sha256"])
 
-        # Check for potential duplicates in Azure storage
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_path)
-        
-        try:
-            # Fetch blob properties to check for duplicates
-            existing_blob_properties = blob_client.get_blob_properties()
-            existing_metadata = existing_blob_properties.metadata
-            
-            # Compare file size and modified time
-            if (str(file_size) == existing_metadata.get("file_size") and
-                str(int(modified_time)) == existing_metadata.get("modified_time")):
-                # If a duplicate, append Unix timestamp to file name
-                timestamp = int(time.time())
-                blob_path = f"{server_folder_sanitized}/{file_type}/{base_name}_{timestamp}{ext}"
-                blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_path)
-        except Exception:
-            # Blob does not exist, continue with original blob_path
-            pass
-        
-        cl.monitor_logger.info(f"Uploading {local_path} to Azure as {blob_path}")
-
-        # Upload the blob with metadata
-        with open(local_path, "rb") as data:
-            blob_client.upload_blob(
-                data,
-                content_settings=ContentSettings(content_type="application/octet-stream"),
-                metadata={
-                    "creation_time": str(int(creation_time)),
-                    "modified_time": str(int(modified_time)),
-                    "file_size": str(file_size)
-                },
-                overwrite=True
-            )
-        
-        cl.monitor_logger.info(f"Successfully uploaded {local_path} to Azure as {blob_path}")
-
-        # Integrity check: Verify upload
-        uploaded_blob_properties = blob_client.get_blob_properties()
-        uploaded_size = uploaded_blob_properties.size
-        
-        if uploaded_size != file_size:
-            cl.error_logger.error(f"Upload failed for {local_path}: size mismatch (local: {file_size}, uploaded: {uploaded_size})")
-            raise Exception(f"Upload failed for {local_path}: size mismatch")
-
-        cl.monitor_logger.info(f"Upload verified for {local_path}: size matches")
+        metadata = build_blob_metadata(creation_time, modified_time, file_size, hasher)
+
+        if config.CONTENT_ADDRESSING["enabled"]:
+            def put_content(content_path, content_metadata):
+                response = put_local_file(content_path, local_path, file_type, file_size, modified_time, hasher, content_metadata)
+                verify_upload(local_path, hasher, response)
+            return upload_content_addressed(local_path, server_folder, file_name, file_type, file_size,
+                                            modified_time, hasher, metadata, put_content)
+
+        blob_path = resolve_blob_path(server_folder, file_name, file_type, file_size, modified_time)
+        cl.monitor_logger.info(f"Uploading {local_path} to {sink.name} as {blob_path}")
+
+        response = put_local_file(blob_path, local_path, file_type, file_size, modified_time, hasher, metadata)
+
+        cl.monitor_logger.info(f"Successfully uploaded {local_path} to {sink.name} as {blob_path}")
+        if blob_index is not None:
+            blob_index.add(blob_path, metadata)
+
+        verify_upload(local_path, hasher, response)
+        return blob_path
 
     except Exception as e:
-        cl.error_logger.error(f"Error uploading {local_path} to Azure: {e}")
+        cl.error_logger.error(f"Error uploading {local_path} to {sink.name}: {e}")
+        return None
+
+def content_blob_path(hasher):
+    """Path of the blob holding some content under the content-addressed prefix, e.g. content/md5/<hex>."""
+    return f"{config.CONTENT_ADDRESSING['prefix']}{hasher.content_key()}"
+
+def upload_content_addressed(source, server_folder, file_name, file_type, file_size, modified_time,
+                             hasher, metadata, put_content):
+    """Store content once under its hash and link the file's usual blob path to it.
+
+    put_content(content_path, content_metadata) sends the bytes and is only
+    called when no blob with the same hash exists yet, so identical files
+    from other servers or zips are never uploaded twice. The logical path is
+    then created as a server-side copy of the content blob, or as an empty
+    reference blob naming it, with the file's own metadata either way.
+    Returns the logical blob path.
+    """
+    content_path = content_blob_path(hasher)
+
+    # The content prefix is listed once into the blob index, so each lookup is a dict hit
+    if get_existing_metadata(content_path) is not None:
+        cl.monitor_logger.info(f"Content of {source} is already stored as {content_path}, skipping the upload")
+    else:
+        content_metadata = {"file_size": str(file_size), **hasher.metadata()}
+        cl.monitor_logger.info(f"Uploading {source} to {sink.name} as {content_path}")
+        put_content(content_path, content_metadata)
+        if blob_index is not None:
+            blob_index.add(content_path, content_metadata)
+
+    blob_path = resolve_blob_path(server_folder, file_name, file_type, file_size, modified_time)
+    link_metadata = {**metadata, "content_path": content_path}
+    if config.CONTENT_ADDRESSING["link"] == "copy":
+        sink.copy(content_path, blob_path, link_metadata)
+    else:
+        sink.put_bytes(blob_path, b"", link_metadata)
+
+    cl.monitor_logger.info(f"Linked {source} at {blob_path} to {content_path}")
+    if blob_index is not None:
+        blob_index.add(blob_path, link_metadata)
+    return blob_path
+
+def streams_to_blob(file_type):
+    """Whether a file type is streamed straight into the sink instead of staged on local disk.
+
+    Content-addressed uploads need the hash before any bytes are sent, so they are always staged on disk.
+    """
+    return (config.STREAMING_UPLOAD["enabled"] and not config.CONTENT_ADDRESSING["enabled"] and
+            file_type.lower() not in config.STREAMING_UPLOAD["disk_file_types"])
+
+def start_blob_stream(source, server_folder, file_name, file_type, expected_size, modified_time):
+    """Resolve the blob for streamed data and return the stager to feed it."""
+    blob_path = resolve_blob_path(server_folder, file_name, file_type, expected_size, modified_time)
+    cl.monitor_logger.info(f"Streaming {source} to {sink.name} as {blob_path}")
+    return open_stager(blob_path, file_type)
+
+def finish_blob_stream(source, stager, expected_size, modified_time, hasher):
+    """Check streamed data is complete and commit it with the usual metadata.
+
+    An expected_size of None takes the size from the data received, for
+    decompressed streams that the decompressor has already checked.
+    """
+    if expected_size is None:
+        expected_size = stager.bytes_received
+
+    try:
+        # Check if the streamed size matches the expected size before anything becomes visible
+        if stager.bytes_received != expected_size:
+            cl.error_logger.error(f"Incomplete data for {source}: expected size {expected_size} bytes, got {stager.bytes_received} bytes")
+            raise Exception(f"Incomplete data for {source}: expected size {expected_size} bytes, got {stager.bytes_received} bytes")
+
+        metadata = build_blob_metadata(time.time(), modified_time, expected_size, hasher)
+        commit_stream(stager, hasher, metadata)
+    except Exception:
+        stager.abort()
+        raise
+    cl.monitor_logger.info(f"Successfully streamed {source} to {sink.name} as {stager.name}")
+    if blob_index is not None:
+        blob_index.add(stager.name, metadata)
+
+    verify_upload(source, hasher)
+    return stager.name
+
+def upload_stream(stream, source, server_folder, file_name, file_type, file_size, modified_time):
+    """Upload a readable stream through the sink's stager, file_size is None when it is only known at the end."""
+    stager = start_blob_stream(source, server_folder, file_name, file_type, file_size, modified_time)
+    hasher = new_hasher()
+    try:
+        while True:
+            chunk = stream.read(STREAM_READ_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            stager.write(chunk)
+            if stager.error is not None:
+                raise stager.error
+    except Exception:
+        stager.abort()
+        raise
+
+    return finish_blob_stream(source, stager, file_size, modified_time, hasher)
+
+def put_stream(blob_path, stream, source, file_type, file_size, hasher, metadata):
+    """Stage a readable stream of known size as a given blob and commit it."""
+    stager = open_stager(blob_path, file_type)
+    try:
+        feed_stager(stager, stream, source, file_size)
+        commit_stream(stager, hasher, metadata)
+    except Exception:
+        stager.abort()
+        raise
+    verify_upload(source, hasher)
+
+def feed_stager(stager, stream, source, file_size):
+    """Write a readable stream of known size into a stager, checking all of it arrived."""
+    while True:
+        chunk = stream.read(STREAM_READ_SIZE)
+        if not chunk:
+            break
+        stager.write(chunk)
+        if stager.error is not None:
+            raise stager.error
+
+    if stager.bytes_received != file_size:
+        cl.error_logger.error(f"Incomplete data for {source}: expected size {file_size} bytes, got {stager.bytes_received} bytes")
+        raise Exception(f"Incomplete data for {source}: expected size {file_size} bytes, got {stager.bytes_received} bytes")
+
+def stream_file_to_blob(url, server_folder, file_name, file_type, expected_size=None, remote_timestamp=None):
+    """Download a file straight into the sink's stager without writing it to local disk."""
+    if expected_size is None or remote_timestamp is None:
+        expected_size, remote_timestamp = get_remote_file_metadata(url)
+    stager = start_blob_stream(url, server_folder, file_name, file_type, expected_size, remote_timestamp)
+    hasher = new_hasher()
+
+    try:
+        with curl_pool.handle(url) as c:
+            c.setopt(pycurl.WRITEFUNCTION, hasher.wrap(stager.write))
+            try:
+                curl_pool.perform(c)
+            except pycurl.error:
+                # Surface the staging error rather than curl's generic write error
+                if stager.error is not None:
+                    raise stager.error
+                raise
+            # Downloading and staging the blocks overlap, so this is one stage
+            record_curl_timings("stream", url, c)
+    except Exception:
+        stager.abort()
+        raise
+
+    return finish_blob_stream(url, stager, expected_size, remote_timestamp, hasher)
 
 def cleanup_file(local_path):
     try:
@@ -231,7 +1066,314 @@ def cleanup_file(local_path):
     except Exception as e:
         cl.error_logger.error(f"Error cleaning up {local_path}: {e}")
 
+def process_batch_concurrently(batch):
+    """Download a batch with up to max_concurrent_tasks transfers in flight using pycurl's multi interface."""
+    def job_entry(job):
+        server, remote_path = job.context[:2]
+        return server, remote_path, job.expected_size, job.remote_timestamp
+
+    def on_metadata(job):
+        server, remote_path, local_dir, server_folder, file_name, file_type = job.context
+        if is_already_ingested(server, remote_path, job.expected_size, job.remote_timestamp):
+            return False
+        if not may_start(job_entry(job)):
+            return False
+
+        # Archives are downloaded to disk here and expanded by the archive threads, off the transfer loop
+        if streams_to_blob(file_type) and expansion_kind(file_name, file_type) is None:
+            job.target = start_blob_stream(job.url, server_folder, file_name, file_type,
+                                           job.expected_size, job.remote_timestamp)
+            job.hasher = new_hasher()
+            job.writer = job.hasher.wrap(job.target.write)
+        elif segment_count_for(job.expected_size) > 1:
+            # Segments arrive out of order, so these files are hashed from disk when uploaded and never resumed
+            job.segment_count = segment_count_for(job.expected_size)
+            remove_checkpoint(job.local_path)
+        else:
+            job.file, job.resume_from = open_download_file(job.local_path, job.url,
+                                                           job.expected_size, job.remote_timestamp)
+            job.hasher = resume_hasher(job.local_path, job.resume_from)
+
+    uploads = []
+
+    def on_done(job):
+        server, remote_path, local_dir, server_folder, file_name, file_type = job.context
+        record_transfer(server, job.expected_size - job.resume_from, job.started_at)
+        transfer_succeeded(server)
+        # Uploads run in their own threads so the transfer loop keeps serving the other downloads,
+        # archives in the archive threads since decompression is CPU bound
+        if job.writer is None and expansion_kind(file_name, file_type) is not None:
+            executor = get_archive_executor()
+        else:
+            executor = get_upload_executor()
+        uploads.append(executor.submit(upload_and_record, job))
+
+    def upload_and_record(job):
+        server, remote_path, local_dir, server_folder, file_name, file_type = job.context
+        try:
+            if job.writer is not None:
+                blob_paths = [finish_blob_stream(job.url, job.target, job.expected_size, job.remote_timestamp, job.hasher)]
+            else:
+                verify_download(job.local_path, job.expected_size, job.remote_timestamp)
+                # Only files uploaded whole reach upload_file, which picks up the hash
+                if job.hasher is not None and expansion_kind(file_name, file_type) is None:
+                    content_hashes[job.local_path] = job.hasher
+                blob_paths = handle_downloaded_file(job.local_path, local_dir, server_folder, file_name, file_type)
+            record_ingested(server, remote_path, job.expected_size, job.remote_timestamp, blob_paths)
+        except Exception as e:
+            on_upload_error(job, e)
+            return
+        if blob_paths is None:
+            file_failed(job_entry(job))
+
+    def on_upload_error(job, error):
+        if job.target is not None and job.target.error is not None:
+            error = job.target.error
+        cl.error_logger.error(f"Error uploading {job.url}: {error}")
+        file_failed(job_entry(job))
+
+    def on_error(job, error):
+        # Surface a staging error rather than curl's generic write error, it isn't the server's fault
+        staging_failed = job.target is not None and job.target.error is not None
+        if staging_failed:
+            error = job.target.error
+        if job.target is not None:
+            job.target.abort()
+        cl.error_logger.error(f"Error downloading {job.url}: {error}")
+        file_failed(job_entry(job), transfer_failed=not staging_failed)
+
+    jobs = []
+    for server, remote_path, *metadata in batch:
+        try:
+            server_folder, file_name, file_type, local_dir, local_path = prepare_download(server, remote_path)
+        except Exception as e:
+            cl.error_logger.error(f"Error downloading {remote_path} from {server}: {e}")
+            file_failed((server, remote_path, *metadata))
+            continue
+
+        download_url = remote_url(server, remote_path)
+        cl.monitor_logger.info(f"Queued download of {download_url} to {local_path}")
+        job = DownloadJob(download_url, local_path, on_done, on_error, on_metadata=on_metadata,
+                          context=(server, remote_path, local_dir, server_folder, file_name, file_type))
+        job.host = get_server_folder_name(server)
+        if metadata and None not in metadata:
+            # Size and timestamp already probed, so the job skips its metadata request
+            job.expected_size, job.remote_timestamp = metadata
+        jobs.append(job)
+
+    get_multi_downloader().run(jobs)
+
+    # Wait for the uploads and archives still in progress, each one records its own failure
+    for upload in uploads:
+        upload.result()
+
+class PipelineFile:
+    """A downloaded file moving through the pipeline, recorded as ingested once all its uploads finish.
+
+    An archive extracted to disk turns into one upload per member, so the file
+    keeps a count of the uploads still pending and collects their blob paths.
+    """
+
+    def __init__(self, server, remote_path, fetched):
+        self.server = server
+        self.remote_path = remote_path
+        (self.server_folder, self.file_name, self.file_type, self.local_dir,
+         self.local_path, self.size, self.modified_time) = fetched
+        self.blob_paths = []
+        self.failed = False
+        # The stage currently handling the file counts as one pending part
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    def add_part(self):
+        """Count an upload split off from this file, e.g. one extracted archive member."""
+        with self._lock:
+            self._pending += 1
+
+    def finish_part(self, blob_paths):
+        """Record the blob paths of a finished part, None if it failed, and record the file once none are pending."""
+        with self._lock:
+            if blob_paths is None:
+                self.failed = True
+            else:
+                self.blob_paths.extend(blob_paths)
+            self._pending -= 1
+            done = self._pending == 0
+
+        if not done:
+            return
+        if self.failed:
+            file_failed((self.server, self.remote_path, self.size, self.modified_time))
+        else:
+            record_ingested(self.server, self.remote_path, self.size, self.modified_time, self.blob_paths)
+
+def pipeline_download(entry, emit):
+    """Download stage: fetch one entry to local disk and queue it for extraction."""
+    server, remote_path, *metadata = entry
+    if not may_start(entry):
+        return
+    fetched = fetch_file(server, remote_path, *metadata)
+    transfer_succeeded(server)
+    if fetched is not None:
+        file = PipelineFile(server, remote_path, fetched)
+        emit(file, file.size)
+
+def extracted_members(file):
+    """Members of a pipeline file that are extracted to disk, or None if the file goes to upload whole."""
+    kind = expansion_kind(file.file_name, file.file_type)
+    if kind == "zip" and not config.ZIP["stream_members"]:
+        return extract_zip_members(file.local_path, file.local_dir, file.server_folder)
+    if kind not in (None, "zip") and archive_members_to_disk():
+        return extract_archive_members(file.local_path, file.local_dir, file.server_folder, file.file_name, kind)
+    return None
+
+def pipeline_extract(file, emit):
+    """Extraction stage: extract archives to disk member by member, passing everything else straight on.
+
+    Archives whose members are streamed out of them go to the upload stage whole.
+    """
+    members = extracted_members(file)
+    if members is None:
+        emit((file, None), file.size)
+        return
+
+    try:
+        for extracted_path, extracted_file_name, extracted_file_type in members:
+            file.add_part()
+            emit((file, (extracted_path, extracted_file_name, extracted_file_type)), os.path.getsize(extracted_path))
+        cleanup_file(file.local_path)
+        file.finish_part([])
+    except Exception:
+        file.finish_part(None)
+        raise
+
+def pipeline_upload(item, emit):
+    """Upload stage: upload a downloaded file or an extracted archive member."""
+    file, member = item
+    if member is None:
+        file.finish_part(handle_downloaded_file(file.local_path, file.local_dir, file.server_folder,
+                                                file.file_name, file.file_type))
+        return
+
+    extracted_path, extracted_file_name, extracted_file_type = member
+    blob_path = handle_file(extracted_path, file.server_folder, extracted_file_name, extracted_file_type)
+    file.finish_part(None if blob_path is None else [blob_path])
+
+def process_batch_pipelined(batch):
+    """Download, extract and upload a batch as separate stages so transfers overlap.
+
+    Each stage has its own worker threads and the queues between them are
+    bounded in bytes, so downloads pause when extraction or upload falls
+    behind instead of filling the disk.
+    """
+    settings = config.PIPELINE
+
+    def on_download_error(entry, error):
+        cl.error_logger.error(f"Error downloading {entry[1]} from {entry[0]}: {error}")
+        file_failed(entry, transfer_failed=True)
+
+    def on_extract_error(file, error):
+        cl.error_logger.error(f"Error extracting {file.local_path}: {error}")
+
+    def on_upload_error(item, error):
+        item[0].finish_part(None)
+        cl.error_logger.error(f"Error uploading {item[0].local_path}: {error}")
+
+    # The batch is already in memory, so the download stage's own queue is not bounded
+    pipeline = Pipeline()
+    pipeline.add_stage("download", pipeline_download, settings["download_workers"], float("inf"), on_download_error)
+    pipeline.add_stage("extract", pipeline_extract, settings["extract_workers"],
+                       settings["max_extract_queue_bytes"], on_extract_error)
+    pipeline.add_stage("upload", pipeline_upload, settings["upload_workers"],
+                       settings["max_upload_queue_bytes"], on_upload_error)
+    pipeline.run((entry, 0) for entry in batch)
+
+    # Report how busy each stage was so the slowest one can be given more workers
+    for stage in pipeline.occupancy():
+        cl.monitor_logger.info(
+            f"Pipeline stage {stage['stage']}: {stage['items']} items, {stage['workers']} workers, "
+            f"{stage['utilization']:.0%} busy, {stage['blocked']:.0%} blocked on the next stage, "
+            f"peak queue {stage['peak_queued_bytes']} bytes"
+        )
+
+def get_multi_downloader():
+    """Create the per-process multi downloader on first use."""
+    global multi_downloader
+    if multi_downloader is None:
+        multi_downloader = MultiDownloader(curl_pool, config.CHILD_PROCESS["max_concurrent_tasks"],
+                                           max_segments_per_host=config.SEGMENTED_DOWNLOAD["max_segments_per_host"],
+                                           acquire_slot=host_limits.try_acquire,
+                                           release_slot=host_limits.release,
+                                           on_transfer=record_multi_timings)
+    return multi_downloader
+
+def get_archive_executor():
+    """Create the per-process archive expansion threads on first use.
+
+    zlib, bz2 and lzma release the GIL while decompressing, as hashlib does
+    while hashing, so archives expanding in these threads use several cores
+    of the worker process. A process pool isn't an option, Pool workers are
+    daemonic and can't start processes of their own, and the members are
+    uploaded through this worker's sink, blob index and state store.
+    """
+    global archive_executor
+    if archive_executor is None:
+        archive_executor = ThreadPoolExecutor(max_workers=config.ARCHIVES["max_concurrent_archives"],
+                                              thread_name_prefix="archive")
+    return archive_executor
+
+def get_upload_executor():
+    """Create the per-process upload threads used by the multi downloader on first use."""
+    global upload_executor
+    if upload_executor is None:
+        upload_executor = ThreadPoolExecutor(max_workers=config.UPLOAD["max_concurrent_uploads"],
+                                             thread_name_prefix="upload")
+    return upload_executor
+
+def take_next_entry(pending):
+    """Pop the first entry whose server has a free connection slot, returning it and whether the slot was taken.
+
+    If every server in the batch is at its limit, the first entry is returned
+    without a slot and download_and_handle_file waits for one.
+    """
+    for _ in range(len(pending)):
+        entry = pending.popleft()
+        if host_limits.try_acquire(get_server_folder_name(entry[0])):
+            return entry, True
+        pending.append(entry)
+    return pending.popleft(), False
+
 def process_batch(batch):
-    """Process a batch of files using pycurl for downloads."""
-    for server, remote_path in batch:
-        download_and_handle_file(server, remote_path)
\ No newline at end of file
+    """Process a batch of files using pycurl for downloads.
+
+    Each entry is (server, remote_path) or (server, remote_path, size, modified_time)
+    when the remote metadata was already probed. Returns the (failed, deferred)
+    entries for the parent to retry, deferred ones were never tried because the
+    batch ran out of time or their server kept failing.
+    """
+    stats_before = curl_pool.stats()
+    start_batch()
+
+    try:
+        if config.PIPELINE["enabled"]:
+            process_batch_pipelined(batch)
+        elif config.CHILD_PROCESS["max_concurrent_tasks"] > 1:
+            process_batch_concurrently(batch)
+        else:
+            pending = deque(batch)
+            while pending:
+                entry, slot_acquired = take_next_entry(pending)
+                if not may_start(entry):
+                    if slot_acquired:
+                        host_limits.release(get_server_folder_name(entry[0]))
+                    continue
+                download_and_handle_file(*entry, slot_acquired=slot_acquired)
+    finally:
+        failed, deferred = finish_batch()
+
+    # Report how many connections the batch opened versus reused from the pool
+    stats_after = curl_pool.stats()
+    opened = stats_after["connections_opened"] - stats_before["connections_opened"]
+    reused = stats_after["connections_reused"] - stats_before["connections_reused"]
+    cl.monitor_logger.info(f"Batch connections: {opened} opened, {reused} reused")
+    return failed, deferred
@@ -0,0 +1,78 @@
+import zlib
+
+from content_hash import ContentHasher
+
+# Content-Encoding of each codec's output
+CONTENT_ENCODINGS = {
+    "gzip": "gzip",
+    "zstd": "zstd",
+}
+
+def new_compressor(codec, level):
+    """Streaming compressor with compress(data) and flush() for a codec and level."""
+    if codec == "gzip":
+        # wbits 31 writes the gzip header and trailer, so the output is a complete .gz stream
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if codec == "zstd":
+        # Only needed when a policy selects zstd
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise Exception(f"Unknown compression codec: {codec}")
+
+class CompressingWriter:
+    """Compress data on its way into a sink's stager.
+
+    Has the stager's write(), error and bytes_received, so it can stand in
+    for it anywhere, including as a pycurl WRITEFUNCTION. bytes_received
+    counts the original bytes, so size checks still compare against the
+    source file, while the compressed bytes are hashed for the blob's
+    Content-MD5.
+    """
+
+    def __init__(self, stager, codec, compressor):
+        self.stager = stager
+        self.content_encoding = CONTENT_ENCODINGS[codec]
+        self.hasher = ContentHasher()
+        self.bytes_received = 0
+        self._compressor = compressor
+        self._error = None
+
+    @property
+    def name(self):
+        return self.stager.name
+
+    @property
+    def error(self):
+        return self._error or self.stager.error
+
+    @property
+    def compressed_size(self):
+        return self.hasher.bytes_hashed
+
+    def write(self, data):
+        """Compress and pass on data, returning 0 aborts the pycurl transfer."""
+        try:
+            self.bytes_received += len(data)
+            compressed = self._compressor.compress(data)
+        except Exception as e:
+            self._error = e
+            return 0
+        return self._pass_on(compressed)
+
+    def finish(self):
+        """Write the end of the compressed stream once all the data is in."""
+        self._pass_on(self._compressor.flush())
+
+    def abort(self):
+        """Abort the wrapped stager, for data that won't be committed."""
+        self.stager.abort()
+
+    def _pass_on(self, compressed):
+        if not compressed:
+            return None
+        self.hasher.update(compressed)
+        return self.stager.write(compressed)
+
+    def metadata(self):
+        """Blob metadata entries describing the compression, file_size stays the original size."""
+        return {"content_encoding": self.content_encoding, "compressed_size": str(self.compressed_size)}
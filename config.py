@@ -1,22 +1,133 @@
 # Batch settings
 BATCH_SIZE = 10  # Number of sources to process in each batch
 
+# Batch scheduling settings
+SCHEDULER = {
+    "strategy": "lpt",  # "lpt" balances batches by estimated transfer time, "round_robin" deals files out ignoring size
+    "default_rate": 10 * 1024 * 1024,  # Bytes per second assumed for a server with no recorded downloads
+    "per_file_overhead": 0.5,  # Seconds added to every file's estimate for connecting and metadata requests
+}
+
 # Parallel processing settings
 MAX_PARALLEL_PROCESSES = 4  # Number of child processes to run in parallel
 
+# Connection limits per server across all child processes, keyed like the server folders (host_port)
+HOST_LIMITS = {
+    "max_connections_per_host": 4,  # Connections open to one server at once across every process, idle ones kept for reuse included, 0 for no limit
+    "per_host": {},  # Overrides for individual servers, e.g. {"ftp.gnu.org_21": 2}
+}
+
+# Bandwidth limits in bytes per second, token buckets shared by every process so the limits hold across the Pool
+BANDWIDTH = {
+    "enabled": False,  # Pace downloads and uploads to the rates below
+    "global_rate": 0,  # Downloads and uploads together, 0 for no limit
+    "download_rate": 0,  # All downloads from the sources, 0 for no limit
+    "upload_rate": 0,  # All uploads to Azure, 0 for no limit
+    "per_host_rate": 0,  # Transfers with each server, 0 for no limit
+    "per_host": {},  # Overrides for individual servers keyed like HOST_LIMITS, e.g. {"ftp.gnu.org_21": 5 * 1024 * 1024}
+    "burst_seconds": 1.0,  # Seconds of its rate a bucket saves up while idle, sent at full speed when transfers start
+    "schedule": [  # Local time windows that scale every rate, the first match applies, e.g. throttling business hours
+        # {"start": "08:00", "end": "18:00", "weekdays": [0, 1, 2, 3, 4], "scale": 0.25},
+    ],
+}
+
 # Child process settings
 CHILD_PROCESS = {
-    "timeout": 300,  # Timeout for each child process in seconds
-    "max_concurrent_tasks": 3,  # Max concurrent downloads within a single child process, placeholder for future functionality
-    # Optional ToDo settings
-    # "retries": 3,    # Number of retries for a failed child process
-    # "retry_delay": 5,  # Delay between retries in seconds
+    "timeout": 300,  # Seconds a batch may run, transfers still going are then aborted and their files retried
+    "max_concurrent_tasks": 3,  # Max concurrent downloads within a single child process, 1 downloads files one at a time
+    "max_idle_connections_per_host": 2,  # Logged-in curl handles each child process keeps open per server for reuse
+    "resume_downloads": True,  # Resume a partial download from its checkpoint if the remote file is unchanged
+    "engine": "pycurl",  # "pycurl" runs child.py, "asyncio" runs async_child.py with every file of a batch on one event loop
+    "watchdog_grace": 60,  # Seconds past the timeout before a batch still running is given up on and its files retried
+}
+
+# Transfer timeouts, applied to every curl request so a stalled server can't hold a worker
+TRANSFER_TIMEOUTS = {
+    "connect_timeout": 30,  # Seconds to connect and log in to a server, 0 for curl's default
+    "low_speed_limit": 1024,  # Bytes per second below which a transfer counts as stalled, 0 to never abort stalled transfers
+    "low_speed_time": 60,  # Seconds a transfer may stay below low_speed_limit before it is aborted
+    "total_timeout": 0,  # Seconds any single request may take in total, 0 for no limit beyond the batch timeout
+}
+
+# Retry settings, files that fail are queued again in a later batch instead of retried in place
+RETRY = {
+    "enabled": True,  # Retry files that failed or weren't reached before their batch timed out
+    "max_attempts": 3,  # Attempts per file, counting the first, before it is given up for this run
+    "initial_delay": 5,  # Seconds before the first retry, doubled after each further failure
+    "max_delay": 300,  # Longest delay in seconds between two attempts
+    "breaker_failures": 5,  # Failures in a row after which a server's files are held back, 0 to never hold them
+    "breaker_cooldown": 300,  # Seconds a server's files are held back before it is tried again
+}
+
+# Staged pipeline settings, the next file downloads while earlier ones are extracted and uploaded
+PIPELINE = {
+    "enabled": False,  # Run download, extraction and upload as separate stages joined by bounded queues
+    "download_workers": 2,  # Files downloaded at the same time in each child process
+    "extract_workers": 1,  # Zip archives extracted at the same time in each child process
+    "upload_workers": 2,  # Files uploaded at the same time in each child process
+    "max_extract_queue_bytes": 1024 * 1024 * 1024,  # Downloaded bytes waiting on disk for extraction before downloads pause
+    "max_upload_queue_bytes": 1024 * 1024 * 1024,  # Downloaded or extracted bytes waiting on disk for upload before extraction pauses
+}
+
+# Asyncio engine settings, used when CHILD_PROCESS engine is "asyncio"
+ASYNC_ENGINE = {
+    "max_concurrent_tasks": 100,  # Files in flight at once in each child process, batches need at least this many files to fill it
+}
+
+# Segmented download settings
+SEGMENTED_DOWNLOAD = {
+    "enabled": False,  # Fetch large files as byte ranges over several connections at once
+    "threshold": 256 * 1024 * 1024,  # Files at least this size in bytes are segmented
+    "segments": 4,  # Byte ranges each large file is split into
+    "max_segments_per_host": 4,  # Segment connections a child process opens to one server at a time
+}
+
+# Streaming upload settings
+STREAMING_UPLOAD = {
+    "enabled": False,  # Stage downloads straight into Azure blocks instead of writing them to LOCAL_DOWNLOAD_DIR first
+    "block_size": 8 * 1024 * 1024,  # Size in bytes of each block staged while the download is running
+    "disk_file_types": ["zip"],  # File types that are always staged on disk, zip extraction needs the whole file
+}
+
+# Zip handling settings
+ZIP = {
+    "stream_members": True,  # Upload members straight out of the archive, False extracts them to disk first
+    "max_concurrent_members": 4,  # Members of one zip uploaded at the same time
+}
+
+# Upload compression settings, files are compressed as they are uploaded and stored with Content-Encoding set
+COMPRESSION = {
+    "enabled": False,  # Compress files whose type has a policy below
+    "file_types": {  # Policy per file type, codec "gzip" or "zstd" (needs the zstandard package) and its level
+        "txt": {"codec": "gzip", "level": 6},
+        "csv": {"codec": "gzip", "level": 6},
+        "log": {"codec": "gzip", "level": 6},
+        "json": {"codec": "gzip", "level": 6},
+        "xml": {"codec": "gzip", "level": 6},
+    },
+    "default": None,  # Policy for file types not listed above, e.g. {"codec": "zstd", "level": 3}, None uploads them as they are
+    "skip_file_types": ["zip", "gz", "tgz", "bz2", "xz", "zst", "7z", "rar", "pdf", "jpg", "jpeg", "png", "gif",
+                        "mp3", "mp4", "docx", "xlsx", "pptx"],  # Already compressed, never compressed again
+}
+
+# Tar and compressed file handling settings
+ARCHIVES = {
+    "enabled": True,  # Expand .tar, .tgz and .tar.gz/.bz2/.xz archives into their members and decompress .gz, .bz2 and .xz files before upload
+    "stream_members": True,  # Upload members as they are decompressed, False writes each to disk first (always the case with CONTENT_ADDRESSING)
+    "max_concurrent_archives": 2,  # Downloaded archives a child process expands at the same time in threads, with max_concurrent_tasks above 1
+    "max_buffered_chunks": 64,  # Chunks of a streamed archive download held in memory while its expansion catches up
 }
 
 # Directory settings
 LOCAL_DOWNLOAD_DIR = "downloads"  
 LOCAL_LOG_DIR = "log"  
 
+# Incremental ingestion settings
+INGESTION_STATE = {
+    "enabled": True,  # Skip files whose remote size and modified time are unchanged since they were last ingested
+    "path": "log/ingestion_state.db",  # SQLite database shared by all child processes
+}
+
 # Azure Storage settings
 AZURE_STORAGE_CONNECTION_STRING = (
     "DefaultEndpointsProtocol=http;"
@@ -28,17 +139,81 @@ AZURE_STORAGE_CONNECTION_STRING = (
 #must be all lower case and avoid most special characters
 AZURE_CONTAINER_NAME = "your-azure-container-name"
 
+# Where ingested files are stored
+STORAGE = {
+    "backend": "azure",  # "azure" uploads to the container above, "local" writes the same layout and metadata to a directory tree
+    "local_root": "/data/ingest",  # Root of the "local" backend, blobs are stored under <local_root>/<AZURE_CONTAINER_NAME>/
+}
+
+# Azure upload settings
+UPLOAD = {
+    "block_size": 8 * 1024 * 1024,  # Size in bytes of each block when a file is uploaded in blocks
+    "single_put_threshold": 64 * 1024 * 1024,  # Files up to this size are sent in a single request
+    "max_concurrent_uploads": 4,  # Threads uploading finished downloads while the multi downloader keeps transferring
+    "max_concurrency": 4,  # Blocks of one file staged in parallel
+    "block_retries": 3,  # Retries for an individual block before the upload fails
+    "block_retry_delay": 1,  # Initial delay between block retries in seconds, doubled on each retry
+    "connection_timeout": 20,  # Seconds to connect to Azure before a request fails
+    "read_timeout": 60,  # Seconds Azure may take to answer a request before it fails
+    "operation_timeout": 300,  # Seconds Azure gives each upload or commit request on the server side
+}
+
+# Integrity settings, MD5 is always computed during transfer and sent as the blob's Content-MD5
+INTEGRITY = {
+    "sha256": False,  # Also compute a SHA-256 during transfer and store it in the blob metadata as content_sha256
+}
+
+# Content-addressed storage settings, identical bytes from any server or zip are uploaded once
+CONTENT_ADDRESSING = {
+    "enabled": False,  # Store each file's bytes once under its hash and create its usual path as a link to them
+    "prefix": "content/",  # Content blobs are stored as <prefix>md5/<hex>, or <prefix>sha256/<hex> when INTEGRITY sha256 is set
+    "link": "copy",  # "copy" creates the usual path as a server-side copy, "reference" as an empty blob whose content_path metadata names the content
+}
+
+# Duplicate detection settings
+BLOB_INDEX = {
+    "enabled": True,  # Check for duplicates against an in-memory listing of each prefix instead of a request per file
+    "results_per_page": 5000,  # Blobs fetched per list_blobs page when a prefix is indexed
+    "max_age": 900,  # Seconds before a prefix is listed again to pick up other processes' uploads, None lists it once
+}
+
+# Daemon mode settings, used by python main.py --daemon
+DAEMON = {
+    "min_poll_interval": 60,  # Seconds between polls of a source that keeps changing
+    "max_poll_interval": 3600,  # Seconds between polls of a source that hasn't changed in a while
+    "poll_backoff": 1.5,  # Factor a source's poll interval grows by after each poll that finds nothing new
+    "poll_workers": 4,  # Threads in the daemon process listing and probing sources
+    "max_pending_batches": 8,  # Batches queued or running before polling pauses to let the workers catch up
+    "report_interval": 300,  # Seconds between updates of the run report
+    "report_window": 3600,  # Seconds of stage timings the run report covers, older ones are dropped
+}
+
+# Run report settings
+METRICS = {
+    "enabled": True,  # Time every stage of every file and write a report at the end of each run
+    "report_path": "log/run_report.json",  # JSON totals and duration percentiles per stage and per host
+    "prometheus_path": "log/ingestion.prom",  # Same figures for the node_exporter textfile collector, None to skip
+}
+
 # Verbosity and logging - Separate configs for monitor and error logs
 MONITOR_LOG = {
     "level": "INFO",  # Options: DEBUG, INFO, WARNING, ERROR, CRITICAL
     "file_path": "log/monitor.log",  # Path to the monitor log file
     "format": "%(asctime)s - %(levelname)s - %(message)s",  # Log format for monitoring
+    "json": False,  # Write JSON lines with time, level, logger, process and message instead of the format above
+    "max_records_per_second": 0,  # Records below WARNING each process may log per second, 0 for no limit
 }
 
 ERROR_LOG = {
     "level": "ERROR",  # Options: DEBUG, INFO, WARNING, ERROR, CRITICAL
     "file_path": "log/error.log",  # Path to the error log file
     "format": "%(asctime)s - %(levelname)s - %(message)s",  # Log format for errors
+    "json": False,  # Write JSON lines with time, level, logger, process and message instead of the format above
 }
 
-# Optional ToDo: Add settings for retries, backoff, or error thresholds as needed
\ No newline at end of file
+# Log writing settings, workers queue their records and a single writer in the parent writes them
+LOG_QUEUE = {
+    "enabled": True,  # False lets every process write to the log files directly
+    "batch_size": 500,  # Records written before the log files are flushed
+    "flush_interval": 1.0,  # Seconds before queued records are flushed regardless of batch_size
+}
@@ -0,0 +1,70 @@
+import base64
+import hashlib
+
+# Bytes read at a time when a file has to be hashed from disk
+HASH_READ_SIZE = 1024 * 1024
+
+class ContentHasher:
+    """MD5, and optionally SHA-256, of data computed incrementally while it is transferred.
+
+    update() is fed every chunk as it passes through a write callback or an
+    upload loop, so the data is hashed while it is already in memory instead
+    of in a separate pass over the file.
+    """
+
+    def __init__(self, sha256=False):
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256() if sha256 else None
+        self.bytes_hashed = 0
+
+    def update(self, data):
+        self._md5.update(data)
+        if self._sha256 is not None:
+            self._sha256.update(data)
+        self.bytes_hashed += len(data)
+
+    def wrap(self, write):
+        """Wrap a write callback, such as a pycurl WRITEFUNCTION, so every chunk is hashed before it is written."""
+        def hashing_write(data):
+            self.update(data)
+            return write(data)
+        return hashing_write
+
+    def md5_digest(self):
+        """Raw MD5 digest, as Azure expects for ContentSettings.content_md5."""
+        return self._md5.digest()
+
+    def md5_base64(self):
+        """Base64 MD5, the encoding of the Content-MD5 header."""
+        return base64.b64encode(self._md5.digest()).decode()
+
+    def content_key(self):
+        """Name of the content under its strongest hash, e.g. md5/<hex> or sha256/<hex>."""
+        if self._sha256 is not None:
+            return f"sha256/{self._sha256.hexdigest()}"
+        return f"md5/{self._md5.hexdigest()}"
+
+    def metadata(self):
+        """Blob metadata entries for the hashes."""
+        metadata = {"content_md5": self.md5_base64()}
+        if self._sha256 is not None:
+            metadata["content_sha256"] = self._sha256.hexdigest()
+        return metadata
+
+def hash_file(path, sha256=False, length=None, hasher=None):
+    """Hash a file from disk, or only its first length bytes, for data that wasn't hashed in transit.
+
+    Pass hasher to continue an existing one, e.g. to cover the part of a
+    resumed download that was written by an earlier attempt.
+    """
+    hasher = hasher or ContentHasher(sha256=sha256)
+    remaining = length
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(HASH_READ_SIZE if remaining is None else min(HASH_READ_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
@@ -0,0 +1,243 @@
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import pycurl
+
+import bandwidth
+import host_limits
+
+# CURLINFO_CONN_ID is only exposed by newer pycurl releases
+_CONN_ID = getattr(pycurl, "CONN_ID", None)
+
+class CurlPool:
+    """Per-process pool of reusable curl handles, keyed by server.
+
+    A curl handle keeps its connection cache between transfers, so reusing the
+    same handle for the same server keeps the logged-in FTP/SFTP control
+    connection alive instead of reconnecting and logging in for every request.
+    DNS lookups and SSL sessions are shared between all handles in the pool.
+    Idle handles to a server limited by HOST_LIMITS keep the connection slots
+    their transfers held, see host_limits.keep_idle_slots.
+
+    Every handle gets the connect, stall and total timeouts, and aborts its
+    transfer once deadline, a time.monotonic() value, has passed. Transfers
+    are paused and resumed to keep within the shared bandwidth budgets.
+    """
+
+    def __init__(self, max_idle_per_host=4, timeouts=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeouts = timeouts or {}
+        self.deadline = None
+        self._idle = {}
+        self._conn_ids = {}
+        self._kept_slots = {}  # {host: connection slots held by its idle handles}
+        self._lock = threading.Lock()
+        self._share = pycurl.CurlShare()
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    @staticmethod
+    def host_key(url):
+        """Key handles by scheme, credentials, host and port so sessions are only reused for the same login."""
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def acquire(self, url):
+        """Get an idle handle for the server of the given URL, creating one if needed."""
+        key = self.host_key(url)
+        with self._lock:
+            idle = self._idle.get(key)
+            c = idle.pop() if idle else None
+
+        if c is None:
+            c = pycurl.Curl()
+            c.setopt(pycurl.SHARE, self._share)
+        else:
+            # reset() clears the options but keeps the handle's live connections and its share
+            c.reset()
+
+        c.setopt(pycurl.URL, url)
+        self._set_timeouts(c)
+        # curl calls the progress function about once a second even when no data arrives, or the transfer is paused
+        c.setopt(pycurl.NOPROGRESS, False)
+        c.setopt(pycurl.XFERINFOFUNCTION, self._progress_function(c, url))
+        return c
+
+    def _set_timeouts(self, c):
+        timeouts = self.timeouts
+        if timeouts.get("connect_timeout"):
+            c.setopt(pycurl.CONNECTTIMEOUT, timeouts["connect_timeout"])
+        if timeouts.get("low_speed_limit") and timeouts.get("low_speed_time"):
+            # Aborts with E_OPERATION_TIMEDOUT when the transfer stays this slow, e.g. a hung FTP data connection
+            c.setopt(pycurl.LOW_SPEED_LIMIT, timeouts["low_speed_limit"])
+            c.setopt(pycurl.LOW_SPEED_TIME, timeouts["low_speed_time"])
+        if timeouts.get("total_timeout"):
+            c.setopt(pycurl.TIMEOUT, timeouts["total_timeout"])
+
+    def _progress_function(self, c, url):
+        """Progress callback for one transfer, enforcing the deadline and the bandwidth budgets.
+
+        Bytes are charged as they arrive. Once a budget is overdrawn the
+        transfer is paused rather than slept on, so other transfers on the
+        same CurlMulti keep going, and resumed from a later callback.
+        """
+        host = bandwidth.host_of(url)
+        counted = {"download": 0, "upload": 0}
+        resume_at = None
+
+        def progress(download_total, downloaded, upload_total, uploaded):
+            nonlocal resume_at
+            # A true return aborts the transfer with E_ABORTED_BY_CALLBACK
+            if self.past_deadline():
+                return True
+
+            now = time.monotonic()
+            if resume_at is not None:
+                if now < resume_at:
+                    return False
+                resume_at = None
+                c.pause(pycurl.PAUSE_CONT)
+
+            wait = 0.0
+            for direction, total in (("download", downloaded), ("upload", uploaded)):
+                wait = max(wait, bandwidth.reserve(direction, host, total - counted[direction]))
+                counted[direction] = total
+            if wait > 0:
+                resume_at = now + wait
+                c.pause(pycurl.PAUSE_ALL)
+            return False
+
+        return progress
+
+    def past_deadline(self):
+        """Whether the deadline is set and has passed."""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def release(self, url, c):
+        """Return a handle to the pool, or close it if the server already has enough idle handles."""
+        key = self.host_key(url)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(c)
+                return
+        self.discard(c)
+
+    def discard(self, c):
+        """Close a handle whose connection state can't be trusted, e.g. after an aborted transfer."""
+        with self._lock:
+            self._conn_ids.pop(id(c), None)
+        try:
+            c.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def handle(self, url):
+        """Context manager that acquires a handle and returns it to the pool afterwards."""
+        c = self.acquire(url)
+        try:
+            yield c
+        except Exception:
+            self.discard(c)
+            raise
+        else:
+            self.release(url, c)
+
+    def record(self, c):
+        """Count whether the last transfer on a handle opened a new connection or reused one."""
+        with self._lock:
+            if _CONN_ID is not None:
+                # The connection id identifies the control connection, FTP data connections don't change it
+                conn_id = c.getinfo(_CONN_ID)
+                opened = conn_id != self._conn_ids.get(id(c))
+                self._conn_ids[id(c)] = conn_id
+            else:
+                # Older pycurl builds only report new connections, which also counts FTP data connections
+                opened = c.getinfo(pycurl.NUM_CONNECTS) > 0
+
+            if opened:
+                self.connections_opened += 1
+            else:
+                self.connections_reused += 1
+
+    def perform(self, c):
+        """Run a transfer on a pooled handle and record connection reuse."""
+        c.perform()
+        self.record(c)
+
+    def stats(self):
+        """Return a snapshot of the connection counters."""
+        with self._lock:
+            return {
+                "connections_opened": self.connections_opened,
+                "connections_reused": self.connections_reused,
+            }
+
+    def _pop_idle(self, host, count=None):
+        """Take up to count idle handles of a server, all of them by default. Call with the lock held."""
+        handles = []
+        for key in [key for key in self._idle if bandwidth.host_of(key) == host]:
+            idle = self._idle[key]
+            while idle and (count is None or len(handles) < count):
+                # Oldest first, acquire reuses the most recently released handle
+                handles.append(idle.pop(0))
+            if not idle:
+                del self._idle[key]
+        return handles
+
+    def keep_slot(self, host):
+        """Keep a freed slot of a server, given as host_port, if one of its idle handles has none yet."""
+        with self._lock:
+            kept = self._kept_slots.get(host, 0)
+            idle = sum(len(handles) for key, handles in self._idle.items() if bandwidth.host_of(key) == host)
+            if idle <= kept:
+                return False
+            self._kept_slots[host] = kept + 1
+            # Handles past the kept slots, e.g. left over from another login, would be connections without one
+            surplus = self._pop_idle(host, idle - kept - 1)
+        for c in surplus:
+            self.discard(c)
+        return True
+
+    def take_slot(self, host):
+        """Hand a slot kept by an idle handle of a server to a new transfer, returning whether there was one."""
+        with self._lock:
+            kept = self._kept_slots.get(host, 0)
+            if not kept:
+                return False
+            self._kept_slots[host] = kept - 1
+            return True
+
+    def release_kept_slots(self):
+        """Close the idle handles that keep slots and free the slots, e.g. at the end of a batch."""
+        with self._lock:
+            hosts = [host for host, kept in self._kept_slots.items() if kept]
+        for host in hosts:
+            self.close_idle(host)
+
+    def close_idle(self, host):
+        """Close the idle handles of a server, given as host_port, freeing any slots they kept."""
+        with self._lock:
+            handles = self._pop_idle(host)
+            kept = self._kept_slots.pop(host, 0)
+        for c in handles:
+            self.discard(c)
+        for _ in range(kept):
+            host_limits.free(host)
+
+    def close(self):
+        """Close every idle handle in the pool, freeing any slots they kept."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            kept_slots, self._kept_slots = self._kept_slots, {}
+        for handles in idle.values():
+            for c in handles:
+                self.discard(c)
+        for host, kept in kept_slots.items():
+            for _ in range(kept):
+                host_limits.free(host)
@@ -1,26 +1,204 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import threading
+import time
 import config
 
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON lines for log shippers and ad hoc analysis."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class RateLimitFilter(logging.Filter):
+    """Drop records below WARNING once a logger passes max_per_second, so per-file chatter stays bounded.
+
+    Tokens refill continuously up to one second's worth. The next record let
+    through notes how many were suppressed before it.
+    """
+
+    def __init__(self, max_per_second):
+        super().__init__()
+        self.max_per_second = max_per_second
+        self.tokens = max_per_second
+        self.updated_at = time.monotonic()
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.max_per_second, self.tokens + (now - self.updated_at) * self.max_per_second)
+            self.updated_at = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} earlier records suppressed by rate limit)"
+            record.args = None
+        return True
+
+class BatchedFileHandler(logging.FileHandler):
+    """FileHandler that leaves flushing to the log listener, so records reach disk in batches."""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+    def close(self):
+        self.flush_batch()
+        super().close()
+
+class LogListener:
+    """Single writer for every process's log records, run in the parent.
+
+    Workers only put records on the queue. One thread here writes them to the
+    handlers of the logger they came from and flushes the files every
+    batch_size records, every flush_interval seconds, or at once for errors.
+    """
+
+    def __init__(self, log_queue, handlers, batch_size, flush_interval):
+        self.queue = log_queue
+        self.handlers = handlers  # {logger name: [handler, ...]}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write everything still queued, then stop the writer."""
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+        for handlers in self.handlers.values():
+            for handler in handlers:
+                handler.close()
+
+    def _run(self):
+        pending = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = False
+
+            if record is None:
+                self._flush()
+                return
+
+            if record:
+                for handler in self.handlers.get(record.name, []):
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                pending += 1
+
+            if pending and (pending >= self.batch_size or (record and record.levelno >= logging.ERROR)
+                            or time.monotonic() - last_flush >= self.flush_interval):
+                self._flush()
+                pending = 0
+                last_flush = time.monotonic()
+
+    def _flush(self):
+        for handlers in self.handlers.values():
+            for handler in handlers:
+                handler.flush_batch()
+
+def build_formatter(log_config):
+    if log_config.get("json"):
+        return JsonFormatter()
+    return logging.Formatter(log_config['format'])
+
 def setup_logger(name, log_config):
     """Set up a logger with the given name and log file path."""
     # Create logger
     logger = logging.getLogger(name)
     logger.setLevel(log_config['level'])
 
-    # Create file handler for the log file
-    handler = logging.FileHandler(log_config['file_path'])
+    # Create file handler for the log file, only opened once something is logged to it
+    handler = logging.FileHandler(log_config['file_path'], delay=True)
     handler.setLevel(log_config['level'])
 
     # Create log format
-    formatter = logging.Formatter(log_config['format'])
-    handler.setFormatter(formatter)
+    handler.setFormatter(build_formatter(log_config))
 
     # Add handler to logger
     logger.addHandler(handler)
 
+    # Rate limit the chatter before it is formatted or queued
+    if log_config.get("max_records_per_second"):
+        logger.addFilter(RateLimitFilter(log_config["max_records_per_second"]))
+
     return logger
 
+def use_queue(log_queue):
+    """Send this process's monitor and error records to the log listener's queue instead of the files."""
+    for logger in (monitor_logger, error_logger):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+def start_log_listener():
+    """Start the single log writer in the parent and route the parent's own records through it.
+
+    Returns the queue to hand to every worker through init_worker_logging.
+    """
+    global log_listener
+    log_queue = multiprocessing.Queue()
+    handlers = {}
+    for logger, log_config in ((monitor_logger, config.MONITOR_LOG), (error_logger, config.ERROR_LOG)):
+        handler = BatchedFileHandler(log_config['file_path'])
+        handler.setLevel(log_config['level'])
+        handler.setFormatter(build_formatter(log_config))
+        handlers[logger.name] = [handler]
+
+    log_listener = LogListener(log_queue, handlers, config.LOG_QUEUE["batch_size"], config.LOG_QUEUE["flush_interval"])
+    log_listener.start()
+    use_queue(log_queue)
+    atexit.register(stop_log_listener)
+    return log_queue
+
+def stop_log_listener():
+    """Write out every queued record and close the log files."""
+    if log_listener is not None:
+        log_listener.stop()
+
+def init_worker_logging(log_queue):
+    """Pool initializer part, points the worker's loggers at the parent's log listener."""
+    if log_queue is not None:
+        use_queue(log_queue)
+
+# The parent's log writer, set by start_log_listener
+log_listener = None
+
 # Ensure the log directory exists
 os.makedirs(config.LOCAL_LOG_DIR, exist_ok=True)
 
@@ -32,4 +210,4 @@ error_logger = setup_logger('error', config.ERROR_LOG)
 #monitor_logger.debug("This is a debug message, logged to monitor.log only if level is DEBUG.")
 #monitor_logger.info("This is an info message, logged to monitor.log if level is INFO or lower.")
 #monitor_logger.warning("This is a warning message, logged to monitor.log if level is WARNING or lower.")
-#error_logger.error("This is an error message, logged to error.log only.")
\ No newline at end of file
+#error_logger.error("This is an error message, logged to error.log only.")
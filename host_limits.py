@@ -0,0 +1,85 @@
+import multiprocessing
+from contextlib import contextmanager
+
+# {host: semaphore} shared by every process, set in each worker by init_worker
+_host_semaphores = {}
+
+# Pool whose idle connections keep their host's slots, set with keep_idle_slots
+_slot_keeper = None
+
+def create_host_semaphores(hosts, max_connections, per_host=None):
+    """Create one cross-process semaphore per host, in the parent before the Pool starts.
+
+    Hosts limited to 0 connections, or missing with a max_connections of 0,
+    get no semaphore and are unlimited.
+    """
+    per_host = per_host or {}
+    semaphores = {}
+    for host in hosts:
+        limit = per_host.get(host, max_connections)
+        if limit and host not in semaphores:
+            semaphores[host] = multiprocessing.BoundedSemaphore(limit)
+    return semaphores
+
+def init_worker(semaphores):
+    """Pool initializer, gives the worker the semaphores created in the parent."""
+    global _host_semaphores
+    _host_semaphores = semaphores
+
+def try_acquire(host):
+    """Take a connection slot for a host without waiting, returning whether one was free."""
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        return True
+    # A slot kept by an idle connection goes to the next transfer, which reuses that connection
+    if _slot_keeper is not None and _slot_keeper.take_slot(host):
+        return True
+    return semaphore.acquire(block=False)
+
+def acquire(host):
+    """Take a connection slot for a host, waiting for another process to free one if needed."""
+    if try_acquire(host):
+        return
+    if _slot_keeper is not None:
+        # Another process may be waiting for the slots this one keeps idle, so they are given up before waiting
+        _slot_keeper.release_kept_slots()
+    _host_semaphores[host].acquire()
+
+def release(host):
+    """Free a connection slot for a host, unless an idle connection to it keeps the slot."""
+    semaphore = _host_semaphores.get(host)
+    if semaphore is not None:
+        if _slot_keeper is not None and _slot_keeper.keep_slot(host):
+            return
+        semaphore.release()
+
+def free(host):
+    """Free a slot that was kept by an idle connection, once the connection is closed."""
+    semaphore = _host_semaphores.get(host)
+    if semaphore is not None:
+        semaphore.release()
+
+def keep_idle_slots(keeper):
+    """Let keeper, usually the process's CurlPool, hold on to the slots of its idle connections.
+
+    A connection kept open for reuse still counts against its host's limit.
+    keeper.keep_slot(host) is asked before each slot of a limited host is
+    freed and returns True if an idle connection keeps it, keeper.take_slot(host)
+    hands such a slot to the next transfer to the host, and
+    keeper.release_kept_slots() closes the idle connections and frees their slots.
+    """
+    global _slot_keeper
+    _slot_keeper = keeper
+
+@contextmanager
+def host_slot(host, acquired=False):
+    """Hold a connection slot for a host for the duration of the block.
+
+    Pass acquired=True when the slot was already taken with try_acquire.
+    """
+    if not acquired:
+        acquire(host)
+    try:
+        yield
+    finally:
+        release(host)
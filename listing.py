@@ -0,0 +1,182 @@
+import asyncio
+import calendar
+import re
+import stat
+import time
+from fnmatch import fnmatchcase
+from io import BytesIO
+from urllib.parse import quote, urlparse
+
+import pycurl
+
+# Characters that make a SOURCES entry a glob pattern rather than a single file
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+# curl errors for a listing command the server answered with a 5xx reply, as opposed to a failed transfer
+COMMAND_REJECTED_ERRORS = (pycurl.E_FTP_COULDNT_RETR_FILE, pycurl.E_QUOTE_ERROR)
+
+class RemoteEntry:
+    """One name from a directory listing, with the size and modified time the listing returned."""
+
+    def __init__(self, name, is_dir, size=None, modified_time=None):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.modified_time = modified_time
+
+def remote_url(server, remote_path):
+    """Build the URL for a remote path, percent-encoding names with spaces or other special characters.
+
+    A % is left as it is, so SOURCES paths that are already percent-encoded aren't encoded twice.
+    """
+    return f"{server}{quote(remote_path, safe='/%')}"
+
+def is_pattern(remote_path):
+    """Whether a SOURCES entry is a directory (trailing slash) or a glob pattern to expand."""
+    return remote_path.endswith('/') or bool(GLOB_CHARS.search(remote_path))
+
+def parse_mlsd(listing):
+    """Parse MLSD output into RemoteEntry objects, skipping the . and .. entries."""
+    entries = []
+    for line in listing.splitlines():
+        facts_text, _, name = line.partition(' ')
+        if not name:
+            continue
+
+        facts = {}
+        for fact in facts_text.split(';'):
+            key, _, value = fact.partition('=')
+            if key:
+                facts[key.lower()] = value
+
+        entry_type = facts.get("type", "").lower()
+        if entry_type in ("cdir", "pdir"):
+            continue
+
+        modified_time = None
+        if "modify" in facts:
+            # MLSD times are UTC, YYYYMMDDHHMMSS with optional fractional seconds
+            modified_time = calendar.timegm(time.strptime(facts["modify"][:14], "%Y%m%d%H%M%S"))
+
+        size = int(facts["size"]) if facts.get("size", "").isdigit() else None
+        entries.append(RemoteEntry(name, entry_type == "dir", size, modified_time))
+    return entries
+
+class FtpLister:
+    """List FTP directories with one MLSD request each over a pooled curl connection."""
+
+    def __init__(self, server, curl_pool):
+        self.server = server
+        self.curl_pool = curl_pool
+        self.mlsd_supported = True
+
+    def list(self, directory):
+        url = remote_url(self.server, directory)
+        if self.mlsd_supported:
+            try:
+                return parse_mlsd(self._fetch(url, "MLSD"))
+            except pycurl.error as e:
+                # A timeout or dropped connection says nothing about MLSD support
+                if e.args[0] not in COMMAND_REJECTED_ERRORS:
+                    raise
+                # Servers such as vsftpd don't implement MLSD, fall back to bare names
+                self.mlsd_supported = False
+
+        # NLST gives names only, so the size and timestamp are probed later and directories can't be told apart
+        return [RemoteEntry(name.rsplit('/', 1)[-1], False)
+                for name in self._fetch(url, None).splitlines() if name]
+
+    def _fetch(self, url, command):
+        buffer = BytesIO()
+        with self.curl_pool.handle(url) as c:
+            c.setopt(pycurl.WRITEDATA, buffer)
+            if command:
+                c.setopt(pycurl.CUSTOMREQUEST, command)
+            else:
+                c.setopt(pycurl.DIRLISTONLY, True)
+            self.curl_pool.perform(c)
+        return buffer.getvalue().decode("utf-8", errors="replace")
+
+    def close(self):
+        pass
+
+class SftpLister:
+    """List SFTP directories with readdir over a single asyncssh session."""
+
+    def __init__(self, server):
+        # asyncssh is only needed when SFTP sources use patterns
+        import asyncssh
+
+        parsed = urlparse(server)
+        self._loop = asyncio.new_event_loop()
+        self._conn = self._loop.run_until_complete(asyncssh.connect(
+            parsed.hostname, port=parsed.port or 22,
+            username=parsed.username, password=parsed.password, known_hosts=None
+        ))
+        self._sftp = self._loop.run_until_complete(self._conn.start_sftp_client())
+
+    def list(self, directory):
+        names = self._loop.run_until_complete(self._sftp.readdir(directory or "/"))
+        entries = []
+        for name in names:
+            if name.filename in (".", ".."):
+                continue
+            attrs = name.attrs
+            is_dir = attrs.permissions is not None and stat.S_ISDIR(attrs.permissions)
+            entries.append(RemoteEntry(name.filename, is_dir, attrs.size, attrs.mtime))
+        return entries
+
+    def close(self):
+        self._sftp.exit()
+        self._conn.close()
+        self._loop.run_until_complete(self._conn.wait_closed())
+        self._loop.close()
+
+def expand_pattern(server, pattern, curl_pool):
+    """Expand a directory or glob pattern into (server, remote_path, size, modified_time) entries.
+
+    A trailing slash means every file in that directory, and a ** component
+    matches any number of subdirectories. Each directory is listed once, and
+    the sizes and timestamps from the listing are returned with each file.
+    """
+    if pattern.endswith('/'):
+        pattern += '*'
+    parts = [part for part in pattern.split('/') if part]
+
+    lister = SftpLister(server) if urlparse(server).scheme == "sftp" else FtpLister(server, curl_pool)
+    listings = {}
+
+    def list_directory(directory):
+        if directory not in listings:
+            listings[directory] = lister.list(directory)
+        return listings[directory]
+
+    def walk(directory, parts):
+        head, rest = parts[0], parts[1:]
+
+        if head == '**':
+            # Match the rest here, then again in every subdirectory below
+            yield from walk(directory, rest or ['*'])
+            for entry in list_directory(directory):
+                if entry.is_dir:
+                    yield from walk(f"{directory}{entry.name}/", parts)
+            return
+
+        if rest and not GLOB_CHARS.search(head):
+            # A literal directory name needs no listing
+            yield from walk(f"{directory}{head}/", rest)
+            return
+
+        for entry in list_directory(directory):
+            if not fnmatchcase(entry.name, head):
+                continue
+            if rest:
+                if entry.is_dir:
+                    yield from walk(f"{directory}{entry.name}/", rest)
+            elif not entry.is_dir:
+                yield server, f"{directory}{entry.name}", entry.size, entry.modified_time
+
+    try:
+        return list(walk('/', parts))
+    finally:
+        lister.close()
@@ -1,50 +1,88 @@
-from multiprocessing import Pool
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, Queue
+import argparse
 import os
+import queue
+import signal
+import threading
 import time
 
-# Azure imports
-from azure.storage.blob import BlobServiceClient
-
 # Local imports
 from sources import SOURCES
 import config
 import custom_logging as cl
+import bandwidth
 import child
+import host_limits
+import metrics
+from listing import is_pattern
+from polling import PollSchedule
+from retry import CircuitBreaker, RetryQueue
+from scheduler import plan_batches
 
 def ensure_container_exists():
-    """Ensure the Azure container exists."""
+    """Ensure the container of the configured storage sink exists."""
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(config.AZURE_STORAGE_CONNECTION_STRING)
-        container_client = blob_service_client.get_container_client(config.AZURE_CONTAINER_NAME)
-
-        # Check if the container exists
-        if not container_client.exists():
-            container_client.create_container()
-            cl.monitor_logger.info(f"Created Azure container: {config.AZURE_CONTAINER_NAME}")
-        else:
-            cl.monitor_logger.info(f"Azure container already exists: {config.AZURE_CONTAINER_NAME}")
-
+        child.sink.ensure_container()
     except Exception as e:
-        cl.error_logger.error(f"Error ensuring Azure container exists: {e}")
+        cl.error_logger.error(f"Error ensuring {child.sink.name} container exists: {e}")
         raise
 
+# Queue the worker reports the batches it starts on, for the parent's watchdog, set by init_worker
+started_queue = None
+
+def init_worker(host_semaphores, log_queue, batch_started_queue=None, bandwidth_limiter=None):
+    """Pool initializer, gives each worker the host connection slots, bandwidth budgets and queues created in the parent."""
+    global started_queue
+    host_limits.init_worker(host_semaphores)
+    bandwidth.init_worker(bandwidth_limiter)
+    cl.init_worker_logging(log_queue)
+    started_queue = batch_started_queue
+
+def init_daemon_worker(host_semaphores, log_queue, bandwidth_limiter=None):
+    """Pool initializer for daemon mode, workers ignore Ctrl-C so their running batches finish when the daemon stops."""
+    init_worker(host_semaphores, log_queue, bandwidth_limiter=bandwidth_limiter)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 def process_batch_completed(result):
     """Callback function to be executed when a batch process completes."""
-    cl.monitor_logger.info(f"Batch process completed with result: {result}")
+    success = result[0]
+    cl.monitor_logger.info(f"Batch process completed with result: {success}")
+
+def get_engine():
+    """Return the module that processes batches, child for pycurl or async_child for asyncio."""
+    if config.CHILD_PROCESS["engine"] == "asyncio":
+        if config.STORAGE["backend"] != "azure":
+            raise Exception("The asyncio engine only uploads to Azure, use the pycurl engine with other storage backends")
+        if config.CONTENT_ADDRESSING["enabled"] or config.COMPRESSION["enabled"]:
+            raise Exception("The asyncio engine doesn't support CONTENT_ADDRESSING or COMPRESSION, use the pycurl engine with them")
+        # The asyncio engine's dependencies are only needed when it is selected
+        import async_child
+        return async_child
+    return child
 
 def process_batch_with_logging(batch, batch_number):
-    """Wrapper around child.process_batch to add logging for start and end times."""
+    """Wrapper around child.process_batch to add logging for start and end times.
+
+    Returns whether the batch succeeded, the stage timings the worker
+    recorded since its last batch, for the run report, and the entries that
+    failed or were never tried, for a retry.
+    """
     cl.monitor_logger.info(f"Batch {batch_number + 1} started processing.")
     start_time = time.time()
+    if started_queue is not None:
+        started_queue.put((batch_number, os.getpid()))
 
     try:
-        # Process the batch using the existing function
-        child.process_batch(batch)
+        # Process the batch with the configured engine
+        failed, deferred = get_engine().process_batch(batch)
         success = True
     except Exception as e:
         cl.error_logger.error(f"Error in batch {batch_number + 1}: {e}")
         cl.monitor_logger.error(f"Batch {batch_number + 1} failed due to error.")
         success = False
+        failed, deferred = list(batch), []
 
     # Calculate elapsed time for processing
     elapsed_time = time.time() - start_time
@@ -53,61 +91,446 @@ def process_batch_with_logging(batch, batch_number):
     else:
         cl.monitor_logger.error(f"Batch {batch_number + 1} failed in {elapsed_time:.2f} seconds.")
     
-    return success
+    return success, metrics.collector.drain(), failed, deferred
+
+def expand_sources(pool, sources):
+    """Turn SOURCES into (server, remote_path) entries, expanding directory and glob patterns in the pool.
+
+    Files found by expanding a pattern come back as (server, remote_path, size, modified_time)
+    using the sizes and timestamps from the directory listing.
+    """
+    entries = []
+    patterns = []
+    for server, file_list in sources.items():
+        for file in file_list:
+            if is_pattern(file):
+                patterns.append((server, file))
+            else:
+                entries.append((server, file))
+
+    for expanded in pool.map(child.expand_source, patterns):
+        entries.extend(expanded)
+
+    return entries
+
+def has_metadata(entry):
+    """Whether an entry already carries its remote size and modified time."""
+    return len(entry) == 4 and None not in entry[2:]
+
+def probe_missing_metadata(pool, entries):
+    """Probe remote sizes and timestamps in the pool for entries that don't have them yet.
+
+    Returns (server, remote_path, size, modified_time) entries so the workers
+    don't request the same metadata again before downloading. Entries whose
+    metadata came from a directory listing are not probed again.
+    """
+    probed = [entry for entry in entries if has_metadata(entry)]
+    probed += pool.map(child.probe_remote_file, [entry for entry in entries if not has_metadata(entry)])
+    return probed
+
+def filter_unchanged_files(entries):
+    """Drop files the state store has already ingested with the same size and modified time."""
+    remaining = [entry for entry in entries if not child.state_store.is_unchanged(*entry)]
+
+    skipped = len(entries) - len(remaining)
+    cl.monitor_logger.info(f"Skipping {skipped} unchanged files out of {len(entries)}, {len(remaining)} to ingest")
+    return remaining
+
+def write_run_report(samples, elapsed_seconds, successful_batches, failed_batches):
+    """Aggregate the stage timings of every worker into the JSON run report and Prometheus textfile."""
+    try:
+        report = metrics.build_report(samples, elapsed_seconds, successful_batches, failed_batches)
+        metrics.write_report(report, config.METRICS["report_path"], config.METRICS["prometheus_path"])
+    except Exception as e:
+        cl.error_logger.error(f"Error writing the run report: {e}")
+        return
+
+    for stage, summary in report["stages"].items():
+        cl.monitor_logger.info(
+            f"Stage {stage}: {summary['count']} samples, {summary['seconds']:.2f} seconds, "
+            f"{summary['bytes']} bytes, {summary['bytes_per_second'] / 1024 / 1024:.2f} MB/s, "
+            f"p90 {summary['quantiles']['0.9']:.2f} seconds"
+        )
+
+def collect_started(batch_started_queue, started):
+    """Record when each batch a worker reported starting was seen, as {batch_number: (pid, started_at)}."""
+    while True:
+        try:
+            batch_number, pid = batch_started_queue.get_nowait()
+        except queue.Empty:
+            return
+        started[batch_number] = (pid, time.monotonic())
+
+def reclaim_overdue_batches(outstanding, started, time_limit):
+    """Stop waiting for batches still running time_limit seconds after they started.
+
+    Each overdue batch is removed from outstanding and returned as
+    (batch_number, batch), so its files can be handed out again. The worker
+    itself is left running until the Pool is terminated at the end of the
+    run, since stopping it early could take a connection slot, a bandwidth
+    bucket or the log queue that every other worker shares down with it.
+    """
+    now = time.monotonic()
+    reclaimed = []
+    for batch_number, (result, batch) in list(outstanding.items()):
+        if batch_number not in started or result.ready():
+            continue
+        pid, started_at = started[batch_number]
+        if now - started_at >= time_limit:
+            cl.error_logger.error(f"Batch {batch_number + 1} in worker {pid} is still running after {time_limit} seconds, "
+                                  f"handing its files back for a retry")
+            del outstanding[batch_number]
+            reclaimed.append((batch_number, batch))
+    return reclaimed
+
+def queue_retries(retry_queue, breaker, batch, failed, deferred):
+    """Queue a finished batch's failed and untried entries for a retry, updating each server's circuit.
+
+    Returns the entries given up after running out of attempts.
+    """
+    failed_keys = {(entry[0], entry[1]) for entry in failed}
+    deferred_keys = {(entry[0], entry[1]) for entry in deferred}
+    for entry in batch:
+        key = (entry[0], entry[1])
+        if key not in failed_keys and key not in deferred_keys:
+            breaker.record_success(child.get_server_folder_name(entry[0]))
+
+    given_up = []
+    for entry in failed:
+        host = child.get_server_folder_name(entry[0])
+        if breaker.record_failure(host):
+            cl.monitor_logger.warning(f"Holding back retries for {host} for {breaker.cooldown} seconds after "
+                                      f"{breaker.failure_threshold} failures in a row")
+        delay = retry_queue.add(entry)
+        if delay is None:
+            given_up.append(entry)
+            cl.error_logger.error(f"Giving up on {entry[1]} from {entry[0]} after {retry_queue.max_attempts} attempts")
+        else:
+            cl.monitor_logger.info(f"Retrying {entry[1]} from {entry[0]} in {delay:.0f} seconds")
+    for entry in deferred:
+        retry_queue.add(entry, failed=False)
+    return given_up
 
 def ingest_files():
+    run_started_at = time.time()
+
+    # Reject an engine that can't handle the configured features before any batch is dispatched
+    get_engine()
+
     # Ensure the log directory exists
     os.makedirs(config.LOCAL_DOWNLOAD_DIR, exist_ok=True)
 
     # Ensure the Azure container exists
     ensure_container_exists()
 
-    batches = [[] for _ in range(config.BATCH_SIZE)]
-    batch_index = 0
-
-    # Iterate over each server and their files
-    for server, file_list in SOURCES.items():
-        for file in file_list:
-            # Add file to the current batch
-            batches[batch_index].append((server, file))
-
-            # Add batches round robin style
-            batch_index = (batch_index + 1) % config.BATCH_SIZE
-
-    # Filter out empty batches
-    batches = [batch for batch in batches if batch]
-    
-    # Log the total number of batches to be processed
-    total_batches = len(batches)
-    cl.monitor_logger.info(f"Total batches to process: {total_batches}")
-
     # Track number of successful and failed batches
     successful_batches = 0
     failed_batches = 0
 
+    # Connection slots per server, shared by every worker so no server sees more than its limit
+    host_semaphores = host_limits.create_host_semaphores(
+        [child.get_server_folder_name(server) for server in SOURCES],
+        config.HOST_LIMITS["max_connections_per_host"],
+        config.HOST_LIMITS["per_host"]
+    )
+
+    # Workers only queue their log records, a single writer in this process writes them to disk
+    log_queue = cl.start_log_listener() if config.LOG_QUEUE["enabled"] else None
+    # Workers report each batch they start, so the watchdog knows how long it has been running
+    batch_started_queue = Queue()
+
+    # Bandwidth budgets, shared by every worker like the connection slots
+    bandwidth_limiter = bandwidth.create_limiter(
+        [child.get_server_folder_name(server) for server in SOURCES], config.BANDWIDTH)
+
     # Use multiprocessing Pool, automatically handles creating a queue and running waiting batches
-    with Pool(processes=config.MAX_PARALLEL_PROCESSES) as pool:
-        results = []
-        for batch_number, batch in enumerate(batches):
-            results.append(pool.apply_async(
+    with Pool(processes=config.MAX_PARALLEL_PROCESSES, initializer=init_worker,
+              initargs=(host_semaphores, log_queue, batch_started_queue, bandwidth_limiter)) as pool:
+        # Every (server, remote path) entry from the sources, with directories and globs expanded
+        entries = expand_sources(pool, SOURCES)
+
+        # Sizes are needed both to skip unchanged files and to balance batches
+        if child.state_store is not None or config.SCHEDULER["strategy"] == "lpt":
+            entries = probe_missing_metadata(pool, entries)
+
+        if child.state_store is not None:
+            entries = filter_unchanged_files(entries)
+
+        # Balance batches by estimated transfer time, the longest batch is dispatched first
+        host_rates = child.state_store.host_rates() if child.state_store is not None else {}
+        planned = plan_batches(
+            entries, config.BATCH_SIZE, config.SCHEDULER["strategy"], host_rates,
+            default_rate=config.SCHEDULER["default_rate"],
+            per_file_overhead=config.SCHEDULER["per_file_overhead"]
+        )
+        batches = [batch for batch, _ in planned]
+
+        # Log the total number of batches to be processed
+        total_batches = len(batches)
+        cl.monitor_logger.info(f"Total batches to process: {total_batches}")
+        for batch_number, (batch, estimate) in enumerate(planned):
+            cl.monitor_logger.info(f"Batch {batch_number}: {len(batch)} files, estimated {estimate:.1f} seconds")
+
+        retry_settings = config.RETRY
+        retry_queue = RetryQueue(retry_settings["initial_delay"], retry_settings["max_delay"],
+                                 retry_settings["max_attempts"])
+        breaker = CircuitBreaker(retry_settings["breaker_failures"], retry_settings["breaker_cooldown"])
+        time_limit = config.CHILD_PROCESS["timeout"] + config.CHILD_PROCESS["watchdog_grace"]
+        outstanding = {}  # {batch_number: (result, batch)} of batches that haven't finished
+        started = {}
+        reclaimed_batches = 0
+        given_up = 0
+
+        def dispatch(batch, batch_number):
+            outstanding[batch_number] = (pool.apply_async(
                 process_batch_with_logging, 
                 args=(batch, batch_number), 
                 callback=process_batch_completed
-            ))
+            ), batch)
 
-        pool.close()
-        pool.join()
+        for batch_number, batch in enumerate(batches):
+            dispatch(batch, batch_number)
 
-        # Count successes and failures
-        for result in results:
-            if result.get():
-                successful_batches += 1
-            else:
+        # Count successes and failures, collecting every worker's stage timings, until nothing is left to retry
+        samples = []
+        while outstanding or retry_queue:
+            collect_started(batch_started_queue, started)
+            # A stuck batch's files are retried like failed ones, and the batch counts as failed
+            for batch_number, batch in reclaim_overdue_batches(outstanding, started, time_limit):
+                reclaimed_batches += 1
                 failed_batches += 1
+                if retry_settings["enabled"]:
+                    given_up += len(queue_retries(retry_queue, breaker, batch, list(batch), []))
+
+            for batch_number, (result, batch) in list(outstanding.items()):
+                if not result.ready():
+                    continue
+                del outstanding[batch_number]
+                success, batch_samples, failed, deferred = result.get()
+                samples.extend(batch_samples)
+                if success:
+                    successful_batches += 1
+                else:
+                    failed_batches += 1
+                if retry_settings["enabled"]:
+                    given_up += len(queue_retries(retry_queue, breaker, batch, failed, deferred))
+
+            # Files of servers whose circuit is open stay queued until it closes
+            due = retry_queue.due(allow=lambda entry: breaker.allow(child.get_server_folder_name(entry[0])))
+            if due:
+                planned = plan_batches(
+                    due, config.BATCH_SIZE, config.SCHEDULER["strategy"], host_rates,
+                    default_rate=config.SCHEDULER["default_rate"],
+                    per_file_overhead=config.SCHEDULER["per_file_overhead"]
+                )
+                for batch, _ in planned:
+                    cl.monitor_logger.info(f"Batch {total_batches}: retrying {len(batch)} files")
+                    dispatch(batch, total_batches)
+                    total_batches += 1
+
+            if outstanding or retry_queue:
+                time.sleep(1.0)
+
+        if reclaimed_batches:
+            # Workers of reclaimed batches may never return, so they are stopped rather than waited for
+            cl.monitor_logger.warning(f"Stopping the workers, {reclaimed_batches} batches were still running past their time limit")
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
 
     # Log summary at the end of the entire process
     cl.monitor_logger.info(f"Batch processing complete. {successful_batches} succeeded, {failed_batches} failed out of {total_batches} total batches.")
+    if given_up:
+        cl.monitor_logger.error(f"Gave up on {given_up} files after {config.RETRY['max_attempts']} attempts each")
+    if config.METRICS["enabled"]:
+        write_run_report(samples, time.time() - run_started_at, successful_batches, failed_batches)
+    cl.stop_log_listener()
+
+def poll_source(executor, server, file_list):
+    """List and probe one source from this process, returning (server, remote_path, size, modified_time) entries.
+
+    Files whose metadata couldn't be fetched are left out and tried again on
+    the next poll.
+    """
+    patterns = [(server, file) for file in file_list if is_pattern(file)]
+    files = [(server, file) for file in file_list if not is_pattern(file)]
+
+    entries = []
+    for expanded in executor.map(child.expand_source, patterns):
+        entries.extend(expanded)
+    entries += executor.map(child.probe_remote_file, files)
+    return [entry for entry in entries if has_metadata(entry)]
+
+def run_daemon():
+    """Stay resident, polling each source on its own interval and dispatching only new or changed files.
+
+    The worker pool is created once, so the workers' connection pools and
+    blob indexes stay warm between batches, and this process keeps its own
+    connections for listing and probing the sources. Each source's poll
+    interval shortens while it keeps changing and grows while it doesn't.
+    Failed files are retried from a RetryQueue rather than the next poll, and
+    a file given up on is only dispatched again once it changes, so a broken
+    file doesn't keep its source at the shortest interval.
+    Runs until SIGINT or SIGTERM, then lets the dispatched batches finish.
+    """
+    if child.state_store is None:
+        raise Exception("Daemon mode needs INGESTION_STATE enabled to tell new and changed files from ingested ones")
+
+    settings = config.DAEMON
+    run_started_at = time.time()
+    get_engine()
+    os.makedirs(config.LOCAL_DOWNLOAD_DIR, exist_ok=True)
+    ensure_container_exists()
+
+    host_semaphores = host_limits.create_host_semaphores(
+        [child.get_server_folder_name(server) for server in SOURCES],
+        config.HOST_LIMITS["max_connections_per_host"],
+        config.HOST_LIMITS["per_host"]
+    )
+    bandwidth_limiter = bandwidth.create_limiter(
+        [child.get_server_folder_name(server) for server in SOURCES], config.BANDWIDTH)
+    # Polls run in this process and take connection slots and bandwidth like the workers do
+    host_limits.init_worker(host_semaphores)
+    bandwidth.init_worker(bandwidth_limiter)
+    log_queue = cl.start_log_listener() if config.LOG_QUEUE["enabled"] else None
+
+    schedule = PollSchedule(list(SOURCES), settings["min_poll_interval"], settings["max_poll_interval"],
+                            settings["poll_backoff"])
+    retry_settings = config.RETRY
+    retry_queue = RetryQueue(retry_settings["initial_delay"], retry_settings["max_delay"],
+                             retry_settings["max_attempts"] if retry_settings["enabled"] else 1)
+    breaker = CircuitBreaker(retry_settings["breaker_failures"], retry_settings["breaker_cooldown"])
+    stop = threading.Event()
+    lock = threading.Lock()
+    # (server, remote_path) of files in dispatched batches that haven't finished, or waiting for a retry
+    in_flight = set()
+    # {(server, remote_path): (size, modified_time)} of files given up on, skipped until they change
+    given_up = {}
+    samples = deque()  # (time.monotonic(), sample) of the last report_window seconds
+    totals = {"successful": 0, "failed": 0}
+    pending = []
+    batch_number = 0
+    last_report_at = time.monotonic()
+
+    def add_samples(new_samples):
+        now = time.monotonic()
+        samples.extend((now, sample) for sample in new_samples)
+        while samples and samples[0][0] < now - settings["report_window"]:
+            samples.popleft()
+
+    def batch_finished(batch, success, batch_samples, failed=(), deferred=()):
+        with lock:
+            dropped = queue_retries(retry_queue, breaker, batch, failed, deferred)
+            retrying = {(entry[0], entry[1]) for entry in list(failed) + list(deferred)}
+            for entry in dropped:
+                given_up[(entry[0], entry[1])] = tuple(entry[2:4])
+                retrying.discard((entry[0], entry[1]))
+            for entry in batch:
+                if (entry[0], entry[1]) not in retrying:
+                    in_flight.discard((entry[0], entry[1]))
+                    retry_queue.forget(entry)
+            add_samples(batch_samples)
+            totals["successful" if success else "failed"] += 1
+
+    def dispatch(batch, batch_number):
+        """Queue a batch in the pool, its files count as in flight until it finishes."""
+        def completed(result):
+            batch_finished(batch, *result)
+            process_batch_completed(result)
+
+        def failed(error):
+            cl.error_logger.error(f"Batch {batch_number + 1} could not be processed: {error}")
+            batch_finished(batch, False, [], failed=batch)
+
+        with lock:
+            in_flight.update((server, remote_path) for server, remote_path, *_ in batch)
+        return pool.apply_async(process_batch_with_logging, args=(batch, batch_number),
+                                callback=completed, error_callback=failed)
+
+    with Pool(processes=config.MAX_PARALLEL_PROCESSES,
+              initializer=init_daemon_worker, initargs=(host_semaphores, log_queue, bandwidth_limiter)) as pool, \
+         ThreadPoolExecutor(max_workers=settings["poll_workers"]) as executor:
+        # Installed after the Pool starts, so the workers keep the default handlers
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        cl.monitor_logger.info(f"Daemon watching {len(SOURCES)} sources")
+
+        while not stop.is_set():
+            pending = [result for result in pending if not result.ready()]
+
+            # Leave due sources for later while the workers are still busy with earlier batches
+            for server in schedule.due() if len(pending) < settings["max_pending_batches"] else []:
+                entries = poll_source(executor, server, SOURCES[server])
+                with lock:
+                    entries = [entry for entry in entries if (entry[0], entry[1]) not in in_flight and
+                               given_up.get((entry[0], entry[1])) != tuple(entry[2:4])]
+                    # A changed file starts over with a full set of attempts
+                    for entry in entries:
+                        given_up.pop((entry[0], entry[1]), None)
+                        retry_queue.forget(entry)
+                entries = [entry for entry in entries if not child.state_store.is_unchanged(*entry)]
+
+                interval = schedule.record(server, bool(entries))
+                cl.monitor_logger.info(f"Polled {server}: {len(entries)} new or changed files, "
+                                       f"next poll in {interval:.0f} seconds")
+
+                planned = plan_batches(
+                    entries, config.BATCH_SIZE, config.SCHEDULER["strategy"], child.state_store.host_rates(),
+                    default_rate=config.SCHEDULER["default_rate"],
+                    per_file_overhead=config.SCHEDULER["per_file_overhead"]
+                )
+                for batch, _ in planned:
+                    pending.append(dispatch(batch, batch_number))
+                    batch_number += 1
+
+            # Files of servers whose circuit is open stay queued until it closes
+            with lock:
+                due = retry_queue.due(allow=lambda entry: breaker.allow(child.get_server_folder_name(entry[0])))
+            if due:
+                planned = plan_batches(
+                    due, config.BATCH_SIZE, config.SCHEDULER["strategy"], child.state_store.host_rates(),
+                    default_rate=config.SCHEDULER["default_rate"],
+                    per_file_overhead=config.SCHEDULER["per_file_overhead"]
+                )
+                for batch, _ in planned:
+                    cl.monitor_logger.info(f"Batch {batch_number + 1}: retrying {len(batch)} files")
+                    pending.append(dispatch(batch, batch_number))
+                    batch_number += 1
+
+            if config.METRICS["enabled"] and time.monotonic() - last_report_at >= settings["report_interval"]:
+                with lock:
+                    # Polls and probes in this process record their timings here too
+                    add_samples(metrics.collector.drain())
+                    write_run_report([sample for _, sample in samples], time.time() - run_started_at,
+                                     totals["successful"], totals["failed"])
+                last_report_at = time.monotonic()
+
+            next_retry = retry_queue.seconds_until_next()
+            wait = min(schedule.seconds_until_next(), settings["report_interval"],
+                       next_retry if next_retry is not None else float("inf"))
+            stop.wait(max(1.0, wait))
+
+        cl.monitor_logger.info(f"Daemon stopping, waiting for {len(pending)} dispatched batches")
+        pool.close()
+        pool.join()
+
+    cl.monitor_logger.info(f"Daemon stopped. {totals['successful']} batches succeeded, {totals['failed']} failed.")
+    if retry_queue:
+        cl.monitor_logger.info(f"Dropped {len(retry_queue)} files waiting for a retry, the next run polls them again")
+    if config.METRICS["enabled"]:
+        add_samples(metrics.collector.drain())
+        write_run_report([sample for _, sample in samples], time.time() - run_started_at,
+                         totals["successful"], totals["failed"])
+    cl.stop_log_listener()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest files from the configured sources into storage.")
+    parser.add_argument("--daemon", action="store_true", help="stay resident and poll the sources instead of running once")
+    args = parser.parse_args()
+
     cl.monitor_logger.info(f"Started ingesting files with pid {os.getpid()}")
-    ingest_files()
\ No newline at end of file
+    if args.daemon:
+        run_daemon()
+    else:
+        ingest_files()
\ No newline at end of file
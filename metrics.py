@@ -0,0 +1,132 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Quantiles reported for every stage, overall and per host
+QUANTILES = (0.5, 0.9, 0.99)
+
+class MetricsCollector:
+    """Per-process record of how long each stage of each file took and how many bytes it moved.
+
+    Samples are (stage, host, seconds, bytes). Workers drain them at the end
+    of every batch and hand them back to the parent, which aggregates them
+    into the run report.
+    """
+
+    def __init__(self):
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, host, seconds, num_bytes=0):
+        with self._lock:
+            self._samples.append((stage, host, seconds, num_bytes))
+
+    @contextmanager
+    def timed(self, stage, host, num_bytes=0):
+        """Time the block as one sample, set sample["bytes"] inside it if the size is only known afterwards."""
+        sample = {"bytes": num_bytes}
+        started_at = time.monotonic()
+        yield sample
+        self.record(stage, host, time.monotonic() - started_at, sample["bytes"])
+
+    def drain(self):
+        """Return every sample recorded since the last drain and start over."""
+        with self._lock:
+            samples, self._samples = self._samples, []
+        return samples
+
+# The collector of this process, used by both engines
+collector = MetricsCollector()
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(samples):
+    """Count, totals, throughput and duration quantiles of a list of samples."""
+    durations = [seconds for _, _, seconds, _ in samples]
+    total_seconds = sum(durations)
+    total_bytes = sum(num_bytes for _, _, _, num_bytes in samples)
+    return {
+        "count": len(samples),
+        "seconds": total_seconds,
+        "bytes": total_bytes,
+        "bytes_per_second": total_bytes / total_seconds if total_seconds else 0.0,
+        "quantiles": {str(q): percentile(durations, q) for q in QUANTILES},
+    }
+
+def build_report(samples, elapsed_seconds, successful_batches, failed_batches):
+    """Aggregate the samples of a whole run into totals per stage and per host and stage."""
+    by_stage = {}
+    by_host = {}
+    for sample in samples:
+        stage, host = sample[0], sample[1]
+        by_stage.setdefault(stage, []).append(sample)
+        by_host.setdefault(host, {}).setdefault(stage, []).append(sample)
+
+    return {
+        "finished_at": int(time.time()),
+        "elapsed_seconds": elapsed_seconds,
+        "batches": {"successful": successful_batches, "failed": failed_batches},
+        "stages": {stage: summarize(stage_samples) for stage, stage_samples in sorted(by_stage.items())},
+        "hosts": {host: {stage: summarize(stage_samples) for stage, stage_samples in sorted(stages.items())}
+                  for host, stages in sorted(by_host.items())},
+    }
+
+def prometheus_lines(report):
+    """Render a report in the Prometheus text exposition format."""
+    lines = [
+        "# HELP ingestion_run_seconds Wall time of the last ingestion run.",
+        "# TYPE ingestion_run_seconds gauge",
+        f"ingestion_run_seconds {report['elapsed_seconds']}",
+        "# HELP ingestion_batches Batches of the last ingestion run by result.",
+        "# TYPE ingestion_batches gauge",
+        f'ingestion_batches{{result="successful"}} {report["batches"]["successful"]}',
+        f'ingestion_batches{{result="failed"}} {report["batches"]["failed"]}',
+        "# HELP ingestion_last_run_timestamp_seconds When the last ingestion run finished.",
+        "# TYPE ingestion_last_run_timestamp_seconds gauge",
+        f"ingestion_last_run_timestamp_seconds {report['finished_at']}",
+    ]
+
+    series = {
+        "ingestion_stage_seconds": ("summary", "Time spent in each stage of the last run, per host."),
+        "ingestion_stage_bytes": ("gauge", "Bytes moved by each stage of the last run, per host."),
+        "ingestion_stage_bytes_per_second": ("gauge", "Throughput of each stage of the last run, per host."),
+    }
+    for name, (metric_type, help_text) in series.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        for host, stages in report["hosts"].items():
+            for stage, summary in stages.items():
+                labels = f'stage="{stage}",host="{host}"'
+                if name == "ingestion_stage_seconds":
+                    for q, value in summary["quantiles"].items():
+                        lines.append(f'{name}{{{labels},quantile="{q}"}} {value}')
+                    lines.append(f"{name}_sum{{{labels}}} {summary['seconds']}")
+                    lines.append(f"{name}_count{{{labels}}} {summary['count']}")
+                elif name == "ingestion_stage_bytes":
+                    lines.append(f"{name}{{{labels}}} {summary['bytes']}")
+                else:
+                    lines.append(f"{name}{{{labels}}} {summary['bytes_per_second']}")
+    return lines
+
+def write_atomically(path, text):
+    """Write a file through a temporary file and a rename, so readers never see it half written."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def write_report(report, json_path=None, prometheus_path=None):
+    """Write the run report as JSON and as a Prometheus textfile-collector file."""
+    if json_path:
+        write_atomically(json_path, json.dumps(report, indent=2))
+    if prometheus_path:
+        write_atomically(prometheus_path, "\n".join(prometheus_lines(report)) + "\n")
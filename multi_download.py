@@ -0,0 +1,355 @@
+import os
+import threading
+import time
+from collections import deque
+
+import pycurl
+
+# Segments in flight per server, shared by every MultiDownloader in the process
+_segments_per_host = {}
+_segments_lock = threading.Lock()
+
+class DownloadJob:
+    """A single file transfer driven by MultiDownloader."""
+
+    def __init__(self, url, local_path, on_done, on_error, on_metadata=None, context=None):
+        self.url = url
+        self.local_path = local_path
+        self.on_done = on_done  # called with the job once the file is fully written
+        self.on_error = on_error  # called with the job and the exception if any step fails
+        self.on_metadata = on_metadata  # called with the job once the remote size and timestamp are known, returning False skips the download
+        self.context = context  # caller data carried through to the callbacks
+        self.writer = None  # set by on_metadata to stream the body somewhere other than local_path
+        self.target = None  # the object behind writer, for the callbacks to finish off
+        self.expected_size = None  # set both of these up front to skip the metadata request
+        self.remote_timestamp = None
+        self.phase = None
+        self.file = None  # opened here unless on_metadata opens it, e.g. to append to a partial file
+        self.hasher = None  # set by on_metadata to hash the body as it is written to file
+        self.resume_from = 0  # byte offset to resume the download from
+        self.segment_count = 1  # set by on_metadata to fetch the file as byte ranges over several connections
+        self.segments = []
+        self.fd = None
+        self.failed = False
+        self.started_at = None  # time.monotonic() when the download phase started
+        self.host = None  # key for the per-host connection slots, None means unlimited
+        self.slots = 0  # connection slots currently held for the job
+
+class Segment:
+    """One byte range of a segmented download, written into the preallocated local file at its own offset."""
+
+    def __init__(self, job, start, end):
+        self.job = job
+        self.start = start
+        self.end = end  # inclusive, as in a curl RANGE
+        self.position = start
+
+    def write(self, data):
+        # Never write past the end of the range into the next segment
+        chunk = data[:self.end + 1 - self.position]
+        if chunk:
+            os.pwrite(self.job.fd, chunk, self.position)
+            self.position += len(chunk)
+
+    @property
+    def complete(self):
+        return self.position == self.end + 1
+
+class MultiDownloader:
+    """Keep up to max_concurrent transfers in flight on a single pycurl.CurlMulti.
+
+    Every job first runs a metadata request for the remote size and timestamp,
+    then the download itself, either to local_path or to the job's writer.
+    A job whose on_metadata asks for several segments is fetched as byte
+    ranges on separate connections, capped at max_segments_per_host across all
+    segmented jobs on the same server, a job that finds the cap reached is
+    fetched as a single transfer. Finished jobs are handed to their
+    on_done callback from the event loop, transfers still in flight resume once
+    it returns.
+
+    With acquire_slot and release_slot set, a job only starts once
+    acquire_slot(job.host) returns True, and holds that slot, plus one more
+    for each extra segment, until its transfer ends. Jobs for hosts with no
+    free slot wait while jobs for other hosts go ahead.
+    """
+
+    def __init__(self, curl_pool, max_concurrent, max_segments_per_host=4, select_timeout=1.0,
+                 acquire_slot=None, release_slot=None, on_transfer=None):
+        self.curl_pool = curl_pool
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_segments_per_host = max(1, max_segments_per_host)
+        self.select_timeout = select_timeout
+        self.acquire_slot = acquire_slot
+        self.release_slot = release_slot
+        self.on_transfer = on_transfer  # called with the job and its curl handle after every successful request, e.g. for timings
+        self._multi = pycurl.CurlMulti()
+        self._active = {}
+
+    def run(self, jobs):
+        """Run all jobs to completion."""
+        pending = deque(jobs)
+
+        while pending or self._active:
+            # Top up the transfers in flight
+            while pending and len(self._active) < self.max_concurrent:
+                job = self._next_job(pending)
+                if job is None:
+                    break
+                if job.expected_size is None or job.remote_timestamp is None:
+                    self._start(job, "metadata")
+                else:
+                    self._metadata_known(job)
+
+            while True:
+                ret, _ = self._multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, succeeded, failed = self._multi.info_read()
+                for c in succeeded:
+                    self._finish(c)
+                for c, errno, errmsg in failed:
+                    self._fail(c, Exception(f"curl error {errno}: {errmsg}"))
+                if queued == 0:
+                    break
+
+            if self._active:
+                self._multi.select(self.select_timeout)
+            elif pending:
+                # Every waiting host is at its limit, idle connections this process keeps may hold the slots needed
+                self.curl_pool.release_kept_slots()
+                time.sleep(self.select_timeout)
+
+    def _next_job(self, pending):
+        """Take the first pending job whose host has a free connection slot, or None if none do."""
+        for _ in range(len(pending)):
+            job = pending.popleft()
+            if self._take_slot(job):
+                return job
+            pending.append(job)
+        return None
+
+    def _take_slot(self, job):
+        if self.acquire_slot is None:
+            return True
+        if not self.acquire_slot(job.host):
+            return False
+        job.slots += 1
+        return True
+
+    def _release_slots(self, job):
+        while job.slots:
+            job.slots -= 1
+            self.release_slot(job.host)
+
+    def _done(self, job):
+        """Hand a finished job to its callback, freeing its connection slots first."""
+        self._release_slots(job)
+        try:
+            job.on_done(job)
+        except Exception as e:
+            self._error(job, e)
+
+    def _error(self, job, error):
+        self._release_slots(job)
+        job.on_error(job, error)
+
+    def _start(self, job, phase):
+        job.phase = phase
+        if phase == "download":
+            job.started_at = time.monotonic()
+        if phase == "download" and job.segment_count > 1 and self._start_segments(job):
+            return
+
+        try:
+            c = self.curl_pool.acquire(job.url)
+            if phase == "metadata":
+                c.setopt(pycurl.NOBODY, True)
+                c.setopt(pycurl.OPT_FILETIME, True)
+                c.setopt(pycurl.WRITEFUNCTION, lambda data: None)
+            elif job.writer is not None:
+                c.setopt(pycurl.WRITEFUNCTION, job.writer)
+            else:
+                if job.file is None:
+                    job.file = open(job.local_path, 'wb')
+                if job.hasher is not None:
+                    c.setopt(pycurl.WRITEFUNCTION, job.hasher.wrap(job.file.write))
+                else:
+                    c.setopt(pycurl.WRITEDATA, job.file)
+                if job.resume_from:
+                    c.setopt(pycurl.RESUME_FROM_LARGE, job.resume_from)
+        except Exception as e:
+            self._close_file(job)
+            self._error(job, e)
+            return
+
+        self._active[c] = (job, None)
+        self._multi.add_handle(c)
+
+    def _start_segments(self, job):
+        """Split a job into byte ranges, each fetched on its own connection into a preallocated file.
+
+        Returns False, with the job set to a single transfer, when the server
+        already has max_segments_per_host segments in flight.
+        """
+        key = self.curl_pool.host_key(job.url)
+        with _segments_lock:
+            in_use = _segments_per_host.get(key, 0)
+            if in_use >= self.max_segments_per_host:
+                # Fetched as a plain download, which doesn't count against the cap
+                job.segment_count = 1
+                return False
+            count = min(job.segment_count, self.max_segments_per_host - in_use)
+            _segments_per_host[key] = in_use + count
+
+        # The job already holds one connection slot, every extra segment needs its own
+        extra = 0
+        while extra < count - 1 and self._take_slot(job):
+            extra += 1
+        if extra < count - 1:
+            with _segments_lock:
+                _segments_per_host[key] -= count - 1 - extra
+            count = extra + 1
+        job.segment_count = count
+
+        try:
+            job.fd = os.open(job.local_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            if job.expected_size:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(job.fd, 0, job.expected_size)
+                else:
+                    os.ftruncate(job.fd, job.expected_size)
+
+            segment_size = -(-job.expected_size // count)
+            for index in range(count):
+                start = index * segment_size
+                end = min(start + segment_size, job.expected_size) - 1
+                if start <= end:
+                    job.segments.append(Segment(job, start, end))
+
+            for segment in job.segments:
+                c = self.curl_pool.acquire(job.url)
+                c.setopt(pycurl.WRITEFUNCTION, segment.write)
+                c.setopt(pycurl.RANGE, f"{segment.start}-{segment.end}")
+                self._active[c] = (job, segment)
+                self._multi.add_handle(c)
+        except Exception as e:
+            self._abort_segments(job, e)
+            return True
+
+        if not job.segments:
+            # An empty file has no ranges to fetch
+            self._finish_segments(job)
+        return True
+
+    def _finish(self, c):
+        job, segment = self._active.pop(c)
+        self._multi.remove_handle(c)
+        self.curl_pool.record(c)
+        if self.on_transfer is not None:
+            self.on_transfer(job, c)
+
+        if segment is not None:
+            self.curl_pool.release(job.url, c)
+            if not segment.complete:
+                self._abort_segments(job, Exception(
+                    f"Incomplete segment {segment.start}-{segment.end} of {job.url}: "
+                    f"got {segment.position - segment.start} bytes"))
+            elif not job.failed and not self._has_active(job):
+                # Segments finishing in the same perform all look complete, only the last one ends the job
+                self._finish_segments(job)
+            return
+
+        if job.phase == "metadata":
+            try:
+                job.expected_size = int(c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD))
+                job.remote_timestamp = c.getinfo(pycurl.INFO_FILETIME)
+                self.curl_pool.release(job.url, c)
+
+                if job.expected_size < 0:
+                    raise Exception(f"Could not get the file size for {job.url}")
+                if job.remote_timestamp == -1:
+                    raise Exception(f"Could not get the last modified time for {job.url}")
+            except Exception as e:
+                self._error(job, e)
+                return
+            self._metadata_known(job)
+            return
+
+        try:
+            self._close_file(job)
+            self.curl_pool.release(job.url, c)
+        except Exception as e:
+            self._error(job, e)
+            return
+        self._done(job)
+
+    def _metadata_known(self, job):
+        """Let the caller prepare the job now the size and timestamp are known, then start the download."""
+        try:
+            if job.on_metadata is not None and job.on_metadata(job) is False:
+                self._release_slots(job)
+                return
+
+            if job.writer is None and job.resume_from and job.resume_from >= job.expected_size:
+                # A resumed partial file that is already complete needs no transfer
+                self._close_file(job)
+                self._done(job)
+                return
+        except Exception as e:
+            self._close_file(job)
+            self._error(job, e)
+            return
+
+        self._start(job, "download")
+
+    def _fail(self, c, error):
+        job, segment = self._active.pop(c)
+        self._multi.remove_handle(c)
+        self.curl_pool.discard(c)
+
+        if segment is not None:
+            self._abort_segments(job, error)
+            return
+
+        self._close_file(job)
+        self._error(job, error)
+
+    def _has_active(self, job):
+        """Whether any transfer of the job is still in flight."""
+        return any(active_job is job for active_job, _ in self._active.values())
+
+    def _finish_segments(self, job):
+        self._release_segments(job)
+        self._done(job)
+
+    def _abort_segments(self, job, error):
+        """Stop every remaining segment of a job and report the first failure once."""
+        if job.failed:
+            return
+        job.failed = True
+
+        for c, (active_job, segment) in list(self._active.items()):
+            if active_job is job:
+                del self._active[c]
+                self._multi.remove_handle(c)
+                self.curl_pool.discard(c)
+
+        self._release_segments(job)
+        self._error(job, error)
+
+    def _release_segments(self, job):
+        if job.fd is not None:
+            os.close(job.fd)
+            job.fd = None
+
+        key = self.curl_pool.host_key(job.url)
+        with _segments_lock:
+            _segments_per_host[key] = max(0, _segments_per_host.get(key, 0) - job.segment_count)
+
+    @staticmethod
+    def _close_file(job):
+        if job.file is not None:
+            job.file.close()
+            job.file = None
@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import deque
+
+# Marks the end of a stage's input, passed on to the next stage once every worker has finished
+_DONE = object()
+
+class ByteQueue:
+    """Queue between two pipeline stages, bounded by the bytes of the items waiting in it.
+
+    put() blocks while the queue holds max_bytes or more, so a fast stage
+    can't pile up more downloaded or extracted data than the next stage can
+    take. An item larger than max_bytes is still accepted once the queue is
+    empty, otherwise it could never pass.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.peak_bytes = 0
+        self._items = deque()
+        self._condition = threading.Condition()
+
+    def put(self, item, size=0):
+        """Add an item of the given size in bytes, returning the seconds spent waiting for room."""
+        started_at = time.monotonic()
+        with self._condition:
+            while self._items and self.bytes + size > self.max_bytes:
+                self._condition.wait()
+            self._items.append((item, size))
+            self.bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self._condition.notify_all()
+        return time.monotonic() - started_at
+
+    def get(self):
+        """Take the next item, waiting for one if the queue is empty."""
+        with self._condition:
+            while not self._items:
+                self._condition.wait()
+            item, size = self._items.popleft()
+            self.bytes -= size
+            self._condition.notify_all()
+            return item
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+class Stage:
+    """A pipeline stage that runs func on every item of its input queue with its own worker threads.
+
+    func(item, emit) handles one item and calls emit(next_item, size) for
+    anything the next stage should handle, any number of times. Exceptions
+    are passed to on_error(item, error) and the stage moves on to the next
+    item.
+    """
+
+    def __init__(self, name, func, workers, input_queue, output_queue=None, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.on_error = on_error
+        self.items = 0
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self._started_at = None
+        self._finished_at = None
+        self._threads = []
+        self._remaining_workers = workers
+        self._lock = threading.Lock()
+
+    def emit(self, item, size=0):
+        """Pass an item on to the next stage, waiting while its queue is full."""
+        blocked = self.output_queue.put(item, size)
+        with self._lock:
+            self.blocked_seconds += blocked
+
+    def start(self):
+        self._started_at = time.monotonic()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.input_queue.get()
+            if item is _DONE:
+                # Let the other workers of this stage see the end too, the last one passes it on
+                self.input_queue.put(_DONE)
+                self._worker_finished()
+                return
+
+            started_at = time.monotonic()
+            with self._lock:
+                self.busy += 1
+            try:
+                self.func(item, self.emit)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(item, e)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.items += 1
+                    self.busy_seconds += time.monotonic() - started_at
+
+    def _worker_finished(self):
+        with self._lock:
+            self._remaining_workers -= 1
+            last = self._remaining_workers == 0
+            if last:
+                self._finished_at = time.monotonic()
+        if last and self.output_queue is not None:
+            self.output_queue.put(_DONE)
+
+    def occupancy(self):
+        """Snapshot of the stage's load, used to tell which stage is the bottleneck.
+
+        utilization is the share of worker time spent handling items, blocked
+        the share spent waiting for room in the next stage's queue. A stage
+        with high utilization and little blocking is the bottleneck; one that
+        is mostly blocked is waiting on a slower stage after it.
+        """
+        with self._lock:
+            elapsed = ((self._finished_at or time.monotonic()) - self._started_at) if self._started_at else 0.0
+            capacity = elapsed * self.workers
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "busy": self.busy,
+                "items": self.items,
+                "queued": len(self.input_queue),
+                "queued_bytes": self.input_queue.bytes,
+                "peak_queued_bytes": self.input_queue.peak_bytes,
+                "utilization": self.busy_seconds / capacity if capacity else 0.0,
+                "blocked": self.blocked_seconds / capacity if capacity else 0.0,
+            }
+
+class Pipeline:
+    """Stages joined by byte-bounded queues, each stage feeding the next.
+
+    Items put into the first stage flow through every stage in order, so
+    while one stage works on an item the stages before it already work on
+    the next ones.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def add_stage(self, name, func, workers, max_queued_bytes, on_error=None):
+        """Append a stage whose input queue holds up to max_queued_bytes of waiting items."""
+        input_queue = ByteQueue(max_queued_bytes)
+        if self.stages:
+            self.stages[-1].output_queue = input_queue
+        stage = Stage(name, func, max(1, workers), input_queue, on_error=on_error)
+        self.stages.append(stage)
+        return stage
+
+    def run(self, items):
+        """Feed items through every stage and wait until the last stage has handled them all.
+
+        Items are (item, size) pairs, size being the bytes counted against the first queue.
+        """
+        for stage in self.stages:
+            stage.start()
+
+        first = self.stages[0].input_queue
+        for item, size in items:
+            first.put(item, size)
+        first.put(_DONE)
+
+        for stage in self.stages:
+            stage.join()
+
+    def occupancy(self):
+        """Occupancy of every stage, in pipeline order."""
+        return [stage.occupancy() for stage in self.stages]
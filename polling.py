@@ -0,0 +1,41 @@
+import time
+
+class PollSchedule:
+    """When each source is polled next, adapting its interval to how often it changes.
+
+    A poll that finds new or changed files halves the source's interval, down
+    to min_interval, and a poll that finds nothing stretches it by backoff, up
+    to max_interval. Every source is due for its first poll straight away.
+    """
+
+    def __init__(self, sources, min_interval, max_interval, backoff=1.5, now=None):
+        now = time.monotonic() if now is None else now
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.intervals = {source: min_interval for source in sources}
+        self.next_poll_at = {source: now for source in sources}
+
+    def due(self, now=None):
+        """Sources whose next poll time has come."""
+        now = time.monotonic() if now is None else now
+        return [source for source, poll_at in self.next_poll_at.items() if poll_at <= now]
+
+    def record(self, source, changed, now=None):
+        """Schedule a source's next poll after one that did or didn't find changes, returning the new interval."""
+        now = time.monotonic() if now is None else now
+        interval = self.intervals[source]
+        if changed:
+            interval = max(self.min_interval, interval / 2)
+        else:
+            interval = min(self.max_interval, interval * self.backoff)
+        self.intervals[source] = interval
+        self.next_poll_at[source] = now + interval
+        return interval
+
+    def seconds_until_next(self, now=None):
+        """Seconds until the next source is due, 0 if one already is."""
+        if not self.next_poll_at:
+            return self.max_interval
+        now = time.monotonic() if now is None else now
+        return max(0.0, min(self.next_poll_at.values()) - now)
@@ -0,0 +1,107 @@
+import heapq
+import itertools
+import threading
+import time
+
+class CircuitBreaker:
+    """Stop sending work to a host after it fails failure_threshold times in a row.
+
+    An open circuit rejects the host until cooldown seconds have passed, then
+    lets it be tried again. A success closes the circuit, another failure
+    opens it for a further cooldown. Safe to share between threads.
+    """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._open_until = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host, now=None):
+        """Whether the host's circuit is closed, or open long enough to try it again."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return self._open_until.get(host, now) <= now
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._open_until.pop(host, None)
+
+    def record_failure(self, host, now=None):
+        """Count a failure of the host, returning True if it opened the circuit."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if not self.failure_threshold or failures < self.failure_threshold:
+                return False
+            self._open_until[host] = now + self.cooldown
+            return True
+
+    def open_hosts(self, now=None):
+        """Hosts whose circuit is currently open."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [host for host, open_until in self._open_until.items() if open_until > now]
+
+class RetryQueue:
+    """Entries waiting to be tried again, each after a delay that doubles with every failed attempt.
+
+    Entries are (server, remote_path, ...) tuples. An entry is given up once it
+    has failed max_attempts times, counting its first try.
+    """
+
+    def __init__(self, initial_delay, max_delay, max_attempts):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.attempts = {}  # (server, remote_path): failed attempts so far
+        self._waiting = []  # heap of (retry_at, sequence, entry)
+        self._sequence = itertools.count()
+
+    def add(self, entry, failed=True, now=None):
+        """Queue an entry for a retry, returning its delay or None if it has run out of attempts.
+
+        Pass failed=False for an entry that was handed back without being
+        tried, it is retried after initial_delay without using up an attempt.
+        """
+        now = time.monotonic() if now is None else now
+        key = (entry[0], entry[1])
+        attempts = self.attempts.get(key, 0) + (1 if failed else 0)
+        self.attempts[key] = attempts
+        if attempts >= self.max_attempts:
+            return None
+
+        delay = min(self.max_delay, self.initial_delay * 2 ** max(0, attempts - 1))
+        heapq.heappush(self._waiting, (now + delay, next(self._sequence), entry))
+        return delay
+
+    def forget(self, entry):
+        """Drop an entry's failed attempts, e.g. once it has been ingested or has changed on the server."""
+        self.attempts.pop((entry[0], entry[1]), None)
+
+    def due(self, allow=None, now=None):
+        """Take the entries whose retry time has come, leaving those allow(entry) rejects queued."""
+        now = time.monotonic() if now is None else now
+        due, held = [], []
+        while self._waiting and self._waiting[0][0] <= now:
+            item = heapq.heappop(self._waiting)
+            if allow is None or allow(item[2]):
+                due.append(item[2])
+            else:
+                held.append(item)
+        for item in held:
+            heapq.heappush(self._waiting, item)
+        return due
+
+    def seconds_until_next(self, now=None):
+        """Seconds until the next entry is due, 0 if one already is, None if the queue is empty."""
+        if not self._waiting:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._waiting[0][0] - now)
+
+    def __len__(self):
+        return len(self._waiting)
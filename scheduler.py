@@ -0,0 +1,49 @@
+import heapq
+
+from state_store import server_key
+
+def estimate_seconds(entry, host_rates, default_rate, per_file_overhead):
+    """Estimate how long an entry takes to transfer from its size and the server's past download rate."""
+    server = entry[0]
+    size = entry[2] if len(entry) > 2 else None
+    rate = host_rates.get(server_key(server)) or default_rate
+    return per_file_overhead + (size or 0) / rate
+
+def round_robin_batches(entries, batch_count):
+    """Deal entries out to batch_count batches in turn, ignoring their sizes."""
+    batches = [[] for _ in range(batch_count)]
+    for index, entry in enumerate(entries):
+        batches[index % batch_count].append(entry)
+    return [batch for batch in batches if batch]
+
+def lpt_batches(entries, batch_count, host_rates, default_rate, per_file_overhead):
+    """Pack entries into batch_count batches by longest processing time first.
+
+    Entries are taken longest first and each goes to the batch with the least
+    estimated time so far, so no batch is left holding several of the largest
+    files. Returns (batch, estimated_seconds) pairs, longest batch first, so
+    the slowest work is dispatched to the pool before anything else.
+    """
+    costs = sorted(((estimate_seconds(entry, host_rates, default_rate, per_file_overhead), entry)
+                    for entry in entries), key=lambda item: item[0], reverse=True)
+
+    # Heap of (estimated seconds, batch index) so the least loaded batch is always on top
+    loads = [(0.0, index) for index in range(batch_count)]
+    batches = [[] for _ in range(batch_count)]
+    for cost, entry in costs:
+        load, index = heapq.heappop(loads)
+        batches[index].append(entry)
+        heapq.heappush(loads, (load + cost, index))
+
+    estimates = {index: load for load, index in loads}
+    planned = [(batch, estimates[index]) for index, batch in enumerate(batches) if batch]
+    return sorted(planned, key=lambda item: item[1], reverse=True)
+
+def plan_batches(entries, batch_count, strategy, host_rates, default_rate, per_file_overhead):
+    """Split entries into batches with the configured strategy, returning (batch, estimated_seconds) pairs."""
+    if strategy == "lpt":
+        return lpt_batches(entries, batch_count, host_rates, default_rate, per_file_overhead)
+    if strategy == "round_robin":
+        return [(batch, sum(estimate_seconds(entry, host_rates, default_rate, per_file_overhead) for entry in batch))
+                for batch in round_robin_batches(entries, batch_count)]
+    raise Exception(f"Unknown scheduler strategy: {strategy}")
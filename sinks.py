@@ -0,0 +1,295 @@
+import errno
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no ioctl, files are hardlinked or copied there
+    fcntl = None
+
+from azure.storage.blob import BlobServiceClient, ContentSettings
+
+import bandwidth
+import config
+import custom_logging as cl
+from blob_blocks import BlockStager, upload_file_in_blocks
+
+# A stored blob as returned by list_blobs, the same two attributes the Azure listing provides
+StoredBlob = namedtuple("StoredBlob", ["name", "metadata"])
+
+# ioctl that clones a file's extents on filesystems with reflinks (btrfs, xfs), from linux/fs.h
+FICLONE = 0x40049409
+
+def content_settings(hasher=None, content_encoding=None):
+    """Azure content settings for an upload, storing the MD5 as the blob's Content-MD5 property."""
+    if hasher is None:
+        return ContentSettings(content_type="application/octet-stream", content_encoding=content_encoding)
+    return ContentSettings(content_type="application/octet-stream", content_encoding=content_encoding,
+                           content_md5=bytearray(hasher.md5_digest()))
+
+class AzureSink:
+    """Blob container in Azure Blob Storage, or Azurite.
+
+    Every sink offers the same operations on blob paths: put a local file,
+    stage a stream in blocks and commit it, put small bytes, look up a blob's
+    metadata, list blobs under a prefix and copy a blob. The metadata stored
+    with each blob is the same on every backend.
+    """
+
+    name = "Azure"
+    # Blobs keep their Content-Encoding, so readers get compressed uploads decoded
+    supports_content_encoding = True
+
+    def __init__(self, connection_string, container_name):
+        self.blob_service_client = BlobServiceClient.from_connection_string(
+            connection_string,
+            max_block_size=config.UPLOAD["block_size"],
+            max_single_put_size=config.UPLOAD["single_put_threshold"],
+            connection_timeout=config.UPLOAD["connection_timeout"],
+            read_timeout=config.UPLOAD["read_timeout"]
+        )
+        self.container_client = self.blob_service_client.get_container_client(container_name)
+
+    def ensure_container(self):
+        """Create the container if it doesn't exist yet."""
+        if not self.container_client.exists():
+            self.container_client.create_container()
+            cl.monitor_logger.info(f"Created Azure container: {self.container_client.container_name}")
+        else:
+            cl.monitor_logger.info(f"Azure container already exists: {self.container_client.container_name}")
+
+    def get_metadata(self, path):
+        """Return the metadata of a blob, or None if it doesn't exist."""
+        try:
+            return self.container_client.get_blob_client(path).get_blob_properties().metadata
+        except Exception:
+            return None
+
+    def list_blobs(self, name_starts_with="", include=None, results_per_page=None):
+        """List the blobs under a prefix, with their metadata when include has "metadata"."""
+        return self.container_client.list_blobs(name_starts_with=name_starts_with, include=include,
+                                                results_per_page=results_per_page)
+
+    def put_file(self, path, local_path, file_size, modified_time, hasher, metadata):
+        """Upload a local file, in one request or as resumable blocks, returning the single put's response."""
+        blob_client = self.container_client.get_blob_client(path)
+        settings = content_settings(hasher)
+        # The SDK sends a single put's body in one go, so with an upload budget only block-sized pieces are
+        # charged and sent at a time
+        block_limit = config.UPLOAD["block_size"] if bandwidth.limits("upload") else config.UPLOAD["single_put_threshold"]
+        if file_size > block_limit:
+            # Large files are staged as blocks in parallel, resuming any blocks an earlier attempt left behind
+            upload_file_in_blocks(
+                blob_client, local_path, file_size, modified_time,
+                block_size=config.UPLOAD["block_size"],
+                max_concurrency=config.UPLOAD["max_concurrency"],
+                retries=config.UPLOAD["block_retries"],
+                retry_delay=config.UPLOAD["block_retry_delay"],
+                content_settings=settings,
+                metadata=metadata,
+                timeout=config.UPLOAD["operation_timeout"]
+            )
+            return None
+
+        # Upload the blob with metadata, Azure checks the bytes it receives against Content-MD5
+        bandwidth.throttle("upload", None, file_size)
+        with open(local_path, "rb") as data:
+            return blob_client.upload_blob(
+                data,
+                content_settings=settings,
+                metadata=metadata,
+                overwrite=True,
+                max_concurrency=config.UPLOAD["max_concurrency"],
+                headers={"Content-MD5": hasher.md5_base64()},
+                timeout=config.UPLOAD["operation_timeout"]
+            )
+
+    def put_bytes(self, path, data, metadata):
+        """Upload a small piece of data, such as a reference blob, in one request."""
+        bandwidth.throttle("upload", None, len(data))
+        self.container_client.get_blob_client(path).upload_blob(
+            data, content_settings=content_settings(), metadata=metadata, overwrite=True,
+            timeout=config.UPLOAD["operation_timeout"])
+
+    def stager(self, path, block_size):
+        """Start a block upload to path, fed with write() and finished with commit()."""
+        return BlockStager(self.container_client.get_blob_client(path), block_size,
+                           retries=config.UPLOAD["block_retries"], retry_delay=config.UPLOAD["block_retry_delay"],
+                           timeout=config.UPLOAD["operation_timeout"])
+
+    def commit(self, stager, hasher, metadata, content_encoding=None):
+        """Commit a stager's blocks, in order, as the blob's content, with Content-Encoding when it is compressed."""
+        stager.commit(content_settings=content_settings(hasher, content_encoding), metadata=metadata)
+
+    def copy(self, source_path, path, metadata):
+        """Create path as a server-side copy of source_path with its own metadata."""
+        source_url = self.container_client.get_blob_client(source_path).url
+        copy = self.container_client.get_blob_client(path).start_copy_from_url(source_url, metadata=metadata)
+        if copy.get("copy_status") not in ("success", "pending"):
+            raise Exception(f"Copy of {source_path} to {path} failed with status {copy.get('copy_status')}")
+
+class LocalStager:
+    """Write streamed data to a temporary file next to its destination, renamed into place on commit."""
+
+    def __init__(self, sink, path):
+        self.sink = sink
+        self.name = path
+        self.bytes_received = 0
+        self.error = None
+        self.temp_path = sink.temp_path_for(path)
+        self.file = open(self.temp_path, "wb")
+
+    def write(self, data):
+        """Append data, returning 0 aborts the pycurl transfer like BlockStager."""
+        try:
+            self.file.write(data)
+            self.bytes_received += len(data)
+        except Exception as e:
+            self.error = e
+            return 0
+        return None
+
+    def abort(self):
+        """Close and remove the temporary file of data that won't be committed, safe to call more than once."""
+        if not self.file.closed:
+            self.file.close()
+        remove_quietly(self.temp_path)
+
+class LocalSink:
+    """Blob container kept as a directory tree on a local or mounted filesystem.
+
+    Blobs are files at <root>/<container>/<path> and their metadata is JSON
+    under <root>/<container>/.metadata/<path>.json. Files are written to a
+    temporary name and renamed into place, data first and metadata last, so
+    a blob only exists once it is complete. Local files and copies are
+    placed with a reflink where the filesystem supports it, otherwise a
+    hardlink, so the data isn't copied at all.
+    """
+
+    name = "local storage"
+    # Files have nowhere to keep a Content-Encoding, so uploads are stored as they are
+    supports_content_encoding = False
+
+    def __init__(self, root, container_name):
+        self.root = os.path.join(root, container_name)
+        self.metadata_root = os.path.join(self.root, ".metadata")
+
+    def data_path(self, path):
+        return os.path.join(self.root, *path.split("/"))
+
+    def metadata_path(self, path):
+        return os.path.join(self.metadata_root, *path.split("/")) + ".json"
+
+    def temp_path_for(self, path):
+        destination = self.data_path(path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        return os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.{uuid.uuid4().hex}.tmp")
+
+    def ensure_container(self):
+        os.makedirs(self.metadata_root, exist_ok=True)
+        cl.monitor_logger.info(f"Using local storage at {self.root}")
+
+    def get_metadata(self, path):
+        try:
+            with open(self.metadata_path(path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def list_blobs(self, name_starts_with="", include=None, results_per_page=None):
+        # Walk only the directory the prefix points into, like a prefix listing
+        start = os.path.dirname(self.metadata_path(name_starts_with + "x"))
+        for directory, _, files in os.walk(start):
+            for file_name in files:
+                if not file_name.endswith(".json"):
+                    continue
+                full_path = os.path.join(directory, file_name)
+                name = os.path.relpath(full_path, self.metadata_root)[:-len(".json")].replace(os.sep, "/")
+                if name.startswith(name_starts_with):
+                    yield StoredBlob(name, self.get_metadata(name) or {})
+
+    def put_file(self, path, local_path, file_size, modified_time, hasher, metadata):
+        temp_path = self.temp_path_for(path)
+        try:
+            place_file(local_path, temp_path)
+            self._publish(temp_path, path, metadata)
+        finally:
+            remove_quietly(temp_path)
+        return None
+
+    def put_bytes(self, path, data, metadata):
+        temp_path = self.temp_path_for(path)
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            self._publish(temp_path, path, metadata)
+        finally:
+            remove_quietly(temp_path)
+
+    def stager(self, path, block_size):
+        return LocalStager(self, path)
+
+    def commit(self, stager, hasher, metadata, content_encoding=None):
+        try:
+            stager.file.close()
+            self._publish(stager.temp_path, stager.name, metadata)
+        finally:
+            remove_quietly(stager.temp_path)
+
+    def copy(self, source_path, path, metadata):
+        temp_path = self.temp_path_for(path)
+        try:
+            place_file(self.data_path(source_path), temp_path)
+            self._publish(temp_path, path, metadata)
+        finally:
+            remove_quietly(temp_path)
+
+    def _publish(self, temp_path, path, metadata):
+        """Rename finished data into place, then write its metadata the same way."""
+        os.replace(temp_path, self.data_path(path))
+
+        metadata_path = self.metadata_path(path)
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(metadata_path), delete=False) as f:
+            json.dump(metadata, f)
+        os.replace(f.name, metadata_path)
+
+def place_file(source, destination):
+    """Make destination a reflink of source, or a hardlink, falling back to copying the bytes."""
+    if fcntl is not None:
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+        remove_quietly(destination)
+
+    try:
+        os.link(source, destination)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    shutil.copyfile(source, destination)
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def create_sink():
+    """Create the sink selected by STORAGE backend in config.py."""
+    backend = config.STORAGE["backend"]
+    if backend == "azure":
+        return AzureSink(config.AZURE_STORAGE_CONNECTION_STRING, config.AZURE_CONTAINER_NAME)
+    if backend == "local":
+        return LocalSink(config.STORAGE["local_root"], config.AZURE_CONTAINER_NAME)
+    raise Exception(f"Unknown storage backend: {backend}")
@@ -0,0 +1,137 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+def server_key(server):
+    """Key a server URL as scheme://host:port, so its credentials are never written to the database."""
+    parsed = urlparse(server)
+    return f"{parsed.scheme}://{parsed.hostname}:{parsed.port or (21 if parsed.scheme == 'ftp' else 22)}"
+
+class StateStore:
+    """SQLite record of every ingested file, keyed by server and remote path.
+
+    Each ingested_files row keeps the remote size and modified time seen when
+    the file was ingested and the blob path(s) it produced, so later runs can
+    skip files that have not changed. host_stats keeps the bytes and seconds
+    spent downloading from each server, which the scheduler turns into
+    transfer rates. Every process and thread opens its own connection and the
+    database runs in WAL mode with a busy timeout, which makes it safe for the
+    multiprocessing Pool workers to write to at the same time. Servers are
+    stored by server_key, without the user name and password of their URL.
+    """
+
+    def __init__(self, path, busy_timeout=30):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ingested_files (
+                    server TEXT NOT NULL,
+                    remote_path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    modified_time INTEGER NOT NULL,
+                    blob_paths TEXT NOT NULL,
+                    ingested_at INTEGER NOT NULL,
+                    PRIMARY KEY (server, remote_path)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS host_stats (
+                    server TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    seconds REAL NOT NULL,
+                    updated_at INTEGER NOT NULL
+                )
+            """)
+            self._migrate_server_keys(conn)
+
+    @staticmethod
+    def _migrate_server_keys(conn):
+        """Rekey rows written under full server URLs, which could hold credentials, by server_key."""
+        for (server,) in conn.execute("SELECT DISTINCT server FROM ingested_files").fetchall():
+            if server_key(server) != server:
+                conn.execute("UPDATE OR REPLACE ingested_files SET server = ? WHERE server = ?",
+                             (server_key(server), server))
+        for server, num_bytes, seconds, updated_at in conn.execute(
+                "SELECT server, bytes, seconds, updated_at FROM host_stats").fetchall():
+            if server_key(server) != server:
+                conn.execute("""
+                    INSERT INTO host_stats (server, bytes, seconds, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (server) DO UPDATE SET
+                        bytes = bytes + excluded.bytes,
+                        seconds = seconds + excluded.seconds,
+                        updated_at = max(updated_at, excluded.updated_at)
+                """, (server_key(server), num_bytes, seconds, updated_at))
+                conn.execute("DELETE FROM host_stats WHERE server = ?", (server,))
+
+    def _connection(self):
+        """Return this thread's connection, opening a new one after a fork."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, server, remote_path):
+        """Return the stored state for a file, or None if it has never been ingested."""
+        row = self._connection().execute(
+            "SELECT size, modified_time, blob_paths, ingested_at FROM ingested_files WHERE server = ? AND remote_path = ?",
+            (server_key(server), remote_path)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "size": row[0],
+            "modified_time": row[1],
+            "blob_paths": json.loads(row[2]),
+            "ingested_at": row[3],
+        }
+
+    def is_unchanged(self, server, remote_path, size, modified_time):
+        """Whether a file was already ingested with the same remote size and modified time."""
+        if size is None or modified_time is None:
+            return False
+        state = self.get(server, remote_path)
+        return (state is not None and
+                state["size"] == size and
+                state["modified_time"] == int(modified_time))
+
+    def record(self, server, remote_path, size, modified_time, blob_paths):
+        """Record a successfully ingested file, replacing any earlier state."""
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT INTO ingested_files (server, remote_path, size, modified_time, blob_paths, ingested_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (server, remote_path) DO UPDATE SET
+                    size = excluded.size,
+                    modified_time = excluded.modified_time,
+                    blob_paths = excluded.blob_paths,
+                    ingested_at = excluded.ingested_at
+            """, (server_key(server), remote_path, size, int(modified_time), json.dumps(blob_paths), int(time.time())))
+
+    def record_transfer(self, server, num_bytes, seconds):
+        """Add a finished download to the server's running transfer totals."""
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT INTO host_stats (server, bytes, seconds, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (server) DO UPDATE SET
+                    bytes = bytes + excluded.bytes,
+                    seconds = seconds + excluded.seconds,
+                    updated_at = excluded.updated_at
+            """, (server_key(server), num_bytes, seconds, int(time.time())))
+
+    def host_rates(self):
+        """Return the average download rate in bytes per second seen for each server, keyed by server_key."""
+        rows = self._connection().execute("SELECT server, bytes, seconds FROM host_stats WHERE seconds > 0")
+        return {server: num_bytes / seconds for server, num_bytes, seconds in rows}